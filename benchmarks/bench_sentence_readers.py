@@ -0,0 +1,78 @@
+# Benchmark of the OpenSubtitles sentence readers (see datasets_preprocess.opensubtitles.SENTENCE_READERS).
+#
+# Every reader runs in a fresh process, so peak RSS figures are not polluted by other readers.
+#
+# Usage:
+#    python benchmarks/bench_sentence_readers.py <subtitles_dir> [--readers etree bs4] [--max-docs N]
+#
+# @author: jpquiroga@gmail.com
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import resource
+import multiprocessing
+from typing import List, Dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from datasets_preprocess.opensubtitles import SENTENCE_READERS
+
+
+def _run_reader(reader: str, files: List[str], queue: multiprocessing.Queue):
+    num_sentences = 0
+    start_time = time.perf_counter()
+    for f in files:
+        num_sentences += len(dict(SENTENCE_READERS[reader](f)))
+    elapsed_time = time.perf_counter() - start_time
+    queue.put({
+        "reader": reader,
+        "docs": len(files),
+        "sentences": num_sentences,
+        "seconds": elapsed_time,
+        "docs_per_second": len(files) / elapsed_time if elapsed_time > 0 else None,
+        # Linux reports ru_maxrss in kilobytes
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    })
+
+
+def benchmark_sentence_readers(files: List[str], readers: List[str]) -> List[Dict]:
+    """
+    Benchmark sentence readers.
+    :param files: Subtitles documents (uncompressed XML).
+    :param readers: Names of the readers to benchmark.
+    :return: A list with the results of every reader.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    res = []
+    for reader in readers:
+        queue = ctx.Queue()
+        p = ctx.Process(target=_run_reader, args=(reader, files, queue))
+        p.start()
+        res.append(queue.get())
+        p.join()
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the OpenSubtitles sentence readers (docs/sec and peak "
+                                                 "RSS).")
+    parser.add_argument("subtitles_dir",
+                        type=str,
+                        help="Directory containing (uncompressed) subtitles XML documents, searched recursively.")
+    parser.add_argument("--readers",
+                        type=str,
+                        nargs="+",
+                        default=sorted(SENTENCE_READERS),
+                        help="Readers to benchmark.")
+    parser.add_argument("--max-docs",
+                        type=int,
+                        default=1000,
+                        help="Maximum number of documents to read.")
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(args.subtitles_dir, "**", "*.xml"), recursive=True))[:args.max_docs]
+    print(json.dumps(benchmark_sentence_readers(files, args.readers), indent=2))
@@ -0,0 +1,147 @@
+# Local mock of the Azure Translator v3 endpoint, for the benchmarks.
+#
+# It answers POST /translate?api-version=3.0&from=..&to=..[&to=..] requests with a fake translation of every text
+# into every destination language. Latency, throttling (429 with Retry-After) and transient errors (503) can be
+# injected.
+#
+# Usage (standalone):
+#    python benchmarks/mock_translator.py [--port 8080] [--latency 0.05] [--error-rate 0.01] [--throttle-rate 0.01]
+#
+# @author: jpquiroga@gmail.com
+
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from typing import Text, Dict
+
+
+class MockTranslatorServer(object):
+    """
+    Mock translation service running in a background thread.
+    """
+
+    def __init__(self, host: Text = "127.0.0.1", port: int = 0, latency: float = 0.0, latency_per_char: float = 0.0,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, retry_after: float = 0.1, seed: int = 0,
+                 record_requests: bool = False):
+        """
+        :param host:
+        :param port: 0 to use any free port.
+        :param latency: Base latency (seconds) of every successful request.
+        :param latency_per_char: Additional latency (seconds) per character of the request.
+        :param error_rate: Probability of answering 503 (Service Unavailable).
+        :param throttle_rate: Probability of answering 429 (Too Many Requests).
+        :param retry_after: Retry-After header (seconds) of the 429 responses.
+        :param seed:
+        :param record_requests: If True, the texts of every successful (billed) request are kept in
+        self.received_requests, in arrival order.
+        """
+        self.latency = latency
+        self.latency_per_char = latency_per_char
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "texts": 0, "chars": 0, "errors": 0, "throttled": 0}
+        self.record_requests = record_requests
+        self.received_requests = []
+        self._server = ThreadingHTTPServer((host, port), self._get_handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> Text:
+        return "http://{}:{}".format(*self._server.server_address[:2])
+
+    def _get_handler_class(self):
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes = b"", headers: Dict[Text, Text] = None):
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client is gone (e.g. a killed job)
+                    pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                languages = parse_qs(urlparse(self.path).query).get("to", ["es"])
+                with server._lock:
+                    server.stats["requests"] += 1
+                    _r = server._random.random()
+                if _r < server.throttle_rate:
+                    with server._lock:
+                        server.stats["throttled"] += 1
+                    self._send(429, headers={"Retry-After": str(server.retry_after)})
+                    return
+                if _r < server.throttle_rate + server.error_rate:
+                    with server._lock:
+                        server.stats["errors"] += 1
+                    self._send(503)
+                    return
+                _num_chars = sum(len(e["text"]) for e in body)
+                time.sleep(server.latency + server.latency_per_char * _num_chars)
+                with server._lock:
+                    server.stats["texts"] += len(body)
+                    server.stats["chars"] += _num_chars
+                    if server.record_requests:
+                        server.received_requests.append([e["text"] for e in body])
+                res = [{"translations": [{"text": "[{}] {}".format(l, e["text"]), "to": l} for l in languages]}
+                       for e in body]
+                self._send(200, json.dumps(res).encode("utf-8"))
+
+        return _Handler
+
+    def start(self) -> "MockTranslatorServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local mock of the Azure Translator service.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.05, help="Base latency (seconds) of every request.")
+    parser.add_argument("--latency-per-char", type=float, default=0.0,
+                        help="Additional latency (seconds) per character.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a 503 response.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probability of a 429 response.")
+    args = parser.parse_args()
+
+    server = MockTranslatorServer(port=args.port, latency=args.latency, latency_per_char=args.latency_per_char,
+                                  error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+    print("Mock translator listening at {}".format(server.url))
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
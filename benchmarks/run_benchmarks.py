@@ -0,0 +1,310 @@
+# Offline benchmark suite of the preprocessing and translation pipelines.
+#
+# Synthetic corpora are generated at the requested scale, and every pipeline is run in a fresh process (so peak RSS
+# figures are not polluted by other benchmarks). Translation pipelines run against a local mock of the Azure
+# Translator service (see mock_translator.py), with injectable latency and error rates. Results (throughput,
+# p50/p99 latency and peak memory) are written to a JSON file that can be compared across commits.
+#
+# Usage:
+#    python benchmarks/run_benchmarks.py [--scale small|medium|large] [--output results.json]
+#        [--benchmarks split_line cornell_load ...] [--latency 0.02] [--error-rate 0.01] [--throttle-rate 0.01]
+#        [--batch-size 100] [--workers 4]
+#
+# @author: jpquiroga@gmail.com
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+from queue import Empty
+from typing import Text, Dict, Any, List, Optional
+
+_BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_BENCHMARKS_DIR, "..", "src"))
+sys.path.insert(0, _BENCHMARKS_DIR)
+
+from datasets_preprocess import split_line
+from datasets_preprocess.metrics import Metrics, exponential_buckets
+from synthetic import write_cornell_corpus, write_personachat_dataset, write_opensubtitles_corpus
+from mock_translator import MockTranslatorServer
+
+
+# Size of the synthetic corpora (Cornell movies, Persona-Chat dialogues, OpenSubtitles document pairs)
+SCALES = {
+    "small": {"cornell_movies": 20, "personachat_dialogues": 500, "opensubtitles_documents": 20},
+    "medium": {"cornell_movies": 200, "personachat_dialogues": 5000, "opensubtitles_documents": 200},
+    "large": {"cornell_movies": 2000, "personachat_dialogues": 50000, "opensubtitles_documents": 2000}
+}
+
+# Histogram buckets precise enough (10%) for latency quantiles
+_LATENCY_BUCKETS = exponential_buckets(1e-5, 1.1, 200)
+
+
+def _no_progress(x, **kwargs):
+    return x
+
+
+def _latency(metrics: Metrics, name: Text) -> Dict[Text, Optional[float]]:
+    _histogram = metrics.get_histogram(name)
+    if _histogram is None:
+        return {"latency_metric": name, "p50": None, "p99": None}
+    return {"latency_metric": name, "p50": _histogram.quantile(0.5), "p99": _histogram.quantile(0.99)}
+
+
+def _get_translator(config: Dict[Text, Any], metrics: Metrics):
+    from datasets_preprocess.azure_translator import AzureTranslator
+    return AzureTranslator("benchmark", base_url=config["translator_url"], metrics=metrics,
+                           requests_per_second=config["requests_per_second"], backoff_factor=0.05)
+
+
+def bench_split_line(config: Dict[Text, Any]) -> Dict[Text, Any]:
+    count = 0
+    with open(os.path.join(config["cornell_dir"], "movie_lines.txt")) as f:
+        for l in f:
+            split_line(l, "+++$+++")
+            count += 1
+    return {"items": count, "unit": "lines"}
+
+
+def bench_cornell_load(config: Dict[Text, Any]) -> Dict[Text, Any]:
+    from datasets_preprocess.cornell_movies import load_cornell_file, build_conversation_index
+    df_lines = load_cornell_file(os.path.join(config["cornell_dir"], "movie_lines.txt"), tqdm_call=_no_progress)
+    df_conversations = load_cornell_file(os.path.join(config["cornell_dir"], "movie_conversations.txt"),
+                                         tqdm_call=_no_progress)
+    build_conversation_index(df_lines, df_conversations)
+    return {"items": len(df_lines), "unit": "lines"}
+
+
+def bench_translate_with_dict(config: Dict[Text, Any]) -> Dict[Text, Any]:
+    from datasets_preprocess.cornell_movies import load_cornell_file
+    df_lines = load_cornell_file(os.path.join(config["cornell_dir"], "movie_lines.txt"), tqdm_call=_no_progress)
+    texts = [str(t) for t in df_lines["UTTERANCE"]]
+    metrics = Metrics(buckets=_LATENCY_BUCKETS)
+    translator = _get_translator(config, metrics)
+    translator.translate_with_dict(texts, {}, num_texts_per_request=config["batch_size"], tqdm_call=_no_progress,
+                                   log_file=os.path.join(config["work_dir"], "translation_log"),
+                                   num_workers=config["workers"])
+    res = {"items": len(texts), "unit": "texts", "requests": metrics.get("translation_requests_total"),
+           "chars": metrics.get("translation_chars_total")}
+    res.update(_latency(metrics, "translation_request_seconds"))
+    return res
+
+
+def bench_personachat_translate(config: Dict[Text, Any]) -> Dict[Text, Any]:
+    from datasets_preprocess.personachat import translate_dataset
+    metrics = Metrics(buckets=_LATENCY_BUCKETS)
+    translator = _get_translator(config, metrics)
+    translate_dataset(config["personachat_file"], os.path.join(config["work_dir"], "personachat_translated.json"),
+                      translator, streaming=True, tqdm_call=_no_progress, batch_size=config["batch_size"])
+    res = {"items": config["corpora"]["personachat"]["turns"], "unit": "turns",
+           "requests": metrics.get("translation_requests_total"), "chars": metrics.get("translation_chars_total")}
+    res.update(_latency(metrics, "translation_request_seconds"))
+    return res
+
+
+def bench_personachat_pipeline(config: Dict[Text, Any]) -> Dict[Text, Any]:
+    from datasets_preprocess.pipeline import TranslationPipeline, PersonaChatDataset
+    metrics = Metrics(buckets=_LATENCY_BUCKETS)
+    translator = _get_translator(config, metrics)
+    dataset = PersonaChatDataset(config["personachat_file"],
+                                 os.path.join(config["work_dir"], "personachat_pipeline.json"))
+    stages = TranslationPipeline(dataset, translator, batch_size=config["batch_size"],
+                                 num_translation_threads=max(1, config["workers"]), metrics=metrics,
+                                 tqdm_call=_no_progress).run()
+    res = {"items": config["corpora"]["personachat"]["turns"], "unit": "turns",
+           "requests": metrics.get("translation_requests_total"), "chars": metrics.get("translation_chars_total"),
+           "stage_seconds": stages}
+    res.update(_latency(metrics, "translation_request_seconds"))
+    return res
+
+
+def bench_opensubtitles_extract(config: Dict[Text, Any]) -> Dict[Text, Any]:
+    import xml.sax
+    from datasets_preprocess.opensubtitles import OpensubtitlesAlignementHandler
+    metrics = Metrics(buckets=_LATENCY_BUCKETS)
+    alignment_file = os.path.join(config["opensubtitles_dir"], "alignment.xml")
+    handler = OpensubtitlesAlignementHandler(alignment_file, config["opensubtitles_dir"],
+                                             os.path.join(config["work_dir"], "opensubtitles_en"),
+                                             os.path.join(config["work_dir"], "opensubtitles_es"), metrics=metrics)
+    xml.sax.parse(alignment_file, handler)
+    handler.close()
+    res = {"items": metrics.get("opensubtitles_link_groups_total"), "unit": "link_groups",
+           "texts": metrics.get("opensubtitles_aligned_texts_total")}
+    res.update(_latency(metrics, "opensubtitles_link_group_seconds"))
+    return res
+
+
+def bench_opensubtitles_extract_workers(config: Dict[Text, Any]) -> Dict[Text, Any]:
+    from datasets_preprocess.opensubtitles import extract_aligned_texts
+    metrics = Metrics(buckets=_LATENCY_BUCKETS)
+    extract_aligned_texts(os.path.join(config["opensubtitles_dir"], "alignment.xml"), config["opensubtitles_dir"],
+                          os.path.join(config["work_dir"], "opensubtitles_workers_en"),
+                          os.path.join(config["work_dir"], "opensubtitles_workers_es"),
+                          num_workers=max(1, config["workers"]), metrics=metrics)
+    return {"items": metrics.get("opensubtitles_link_groups_total"), "unit": "link_groups",
+            "texts": metrics.get("opensubtitles_aligned_texts_total")}
+
+
+BENCHMARKS = {
+    "split_line": bench_split_line,
+    "cornell_load": bench_cornell_load,
+    "translate_with_dict": bench_translate_with_dict,
+    "personachat_translate": bench_personachat_translate,
+    "personachat_pipeline": bench_personachat_pipeline,
+    "opensubtitles_extract": bench_opensubtitles_extract,
+    "opensubtitles_extract_workers": bench_opensubtitles_extract_workers
+}
+
+
+def _run_benchmark(name: Text, config: Dict[Text, Any], queue: multiprocessing.Queue):
+    # Progress output of the pipelines is discarded
+    sys.stdout = open(os.devnull, "w")
+    sys.stderr = open(os.devnull, "w")
+    os.chdir(config["work_dir"])
+    start_time = time.perf_counter()
+    res = BENCHMARKS[name](config)
+    elapsed_time = time.perf_counter() - start_time
+    res.update({
+        "benchmark": name,
+        "seconds": elapsed_time,
+        "throughput": res["items"] / elapsed_time if elapsed_time > 0 else None,
+        # Linux reports ru_maxrss in kilobytes (worker processes are included)
+        "peak_rss_mb": max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                           resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    })
+    queue.put(res)
+
+
+def run_benchmarks(names: List[Text], config: Dict[Text, Any]) -> List[Dict[Text, Any]]:
+    """
+    Run benchmarks, every one in a fresh process.
+    :param names: Names of the benchmarks (see BENCHMARKS).
+    :param config: Benchmark configuration (corpora locations, translator url, batch size, number of workers...).
+    :return: A list with the results of every benchmark.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    res = []
+    for name in names:
+        queue = ctx.Queue()
+        p = ctx.Process(target=_run_benchmark, args=(name, config, queue))
+        p.start()
+        # The result is read before joining the process: a process putting a large object in a queue does not exit
+        # until the object is read
+        result = None
+        while result is None and p.is_alive():
+            try:
+                result = queue.get(timeout=1)
+            except Empty:
+                pass
+        if result is None:
+            # The process may have exited right after putting its result
+            try:
+                result = queue.get(timeout=1)
+            except Empty:
+                pass
+        p.join()
+        if result is None:
+            res.append({"benchmark": name, "error": "exit code {}".format(p.exitcode)})
+        else:
+            res.append(result)
+        print(json.dumps(res[-1]))
+    return res
+
+
+def _get_commit() -> Optional[Text]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=_BENCHMARKS_DIR,
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the offline benchmarks on synthetic corpora, against a local "
+                                                 "mock translation service.")
+    parser.add_argument("--scale", type=str, default="small", choices=sorted(SCALES), help="Size of the corpora.")
+    parser.add_argument("--benchmarks", type=str, nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS),
+                        help="Benchmarks to run.")
+    parser.add_argument("--output", type=str, default="benchmark_results.json",
+                        help="File where the results are written (JSON).")
+    parser.add_argument("--data-dir", type=str, default=None,
+                        help="Directory for the synthetic corpora (reused if it already has them). A temporary "
+                             "directory by default.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Base latency (seconds) of the mock translation service.")
+    parser.add_argument("--latency-per-char", type=float, default=0.0,
+                        help="Additional latency (seconds) per character of the mock translation service.")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Probability of a 503 response of the mock translation service.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Probability of a 429 response of the mock translation service.")
+    parser.add_argument("--requests-per-second", type=float, default=1000.0,
+                        help="Request rate limit of the translator.")
+    parser.add_argument("--batch-size", type=int, default=100, help="Number of texts per translation request.")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Concurrent translation requests, and worker processes of the parallel extraction.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir if args.data_dir is not None else os.path.join(tmp_dir, "data")
+        scale = SCALES[args.scale]
+        cornell_dir = os.path.join(data_dir, "cornell")
+        personachat_file = os.path.join(data_dir, "personachat.json")
+        opensubtitles_dir = os.path.join(data_dir, "opensubtitles")
+        _corpora_file = os.path.join(data_dir, "corpora_{}_{}.json".format(args.scale, args.seed))
+        if os.path.exists(_corpora_file):
+            with open(_corpora_file) as f:
+                corpora = json.load(f)
+        else:
+            print("Generating {} synthetic corpora in {}...".format(args.scale, data_dir))
+            corpora = {
+                "cornell": write_cornell_corpus(cornell_dir, num_movies=scale["cornell_movies"], seed=args.seed),
+                "personachat": write_personachat_dataset(personachat_file,
+                                                         num_dialogues=scale["personachat_dialogues"],
+                                                         seed=args.seed),
+                "opensubtitles": write_opensubtitles_corpus(opensubtitles_dir,
+                                                            num_documents=scale["opensubtitles_documents"],
+                                                            seed=args.seed)
+            }
+            with open(_corpora_file, "w") as f:
+                json.dump(corpora, f)
+        work_dir = os.path.join(tmp_dir, "work")
+        os.makedirs(work_dir)
+
+        with MockTranslatorServer(latency=args.latency, latency_per_char=args.latency_per_char,
+                                  error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                                  seed=args.seed) as server:
+            config = {
+                "cornell_dir": cornell_dir,
+                "personachat_file": personachat_file,
+                "opensubtitles_dir": opensubtitles_dir,
+                "work_dir": work_dir,
+                "corpora": corpora,
+                "translator_url": server.url,
+                "requests_per_second": args.requests_per_second,
+                "batch_size": args.batch_size,
+                "workers": args.workers
+            }
+            results = run_benchmarks(args.benchmarks, config)
+            server_stats = dict(server.stats)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "commit": _get_commit(),
+            "created": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": vars(args),
+            "corpora": corpora,
+            "mock_translator": server_stats,
+            "results": results
+        }, f, indent=2)
+    print("Results written to {}".format(args.output))
@@ -0,0 +1,167 @@
+# Synthetic corpora for the benchmarks.
+#
+# Corpora are generated deterministically (for a given seed and scale) in the format of the original datasets:
+# Cornell movie dialogues (+++$+++ separated files), Persona-Chat (json) and OpenSubtitles (XCES alignment file and
+# subtitles XML documents). Texts are drawn from a small vocabulary with a Zipf-like distribution, and some of them
+# are repeated, so deduplication and caching behave as they do with real data.
+#
+# @author: jpquiroga@gmail.com
+
+import os
+import json
+import random
+from typing import Text, List, Dict
+
+
+_WORDS = ("i you he she we they it the a an and or but not no yes what why how where when who is are was were "
+          "do did have had will would can could should go going come get know think want like love hate see look "
+          "tell say said talk here there now then never always just really right okay well oh hey sorry please "
+          "thanks man girl father mother money time night day house car gun dead life home back out up down "
+          "sure good bad little big old new nothing something everything anything").split()
+
+_DELIM = " +++$+++ "
+
+
+class TextGenerator(object):
+    """
+    Random utterances, with a fraction of them repeated.
+    """
+
+    def __init__(self, seed: int = 0, repeat_rate: float = 0.2, max_words: int = 20):
+        """
+        :param seed:
+        :param repeat_rate: Probability that an utterance repeats a previous one.
+        :param max_words: Maximum number of words per utterance.
+        """
+        self._random = random.Random(seed)
+        self.repeat_rate = repeat_rate
+        self.max_words = max_words
+        self._weights = [1.0 / (i + 1) for i in range(len(_WORDS))]
+        self._history = []
+
+    def utterance(self) -> Text:
+        if len(self._history) > 0 and self._random.random() < self.repeat_rate:
+            return self._random.choice(self._history)
+        _num_words = self._random.randint(1, self.max_words)
+        _words = self._random.choices(_WORDS, weights=self._weights, k=_num_words)
+        res = " ".join(_words).capitalize() + self._random.choice((".", ".", "?", "!", "..."))
+        if len(self._history) < 10000:
+            self._history.append(res)
+        return res
+
+    def randint(self, a: int, b: int) -> int:
+        return self._random.randint(a, b)
+
+
+def write_cornell_corpus(out_dir: Text, num_movies: int = 100, conversations_per_movie: int = 50,
+                         seed: int = 0) -> Dict[Text, int]:
+    """
+    Write movie_lines.txt and movie_conversations.txt files.
+    :param out_dir:
+    :param num_movies:
+    :param conversations_per_movie:
+    :param seed:
+    :return: Number of lines and conversations written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    gen = TextGenerator(seed)
+    line_id = 1
+    num_conversations = 0
+    with open(os.path.join(out_dir, "movie_lines.txt"), "w") as f_lines, \
+            open(os.path.join(out_dir, "movie_conversations.txt"), "w") as f_conversations:
+        for m in range(num_movies):
+            characters = [(m * 10 + c, "CHARACTER{}".format(c)) for c in range(gen.randint(2, 10))]
+            for _ in range(conversations_per_movie):
+                _speakers = (characters[gen.randint(0, len(characters) - 1)],
+                             characters[gen.randint(0, len(characters) - 1)])
+                _line_ids = []
+                for t in range(gen.randint(2, 8)):
+                    _character_id, _character_name = _speakers[t % 2]
+                    f_lines.write(_DELIM.join(("L{}".format(line_id), "u{}".format(_character_id), "m{}".format(m),
+                                               _character_name, gen.utterance())) + "\n")
+                    _line_ids.append("'L{}'".format(line_id))
+                    line_id += 1
+                f_conversations.write(_DELIM.join(("u{}".format(_speakers[0][0]), "u{}".format(_speakers[1][0]),
+                                                   "m{}".format(m), "[{}]".format(", ".join(_line_ids)))) + "\n")
+                num_conversations += 1
+    return {"lines": line_id - 1, "conversations": num_conversations}
+
+
+def write_personachat_dataset(dataset_file: Text, num_dialogues: int = 1000, seed: int = 0) -> Dict[Text, int]:
+    """
+    Write a dataset in the Persona-Chat format.
+    :param dataset_file:
+    :param num_dialogues:
+    :param seed:
+    :return: Number of dialogues and turns written.
+    """
+    gen = TextGenerator(seed)
+    num_turns = 0
+    dialogues = []
+    for d in range(num_dialogues):
+        _dialog = []
+        for t in range(gen.randint(1, 16)):
+            _dialog.append({"id": t, "sender": "participant{}".format(t % 2 + 1), "text": gen.utterance(),
+                            "evaluation_score": None, "sender_class": "Human" if t % 2 == 0 else "Bot"})
+        num_turns += len(_dialog)
+        dialogues.append({
+            "dialog": _dialog,
+            "start_time": "2018-07-09 04:29:15",
+            "end_time": "2018-07-09 04:39:15",
+            "bot_profile": [gen.utterance() for _ in range(4)],
+            "user_profile": [gen.utterance() for _ in range(4)],
+            "eval_score": gen.randint(1, 5),
+            "profile_match": 1,
+            "participant1_id": {"class": "User", "user_id": "User {:05d}".format(d)},
+            "participant2_id": {"class": "Bot", "user_id": "Bot {:05d}".format(d)}
+        })
+    with open(dataset_file, "w") as f:
+        json.dump(dialogues, f)
+    return {"dialogues": num_dialogues, "turns": num_turns}
+
+
+def _write_subtitles_document(subtitles_file: Text, sentences: List[Text]):
+    os.makedirs(os.path.dirname(subtitles_file), exist_ok=True)
+    with open(subtitles_file, "w") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<document id="{}">\n'.format(
+            os.path.basename(subtitles_file)))
+        for i, s in enumerate(sentences):
+            f.write('  <s id="{0}">\n    <time id="T{0}S" value="00:00:01,000" />\n    {1}\n'
+                    '    <time id="T{0}E" value="00:00:02,000" />\n  </s>\n'.format(i + 1, s))
+        f.write("</document>\n")
+
+
+def write_opensubtitles_corpus(out_dir: Text, num_documents: int = 100, origin_language: Text = "en",
+                               destination_language: Text = "es", seed: int = 0) -> Dict[Text, int]:
+    """
+    Write an alignment file (<out_dir>/alignment.xml) and the subtitles documents it links.
+    :param out_dir: Base dir of the subtitles documents.
+    :param num_documents: Number of document pairs (link groups).
+    :param origin_language:
+    :param destination_language:
+    :param seed:
+    :return: Number of link groups and links written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    gen = TextGenerator(seed)
+    num_links = 0
+    with open(os.path.join(out_dir, "alignment.xml"), "w") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<!DOCTYPE cesAlign PUBLIC "-//CES//DTD XML cesAlign//EN" "">\n<cesAlign version="1.0">\n')
+        for d in range(num_documents):
+            _num_sentences = gen.randint(20, 200)
+            _docs = []
+            for l in (origin_language, destination_language):
+                _doc = "{}/{}/{}/{}.xml".format(l, 2000 + d % 20, d, d)
+                _write_subtitles_document(os.path.join(out_dir, _doc),
+                                          [gen.utterance().replace("&", "&amp;") for _ in range(_num_sentences)])
+                _docs.append(_doc)
+            f.write('<linkGrp targType="s" fromDoc="{}" toDoc="{}" >\n'.format(*_docs))
+            for i in range(1, _num_sentences + 1):
+                # Some sentences are not aligned, as in the real corpus
+                _xtargets = "{};".format(i) if i % 11 == 0 else "{0};{0}".format(i)
+                f.write('<link id="SL{}" xtargets="{}" />\n'.format(i, _xtargets))
+            f.write("</linkGrp>\n")
+            num_links += _num_sentences
+        f.write("</cesAlign>\n")
+    return {"link_groups": num_documents, "links": num_links}
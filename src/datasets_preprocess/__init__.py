@@ -14,14 +14,10 @@ def split_line(s_line: Text, delim: Text) -> List[Text]:
 
     :return: List of texts
     """
-    res = []
-    _buff = s_line
-    while delim in _buff:
-        _index = _buff.index(delim)
-        res.append(_buff[:_index].strip())
-        _buff = _buff[_index+len(delim):].strip()
-    res.append(_buff)
-    return res
+    res = s_line.split(delim)
+    if len(res) == 1:
+        return res
+    return [t.strip() for t in res]
 
 
 def build_text_translation_dict(log_file: Text, tqdm_call: Optional[Callable] = tqdm) -> Dict[Text, Text]:
@@ -32,10 +28,12 @@ def build_text_translation_dict(log_file: Text, tqdm_call: Optional[Callable] =
     :param log_file:
     :param tqdm_call:
     :return: The dictionary with the translations
+
+    See also translation_store.TranslationStore, a persistent alternative that does not need to load the whole log.
     """
     res = {}
     with open(log_file) as f:
-        for l in tqdm_call(f.readlines()):
+        for l in tqdm_call(f):
             toks = l.split("$___$___$")
             if len(toks) == 2:
                 res[toks[0].strip()] = toks[1].strip()
@@ -6,8 +6,20 @@
 
 # -*- coding: utf-8 -*-
 import os, requests, uuid, json
+import threading
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
-from typing import Text, List, Optional, Tuple, Any, Dict, Callable
+from typing import Text, List, Optional, Tuple, Any, Dict, Callable, Iterator, Union
+from .batching import plan_batches, MAX_CHARS_PER_REQUEST, MAX_ELEMENTS_PER_REQUEST
+from .translate import Translator
+from .journal import TranslationJournal
+from .canonical import CanonicalForms
+from .translation_store import TranslationStore
+from .metrics import Metrics
+from . import count_chars
 
 
 # class AzureTranslator(object):
@@ -49,36 +61,112 @@ from typing import Text, List, Optional, Tuple, Any, Dict, Callable
 #         return res, response
 
 
-class AzureTranslator(object):
+class AzureTranslator(Translator):
     """
     Wrapper for the Azure Translator API.
     See https://docs.microsoft.com/en-us/azure/cognitive-services/translator/quickstart-python-translate
     """
 
     _SEPARATOR = "$___$___$"
+    # Status codes considered transient (the request is retried with backoff)
+    _RETRY_STATUS_CODES = (500, 502, 503, 504)
 
-    def __init__(self, subscription_key: Text, origin_language: Text = "en", destination_language: Text = "es"):
+    def __init__(self, subscription_key: Text, origin_language: Text = "en",
+                 destination_language: Union[Text, List[Text]] = "es",
+                 base_url: Text = 'https://api.cognitive.microsofttranslator.com', pool_size: int = 10,
+                 requests_per_second: float = 10.0, max_retries: int = 5, backoff_factor: float = 0.5,
+                 timeout: float = 60.0, metrics: Optional[Metrics] = None):
+        """
+        :param subscription_key: Azure Translator subscription key.
+        :param origin_language:
+        :param destination_language: Destination language, or list of destination languages (every text is then
+        translated into all of them with a single request).
+        :param base_url: Base url of the service (it can point to a local stub server for testing).
+        :param pool_size: Maximum number of keep-alive connections kept in the session pool.
+        :param requests_per_second: Initial request rate. It is adapted on 429 (Too Many Requests) responses.
+        :param max_retries: Maximum number of retries for throttled (429) or transient (5xx) responses.
+        :param backoff_factor: Base delay (seconds) of the exponential backoff between retries.
+        :param timeout: Timeout (seconds) of every request.
+        :param metrics: Metrics registry where request counts and latencies are recorded. A new one is created by
+        default.
+        """
 
         # If you want to set your subscription key as a string, uncomment the line
         # below and add your subscription key.
         # subscriptionKey = 'put_your_key_here'
 
         self.origin_language = origin_language
-        self.destination_language = destination_language
-        self.base_url = 'https://api.cognitive.microsofttranslator.com'
+        if isinstance(destination_language, str):
+            destination_language = [destination_language]
+        self.destination_languages = list(destination_language)
+        # Main destination language
+        self.destination_language = self.destination_languages[0]
+        self.base_url = base_url
         self.path = '/translate?api-version=3.0'
-        self.params = '&from={}&to={}'.format(origin_language, destination_language)
+        self.params = '&from={}'.format(origin_language) + \
+                      "".join('&to={}'.format(l) for l in self.destination_languages)
         self.constructed_url = self.base_url + self.path + self.params
         self.headers = {
             'Ocp-Apim-Subscription-Key': subscription_key,
             'Content-type': 'application/json',
             'X-ClientTraceId': str(uuid.uuid4())
         }
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        # Pooled keep-alive session, shared by all the requests (and threads)
+        self.session = requests.Session()
+        _adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", _adapter)
+        self.session.mount("http://", _adapter)
+        self.throttle = TokenBucket(rate=requests_per_second)
+        self._log_lock = threading.Lock()
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    def _post(self, body: List[Dict[Text, Text]]) -> Any:
+        """
+        Post a request to the service, throttling it and retrying throttled (429) and transient (5xx) errors.
+
+        :param body: Request body.
+        :return: The json response.
+        """
+        attempt = 0
+        while True:
+            self.throttle.acquire()
+            try:
+                with self.metrics.time("translation_http_request_seconds"):
+                    request = self.session.post(self.constructed_url, headers=self.headers, json=body,
+                                                timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self.metrics.inc("translation_http_errors_total")
+                if attempt >= self.max_retries:
+                    raise
+                self.metrics.inc("translation_retries_total", reason="connection")
+                time.sleep(self.backoff_factor * 2 ** attempt)
+                attempt += 1
+                continue
+            self.metrics.inc("translation_http_responses_total", status=request.status_code)
+            if request.status_code == 200:
+                self.throttle.reward()
+                return request.json()
+            if attempt < self.max_retries:
+                if request.status_code == 429:
+                    self.metrics.inc("translation_retries_total", reason="throttled")
+                    self.throttle.penalize(_get_retry_after(request, self.backoff_factor * 2 ** attempt))
+                    attempt += 1
+                    continue
+                if request.status_code in AzureTranslator._RETRY_STATUS_CODES:
+                    self.metrics.inc("translation_retries_total", reason="server_error")
+                    time.sleep(self.backoff_factor * 2 ** attempt)
+                    attempt += 1
+                    continue
+            raise TranslationExample(status_code=request.status_code, reason=request.reason,
+                                     content=request.content)
 
     def translate_text_azure(self, texts: List[Text], log_file: Text = "./translation_log") -> \
             Tuple[List[Text], List[Text]]:
         """
-        Translate a list of texts to one language.
+        Translate a list of texts to one language (the main destination language).
 
         :param texts:
         :param log_file: File to store (append) logging data. This logging file can be used to recover translation
@@ -107,61 +195,275 @@ class AzureTranslator(object):
 
         :return: List of translation and list of raw responses (as a tuple).
         """
+        res, response = self.translate_text_azure_multi(texts, log_file=log_file)
+        return res[self.destination_language], response
+
+    def translate_text_azure_multi(self, texts: List[Text], log_file: Text = "./translation_log") -> \
+            Tuple[Dict[Text, List[Text]], List[Text]]:
+        """
+        Translate a list of texts to all the destination languages, with a single request.
+
+        :param texts:
+        :param log_file: File to store (append) logging data (see translate_text_azure). Translations to languages
+        other than the main destination language are appended to <log_file>_<language>
+        :return: Dictionary with the list of translations to every destination language and list of raw responses
+        (as a tuple).
+        """
         #     body = [{
         #         'text' : text
         #     }]
         body = [{"text": t} for t in texts]
-        request = requests.post(self.constructed_url, headers=self.headers, json=body)
-        if request.status_code != 200:
-            raise TranslationExample(status_code=request.status_code, reason=request.reason,
-                                     content=request.content)
-        response = request.json()
+        # The latency includes throttling and retries
+        with self.metrics.time("translation_request_seconds"):
+            response = self._post(body)
+        self.metrics.inc("translation_requests_total")
+        self.metrics.inc("translation_texts_total", len(texts))
+        self.metrics.inc("translation_chars_total", count_chars(texts) * len(self.destination_languages))
         # Extract results
-        res = []
+        res = {l: [] for l in self.destination_languages}
         if log_file is not None:
-            with open(log_file + "_raw", "a") as f:
+            with self._log_lock, open(log_file + "_raw", "a") as f:
                 for i, r in enumerate(response):
                     f.write("{} {} {}\n".format(texts[i], AzureTranslator._SEPARATOR, r))
-        for r in response:
-            # Take the first translation
-            res.append(r["translations"][0]["text"])
+        if len(response) != len(texts):
+            raise ValueError("Expected {} translated texts, but the response has {}".format(len(texts),
+                                                                                          len(response)))
+        for i, r in enumerate(response):
+            # Translations come in the order of the destination languages of the request (the returned language
+            # codes may differ from the requested ones, e.g. in case)
+            if len(r["translations"]) != len(self.destination_languages):
+                raise ValueError("Expected {} translations of text {}, but the response has {}: {}".format(
+                    len(self.destination_languages), i, len(r["translations"]), r))
+            for l, t in zip(self.destination_languages, r["translations"]):
+                res[l].append(t["text"])
         if log_file is not None:
-            with open(log_file, "a") as f:
-                for i, r in enumerate(res):
-                    f.write("{} {} {}\n".format(texts[i], AzureTranslator._SEPARATOR, r))
-            with open(log_file + "_raw", "a") as f:
-                for i, r in enumerate(response):
-                    f.write("{} {} {}\n".format(texts[i], AzureTranslator._SEPARATOR, r))
+            self._log_translations(texts, res, log_file)
 
         return res, response
 
-    def translate_with_dict(self, texts: List[Text], translation_dict: Dict[Text, Text], num_texts_per_request=20,
-                            tqdm_call: Optional[Callable] = tqdm, log_file: Text = "./translation_log") -> Dict[Text,Text]:
+    def _log_translations(self, texts: List[Text], translations: Dict[Text, List[Text]], log_file: Text):
+        # Append translations to the log file of every destination language
+        for l in self.destination_languages:
+            _log_file = log_file if l == self.destination_language else "{}_{}".format(log_file, l)
+            with self._log_lock, open(_log_file, "a") as f:
+                for i, r in enumerate(translations[l]):
+                    f.write("{} {} {}\n".format(texts[i], AzureTranslator._SEPARATOR, r))
+
+    def translate(self, text: Text, **kwargs) -> Text:
+        """
+        Translate a text.
+        :param text: Text to translate
+        :param kwargs: See translate_batch.
+        :return: Translated text.
+        """
+        return self.translate_batch([text], **kwargs)[0]
+
+    def translate_batch(self, texts: List[Text], translation_dict: Optional[Dict[Text, Any]] = None,
+                        log_file: Text = "./translation_log", num_workers: int = 1, canonicalize: bool = False,
+                        collapse_repeats: bool = True, **kwargs) -> List[Text]:
+        """
+        Translate several texts with as few requests as possible (see translate_with_dict).
+        :param texts: Texts to translate
+        :param translation_dict: Translation dictionary used as cache (one per destination language if there are
+        several). Texts found in it are not sent.
+        :param log_file:
+        :param num_workers: Number of requests kept in flight concurrently.
+        :param canonicalize: If True, near-duplicate texts are translated once (see translate_with_dict).
+        :param collapse_repeats: See translate_with_dict.
+        :param kwargs:
+        :return: Translated texts to the main destination language, in the same order.
+        """
+        if translation_dict is None:
+            translation_dict = {l: {} for l in self.destination_languages} \
+                if len(self.destination_languages) > 1 else {}
+        self.translate_with_dict(texts, translation_dict, tqdm_call=lambda x, **kw: x, log_file=log_file,
+                                 num_workers=num_workers, canonicalize=canonicalize, collapse_repeats=collapse_repeats)
+        if len(self.destination_languages) > 1:
+            translation_dict = translation_dict[self.destination_language]
+        return [translation_dict[t.strip()] for t in texts]
+
+    def translate_with_dict(self, texts: List[Text], translation_dict: Dict[Text, Any],
+                            num_texts_per_request: int = MAX_ELEMENTS_PER_REQUEST,
+                            tqdm_call: Optional[Callable] = tqdm, log_file: Text = "./translation_log",
+                            num_workers: int = 1,
+                            max_chars_per_request: int = MAX_CHARS_PER_REQUEST,
+                            journal_file: Optional[Text] = None, canonicalize: bool = False,
+                            collapse_repeats: bool = True) -> Dict[Text,Text]:
         """
 
         :param texts: List of texts to translate
-        :param translation_dict: Translation dictionary
-        :param num_texts_per_request:
+        :param translation_dict: Translation dictionary. It can be a persistent TranslationStore (translations are
+        inserted in one transaction per batch). If there are several destination languages, a dictionary with the
+        translation dictionary of every language: texts missing from any of them are translated into all the
+        languages with a single request.
+        :param num_texts_per_request: Maximum number of texts per request.
         :param tqdm_call:
         :param log_file:
+        :param num_workers: Number of requests kept in flight concurrently over the pooled session. Translations are
+        added to translation_dict in batch order, whatever the order in which requests complete.
+        :param max_chars_per_request: Maximum number of characters per request. Longer texts are split.
+        :param journal_file: If given, the job is resumable: committed batches are recorded in this journal file,
+        and they are skipped when the same job (same texts, languages and request limits) is run again.
+        translation_dict must then be persistent (e.g. a TranslationStore, or a dictionary rebuilt from the
+        translation log), since skipped batches are expected to be in it. Texts of uncommitted batches already in
+        translation_dict are not sent again.
+        :param canonicalize: If True, texts differing only in case, whitespace, terminal punctuation or repeated
+        letters are mapped to a canonical key (see canonical.CanonicalForms), and only the keys are translated. Keys
+        are translated into temporary dictionaries: only the translations of the texts themselves are added to
+        translation_dict and logged. It cannot be used with journal_file (texts already in translation_dict are
+        not sent again, though).
+        :param collapse_repeats: If canonicalize is True, whether runs of repeated letters ("Nooo") are collapsed in
+        the canonical keys.
         :return:
         """
-        _buffer = []
-        for i, t in tqdm_call(enumerate(texts), desc="Number of texts to translate", total=len(texts)):
-            _t = t.strip()
-            if _t not in translation_dict:
-                _buffer.append(_t)
-            if len(_buffer) >= num_texts_per_request or i >= len(texts)-1:
-                r1, r2 = self.translate_text_azure(_buffer, log_file=log_file)
-                for j, trans_t in enumerate(r1):
-                    translation_dict[_buffer[j]] = trans_t
-                _buffer = []
-        # if len(_buffer) > 0:
-        #     r1, r2 = self.translate_text_azure(_buffer, log_file=log_file)
-        #     for j, trans_t in enumerate(r1):
-        #         translation_dict[_buffer[j]] = trans_t
+        _start = time.perf_counter()
+        # Translation dictionaries, in the order of the destination languages
+        if len(self.destination_languages) > 1:
+            _dicts = [translation_dict[l] for l in self.destination_languages]
+        else:
+            _dicts = [translation_dict]
+        if canonicalize:
+            if journal_file is not None:
+                raise ValueError("journal_file cannot be used with canonicalize")
+            _texts = [_t for _t in dict.fromkeys(t.strip() for t in texts) if any(_t not in d for d in _dicts)]
+            forms = CanonicalForms(_texts, collapse_repeats=collapse_repeats)
+            _stats = forms.stats()
+            self.metrics.inc("translation_canonical_texts_total", _stats["texts"])
+            self.metrics.inc("translation_canonical_keys_total", _stats["keys"])
+            self.metrics.inc("translation_canonical_chars_total", _stats["chars"])
+            self.metrics.inc("translation_canonical_key_chars_total", _stats["key_chars"])
+            # Keys are not real texts: they are translated into temporary dictionaries (keys that are texts of
+            # translation_dict are taken from it)
+            _key_dicts = [d.get_many(forms.keys) if isinstance(d, TranslationStore) else
+                          {k: d[k] for k in forms.keys if k in d} for d in _dicts]
+            self.translate_with_dict(forms.keys, dict(zip(self.destination_languages, _key_dicts))
+                                     if len(_dicts) > 1 else _key_dicts[0],
+                                     num_texts_per_request=num_texts_per_request, tqdm_call=tqdm_call, log_file=None,
+                                     num_workers=num_workers, max_chars_per_request=max_chars_per_request)
+            _translations = {l: forms.restore([d[k] for k in forms.keys], l)
+                             for l, d in zip(self.destination_languages, _key_dicts)}
+            for l, d in zip(self.destination_languages, _dicts):
+                d.update(zip(_texts, _translations[l]))
+            if log_file is not None and len(_texts) > 0:
+                self._log_translations(_texts, _translations, log_file)
+            self.metrics.observe("translate_with_dict_seconds", time.perf_counter() - _start)
+            return translation_dict
+        if journal_file is not None:
+            self._translate_with_journal(texts, _dicts, journal_file, num_texts_per_request=num_texts_per_request,
+                                         tqdm_call=tqdm_call, log_file=log_file, num_workers=num_workers,
+                                         max_chars_per_request=max_chars_per_request)
+            self.metrics.observe("translate_with_dict_seconds", time.perf_counter() - _start)
+            return translation_dict
+        _texts = list(dict.fromkeys(t.strip() for t in texts))
+        plan = plan_batches((_t for _t in _texts if any(_t not in d for d in _dicts)),
+                            max_chars=max_chars_per_request, max_elements=num_texts_per_request)
+        self.metrics.inc("translation_dict_hits_total", len(_texts) - len(plan.texts))
+        self.metrics.inc("translation_dict_misses_total", len(plan.texts))
+        _results = tqdm_call(self._translate_batches(plan.batches, log_file=log_file, num_workers=num_workers),
+                             desc="Number of batches to translate", total=len(plan))
+        for completed in plan.assemble(_results, join=_join_translations):
+            _update_dicts(_dicts, completed)
+        self.metrics.observe("translate_with_dict_seconds", time.perf_counter() - _start)
         return translation_dict
 
+    def _translate_with_journal(self, texts: List[Text], translation_dicts: List[Dict[Text, Text]],
+                                journal_file: Text, num_texts_per_request: int, tqdm_call: Optional[Callable],
+                                log_file: Text, num_workers: int, max_chars_per_request: int):
+        """
+        Resumable version of translate_with_dict (see its journal_file parameter).
+        """
+        # The plan covers all the texts, so it is the same for every run of the job
+        plan = plan_batches((t.strip() for t in texts), max_chars=max_chars_per_request,
+                            max_elements=num_texts_per_request)
+        fingerprint = hashlib.sha1("{} {} {}".format(self.origin_language, " ".join(self.destination_languages),
+                                                     plan.fingerprint()).encode("utf-8")).hexdigest()
+        batch_ids = [plan.get_batch_id(b) for b in range(len(plan))]
+        with TranslationJournal(journal_file, fingerprint) as journal:
+            skipped = [journal.is_committed(b, batch_ids[b]) for b in range(len(plan))]
+            # Only whole commit units are skipped (a torn write may have recorded part of one)
+            _changed = True
+            while _changed:
+                _changed = False
+                for b in range(len(plan)):
+                    if skipped[b] and ((b > 0 and not plan.ends_text(b - 1) and not skipped[b - 1]) or
+                                       (not plan.ends_text(b) and not skipped[b + 1])):
+                        skipped[b] = False
+                        _changed = True
+            # Pieces to send for every batch (whole texts already translated are not sent)
+            send_masks = []
+            for b in range(len(plan)):
+                if skipped[b]:
+                    send_masks.append(None)
+                    continue
+                send_masks.append([plan.num_pieces[i] > 1 or any(plan.texts[i] not in d for d in translation_dicts)
+                                   for i in plan.batch_text_ids[b]])
+            _requests = [[p for p, send in zip(plan.batches[b], send_masks[b]) if send]
+                         for b in range(len(plan)) if not skipped[b]]
+            _responses = self._translate_batches([r for r in _requests if len(r) > 0], log_file=log_file,
+                                                 num_workers=num_workers)
+
+            def _batch_translations():
+                for b in range(len(plan)):
+                    if skipped[b]:
+                        yield None
+                        continue
+                    _translations = iter(next(_responses) if any(send_masks[b]) else [])
+                    yield [next(_translations) if send else tuple(d[plan.texts[i]] for d in translation_dicts)
+                           for i, send in zip(plan.batch_text_ids[b], send_masks[b])]
+
+            _uncommitted = []
+            for b, completed in enumerate(tqdm_call(plan.assemble(_batch_translations(), join=_join_translations),
+                                                    desc="Number of batches to translate", total=len(plan))):
+                if skipped[b]:
+                    continue
+                _update_dicts(translation_dicts, completed)
+                _uncommitted.append(b)
+                # Batches are committed only when no text is split between them and the next one
+                if plan.ends_text(b):
+                    journal.commit(_uncommitted, [batch_ids[i] for i in _uncommitted])
+                    _uncommitted = []
+
+    def _translate_batches(self, batches: List[List[Text]], log_file: Text = "./translation_log",
+                           num_workers: int = 1) -> Iterator[List[Tuple[Text, ...]]]:
+        """
+        Translate several batches of texts.
+        :param batches:
+        :param log_file:
+        :param num_workers: Number of requests kept in flight concurrently.
+        :return: Iterator over the translations of every batch, in batch order. The translation of every text is a
+        tuple with its translation to every destination language.
+        """
+        if num_workers <= 1:
+            for _batch in batches:
+                r1, r2 = self.translate_text_azure_multi(_batch, log_file=log_file)
+                yield list(zip(*(r1[l] for l in self.destination_languages)))
+            return
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(self.translate_text_azure_multi, _batch, log_file=log_file)
+                       for _batch in batches]
+            try:
+                for future in futures:
+                    r1, r2 = future.result()
+                    yield list(zip(*(r1[l] for l in self.destination_languages)))
+            finally:
+                # Do not send the pending requests if the iteration is stopped
+                for future in futures:
+                    future.cancel()
+
+
+def _join_translations(pieces: List[Tuple[Text, ...]]) -> Tuple[Text, ...]:
+    # Join the translations of the pieces of a text, for every destination language
+    return tuple(" ".join(t) for t in zip(*pieces))
+
+
+def _update_dicts(translation_dicts: List[Dict[Text, Text]], translations: List[Tuple[Text, Tuple[Text, ...]]]):
+    # Add translations to the translation dictionary of every destination language
+    if len(translations) == 0:
+        return
+    for i, d in enumerate(translation_dicts):
+        d.update((t, tr[i]) for t, tr in translations)
+
 
 class TranslationExample(Exception):
 
@@ -171,3 +473,73 @@ class TranslationExample(Exception):
         self.reason = reason
         self.content = content
 
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket throttle.
+    The rate is halved and the bucket paused on every 429 (Too Many Requests) response, and it recovers slowly
+    with every successful request.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, min_rate: float = 0.1,
+                 recovery_step: Optional[float] = None):
+        """
+        :param rate: Initial (and maximum) rate, in tokens per second.
+        :param capacity: Maximum number of tokens in the bucket (burst size). Defaults to the rate.
+        :param min_rate: Minimum rate.
+        :param recovery_step: Rate increment for every successful request. Defaults to 5% of the initial rate.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.min_rate = min_rate
+        self.recovery_step = recovery_step if recovery_step is not None else rate / 20
+        self._tokens = self.capacity
+        self._last_time = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, and take it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_time) * self.rate)
+                self._last_time = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def penalize(self, retry_after: float):
+        """
+        Halve the rate and pause the bucket.
+        :param retry_after: Seconds to wait before the next token is given.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def reward(self):
+        """
+        Increase the rate after a successful request.
+        """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.recovery_step)
+
+
+def _get_retry_after(response: requests.Response, default: float) -> float:
+    """
+    Get the number of seconds to wait from the Retry-After header of a response.
+    :param response:
+    :param default: Value returned when the header is missing or it is not a number of seconds.
+    :return:
+    """
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return default
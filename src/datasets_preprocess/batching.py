@@ -0,0 +1,150 @@
+# Request packing for translation services.
+#
+# Texts are deduplicated and packed into requests up to a character and element budget. Texts longer than the
+# character budget are split into pieces, whose translations are joined back.
+#
+# @author: jpquiroga@gmail.com
+
+import re
+import hashlib
+from typing import Text, List, Iterable, Iterator, Tuple, Optional, Any, Callable
+from . import count_chars
+
+
+# Azure Translator v3 request limits
+MAX_ELEMENTS_PER_REQUEST = 100
+MAX_CHARS_PER_REQUEST = 5000
+
+_SENTENCE_END = re.compile(r"[.!?;:]\s+")
+
+
+def split_text(text: Text, max_chars: int) -> List[Text]:
+    """
+    Split a text into pieces of at most max_chars characters, preferably at sentence boundaries, then at
+    whitespace.
+    :param text:
+    :param max_chars:
+    :return: List of pieces.
+    """
+    res = []
+    _buff = text
+    while len(_buff) > max_chars:
+        _head = _buff[:max_chars]
+        _cut = max((m.end() for m in _SENTENCE_END.finditer(_head)), default=0)
+        if _cut == 0:
+            _cut = _head.rfind(" ") + 1
+        if _cut == 0:
+            _cut = max_chars
+        res.append(_buff[:_cut].strip())
+        _buff = _buff[_cut:].strip()
+    res.append(_buff)
+    return res
+
+
+class BatchPlan(object):
+    """
+    Requests needed to translate a list of texts.
+    """
+
+    def __init__(self, texts: List[Text], num_pieces: List[int], batches: List[List[Text]]):
+        """
+        :param texts: Unique texts to translate.
+        :param num_pieces: Number of pieces every text has been split into.
+        :param batches: Pieces sent in every request, in the same order as texts.
+        """
+        self.texts = texts
+        self.num_pieces = num_pieces
+        self.batches = batches
+        # Text (index) of every piece of every batch
+        _text_ids = (i for i, n in enumerate(num_pieces) for _ in range(n))
+        self.batch_text_ids = [[next(_text_ids) for _ in b] for b in batches]
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    @property
+    def num_chars(self) -> int:
+        """
+        Number of characters sent (billed) in the whole plan.
+        """
+        return sum(count_chars(b) for b in self.batches)
+
+    def ends_text(self, batch_index: int) -> bool:
+        """
+        :param batch_index:
+        :return: True if the last piece of the batch is the last piece of its text (i.e. no text is split between
+        the batch and the next one).
+        """
+        return batch_index == len(self.batches) - 1 or \
+            self.batch_text_ids[batch_index][-1] != self.batch_text_ids[batch_index + 1][0]
+
+    def get_batch_id(self, batch_index: int) -> Text:
+        """
+        :param batch_index:
+        :return: Content hash of a batch.
+        """
+        return hashlib.sha1("\n".join(self.batches[batch_index]).encode("utf-8")).hexdigest()[:16]
+
+    def fingerprint(self) -> Text:
+        """
+        :return: Content hash of the whole plan.
+        """
+        _hash = hashlib.sha1()
+        for b in self.batches:
+            _hash.update("\n".join(b).encode("utf-8"))
+            _hash.update(b"\0")
+        return _hash.hexdigest()
+
+    def assemble(self, batch_translations: Iterable[Optional[List[Any]]],
+                 join: Callable[[List[Any]], Any] = " ".join) -> Iterator[List[Tuple[Text, Any]]]:
+        """
+        Map the translations of every request back to the texts.
+        :param batch_translations: Translations of the pieces of every batch, in batch order. None stands for a
+        skipped batch (its texts are not returned).
+        :param join: Function joining the translations of the pieces of a text.
+        :return: Iterator over the (text, translation) pairs completed by every batch.
+        """
+        _text_id = None
+        _pieces = []
+        for b, translations in enumerate(batch_translations):
+            res = []
+            if translations is not None:
+                for text_id, t in zip(self.batch_text_ids[b], translations):
+                    if text_id != _text_id:
+                        _text_id = text_id
+                        _pieces = []
+                    _pieces.append(t)
+                    if len(_pieces) == self.num_pieces[text_id]:
+                        res.append((self.texts[text_id], join(_pieces)))
+            yield res
+
+
+def plan_batches(texts: Iterable[Text], max_chars: int = MAX_CHARS_PER_REQUEST,
+                 max_elements: int = MAX_ELEMENTS_PER_REQUEST) -> BatchPlan:
+    """
+    Pack texts into requests. Repeated texts are sent once, and every request holds at most max_elements texts
+    and max_chars characters.
+
+    :param texts:
+    :param max_chars: Maximum number of characters per request.
+    :param max_elements: Maximum number of texts per request.
+    :return: The batch plan.
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    num_pieces = []
+    batches = []
+    _batch = []
+    _batch_chars = 0
+    for t in unique_texts:
+        _pieces = split_text(t, max_chars) if len(t) > max_chars else [t]
+        num_pieces.append(len(_pieces))
+        for p in _pieces:
+            if len(_batch) > 0 and (len(_batch) >= max_elements or _batch_chars + len(p) > max_chars):
+                batches.append(_batch)
+                _batch = []
+                _batch_chars = 0
+            _batch.append(p)
+            _batch_chars += len(p)
+    if len(_batch) > 0:
+        batches.append(_batch)
+    return BatchPlan(unique_texts, num_pieces, batches)
@@ -0,0 +1,137 @@
+#
+# Canonicalization of texts before translation.
+#
+# Texts that differ only in case, whitespace, terminal punctuation or repeated letters ("No", "No.", "no!", "Nooo")
+# are mapped to the same canonical key, so they are translated once. The surface features of every text (casing and
+# terminal punctuation) are re-applied to the translation of its key.
+#
+# @author: jpquiroga@gmail.com
+
+import re
+import argparse
+import numpy as np
+import pandas as pd
+from typing import Text, List, Iterable, Dict, Union
+
+
+# Languages opening questions and exclamations with inverted marks
+INVERTED_MARK_LANGUAGES = ("es",)
+
+_LEADING_MARKS = "¿¡"
+_TRAILING_MARKS = ".!?…"
+
+# Lower case letter repeated three or more times after another letter ("Nooo", "sooo")
+_REPEATED_LETTER_PATTERN = re.compile(r"(?<=[^\W\d_])([a-z])\1{2,}")
+
+# Case of the texts
+KEEP_CASE = 0
+LOWER_CASE = 1
+UPPER_CASE = 2
+
+
+def _collapse_repeats(match: re.Match) -> Text:
+    _word = match.group(0)
+    if _word.isupper() or "." in _word or "/" in _word:
+        return _word
+    return _REPEATED_LETTER_PATTERN.sub(r"\1", _word)
+
+
+class CanonicalForms(object):
+    """
+    Canonical keys of a list of texts, and the surface features needed to rebuild their translations.
+
+    Texts are canonicalized with a vectorized pass:
+    - Whitespace runs are collapsed.
+    - Terminal punctuation (.!?…) and leading inverted marks (¿¡) are removed.
+    - Runs of three or more repeated lower case letters inside a word are collapsed to one letter ("Nooo" -> "No").
+      Upper case words ("VIII", "III") and words with "." or "/" ("www.imdb.com") are left as they are.
+    - Upper case texts are lower cased, and the first letter is upper cased ("no", "NO" -> "No").
+    """
+
+    def __init__(self, texts: Iterable[Text], collapse_repeats: bool = True):
+        """
+        :param texts: Unique texts.
+        :param collapse_repeats: If True, runs of repeated lower case letters inside words are collapsed.
+        """
+        self.texts = np.array(list(texts), dtype=object)
+        _texts = pd.Series(self.texts, dtype=object).str.replace(r"\s+", " ", regex=True).str.strip()
+        _parts = _texts.str.extract(r"^[{}]*\s*(.*?)\s*([{}]*)$".format(_LEADING_MARKS, _TRAILING_MARKS))
+        _core = _parts[0].fillna("")
+        if collapse_repeats:
+            _core = _core.str.replace(r"\S+", _collapse_repeats, regex=True)
+        _is_upper = (_core.str.isupper() & (_core.str.count(r"[^\W\d_]") > 1)).values
+        _is_lower = _core.str[:1].str.islower().values
+        self.cases = np.where(_is_upper, UPPER_CASE, np.where(_is_lower, LOWER_CASE, KEEP_CASE)).astype(np.int8)
+        _core = _core.where(~_is_upper, _core.str.lower())
+        _keys = _core.str[:1].str.upper() + _core.str[1:]
+        # Texts with nothing to translate but punctuation are kept as they are
+        _empty = (_core.str.len() == 0).values
+        _keys = _keys.where(~_empty, _texts)
+        self.suffixes = _parts[1].fillna("").where(~_empty, "").values
+        self.key_ids, _unique_keys = pd.factorize(_keys.values)
+        self.keys = list(_unique_keys)
+        # Texts that are their own key (their translation is taken as it is)
+        self._is_key = (self.texts == np.array(self.keys, dtype=object)[self.key_ids]) if len(self.keys) > 0 \
+            else np.zeros(0, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def stats(self) -> Dict[Text, Union[int, float]]:
+        """
+        :return: Number of texts and keys, number of characters of the texts and the keys, and their ratios.
+        """
+        num_chars = int(sum(len(t) for t in self.texts))
+        num_key_chars = int(sum(len(k) for k in self.keys))
+        return {
+            "texts": len(self.texts),
+            "keys": len(self.keys),
+            "dedup_ratio": len(self.keys) / len(self.texts) if len(self.texts) > 0 else 1.0,
+            "chars": num_chars,
+            "key_chars": num_key_chars,
+            "chars_ratio": num_key_chars / num_chars if num_chars > 0 else 1.0
+        }
+
+    def report(self) -> Text:
+        """
+        :return: Human readable canonicalization statistics.
+        """
+        s = self.stats()
+        return "Canonicalization: {} texts -> {} keys ({:.1%}), {} -> {} characters ({:.1%})".format(
+            s["texts"], s["keys"], s["dedup_ratio"], s["chars"], s["key_chars"], s["chars_ratio"])
+
+    def restore(self, key_translations: List[Text], language: Text) -> List[Text]:
+        """
+        Rebuild the translations of the texts from the translations of their keys.
+        :param key_translations: Translations of the keys, in the same order as self.keys.
+        :param language: Destination language (e.g. to open questions with "¿" in Spanish).
+        :return: Translations of the texts, in the same order as self.texts.
+        """
+        _raw = pd.Series(key_translations, dtype=object).take(self.key_ids).reset_index(drop=True)
+        res = _raw.str.strip().str.lstrip(_LEADING_MARKS).str.rstrip(_TRAILING_MARKS).str.rstrip()
+        res = res.where(self.cases != UPPER_CASE, res.str.upper())
+        res = res.where(self.cases != LOWER_CASE, res.str[:1].str.lower() + res.str[1:])
+        res = res + self.suffixes
+        if language.split("-")[0] in INVERTED_MARK_LANGUAGES:
+            _suffixes = pd.Series(self.suffixes, dtype=object)
+            _questions = _suffixes.str.contains("?", regex=False).values
+            _exclamations = _suffixes.str.contains("!", regex=False).values & ~_questions
+            res = res.where(~_questions, "¿" + res).where(~_exclamations, "¡" + res)
+        return res.where(~self._is_key, _raw).tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report how many texts (and characters) of a text file would be "
+                                                 "translated after canonicalization.")
+    parser.add_argument("text_file",
+                        type=str,
+                        help="File with one text per line.")
+    parser.add_argument("--keep-repeats",
+                        action="store_true",
+                        help="Do not collapse runs of repeated letters.")
+    args = parser.parse_args()
+
+    with open(args.text_file) as f:
+        _texts = dict.fromkeys(_l.strip() for _l in f)
+    _texts.pop("", None)
+    print(CanonicalForms(_texts, collapse_repeats=not args.keep_repeats).report())
@@ -4,10 +4,117 @@
 #
 # @author: jpquiroga@gmail.com
 
+import os
+import re
+import itertools
+import multiprocessing
+import numpy as np
 import pandas as pd
+from functools import partial
 from tqdm import tqdm
-from typing import Text, Optional, Callable
-from . import split_line
+from typing import Text, Optional, Callable, List, Iterator, Tuple
+
+from .translate import Translator
+from .delta import DeltaWriter, content_hash
+
+
+DELIM = "+++$+++"
+
+# Columns of every file of the corpus
+CORNELL_FILE_COLUMNS = {
+    "movie_lines": ["LINE_ID", "CHARACTER_ID", "MOVIE_ID", "CHARACTER_NAME", "UTTERANCE"],
+    "movie_conversations": ["CHARACTER_ID_1", "CHARACTER_ID_2", "MOVIE_ID", "LINE_IDS"],
+    "movie_characters_metadata": ["CHARACTER_ID", "CHARACTER_NAME", "MOVIE_ID", "MOVIE_TITLE", "GENDER",
+                                  "CREDITS_POSITION"],
+    "movie_titles_metadata": ["MOVIE_ID", "MOVIE_TITLE", "YEAR", "IMDB_RATING", "IMDB_VOTES", "GENRES"]
+}
+
+# Prefixes of the ID columns ("L1045" -> 1045)
+_ID_PREFIXES = {
+    "LINE_ID": "L",
+    "CHARACTER_ID": "u",
+    "CHARACTER_ID_1": "u",
+    "CHARACTER_ID_2": "u",
+    "MOVIE_ID": "m"
+}
+
+_CATEGORICAL_COLUMNS = {"CHARACTER_NAME", "MOVIE_TITLE", "GENDER", "CREDITS_POSITION", "YEAR", "GENRES"}
+
+_NUMERIC_COLUMNS = {"IMDB_RATING", "IMDB_VOTES"}
+
+
+def _parse_chunk(lines: List[Text], num_fields: int) -> pd.DataFrame:
+    rows = [l.rstrip("\r\n").split(DELIM, num_fields - 1) for l in lines]
+    res = pd.DataFrame(rows, columns=range(num_fields))
+    for c in res.columns:
+        res[c] = res[c].str.strip()
+    return res
+
+
+def _iter_chunks(file_path: Text, chunk_size: int, encoding: Text) -> Iterator[List[Text]]:
+    with open(file_path, encoding=encoding, errors="ignore") as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if len(lines) == 0:
+                break
+            yield lines
+
+
+def load_cornell_file(file_path: Text, file_type: Optional[Text] = None, compact: bool = True,
+                      chunk_size: int = 100000, num_workers: int = 1, cache_file: Optional[Text] = None,
+                      encoding: Text = "utf-8", tqdm_call: Optional[Callable] = tqdm) -> pd.DataFrame:
+    """
+    Load a file of the corpus (fields separated by +++$+++) into a pandas dataframe.
+
+    :param file_path: movie_lines.txt, movie_conversations.txt, movie_characters_metadata.txt or
+    movie_titles_metadata.txt
+    :param file_type: Key of CORNELL_FILE_COLUMNS. Defaults to the file name without extension.
+    :param compact: If True, ID columns are stored as integers (without their "L", "u" or "m" prefix), text
+    metadata columns as categorical and rating/votes as numbers. Otherwise all columns are strings.
+    :param chunk_size: Number of lines parsed at a time.
+    :param num_workers: Number of processes parsing chunks.
+    :param cache_file: Binary (pickle) copy of the dataframe, along with the loading parameters. It is used instead of
+    the corpus file if it is newer than it and it was written with the same file_type, compact and encoding
+    parameters, and written otherwise.
+    :param encoding:
+    :param tqdm_call:
+
+    :return Pandas dataframe
+    """
+    if file_type is None:
+        file_type = os.path.splitext(os.path.basename(file_path))[0]
+    cache_params = {"file_type": file_type, "compact": compact, "encoding": encoding}
+    if cache_file is not None and os.path.exists(cache_file) and \
+            os.path.getmtime(cache_file) >= os.path.getmtime(file_path):
+        _cached = pd.read_pickle(cache_file)
+        if isinstance(_cached, dict) and _cached.get("params") == cache_params:
+            return _cached["dataframe"]
+    columns = CORNELL_FILE_COLUMNS[file_type]
+
+    _parse = partial(_parse_chunk, num_fields=len(columns))
+    _chunks = _iter_chunks(file_path, chunk_size, encoding)
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            parsed_chunks = list(tqdm_call(pool.imap(_parse, _chunks), desc="Parsed chunks"))
+    else:
+        parsed_chunks = [_parse(c) for c in tqdm_call(_chunks, desc="Parsed chunks")]
+    if len(parsed_chunks) > 0:
+        res = pd.concat(parsed_chunks, ignore_index=True)
+    else:
+        res = pd.DataFrame(columns=range(len(columns)), dtype=object)
+    res.columns = columns
+
+    if compact:
+        for c in columns:
+            if c in _ID_PREFIXES:
+                res[c] = res[c].str[len(_ID_PREFIXES[c]):].astype(np.int32)
+            elif c in _NUMERIC_COLUMNS:
+                res[c] = pd.to_numeric(res[c], errors="coerce")
+            elif c in _CATEGORICAL_COLUMNS:
+                res[c] = res[c].astype("category")
+    if cache_file is not None:
+        pd.to_pickle({"params": cache_params, "dataframe": res}, cache_file)
+    return res
 
 
 def movie_lines_to_dataframe(file_path: Text, tqdm_call: Optional[Callable] = tqdm) -> pd.DataFrame:
@@ -26,31 +133,155 @@ def movie_lines_to_dataframe(file_path: Text, tqdm_call: Optional[Callable] = tq
     :param tqdm_call:
 
     :return Pandas dataframe
+
+    See also load_cornell_file, which stores IDs and names with compact dtypes.
     """
-    DELIM = "+++$+++"
-    line_ids = []
-    character_ids = []
-    movie_ids = []
-    character_names = []
-    utterances = []
-    with open(file_path, encoding="utf-8", errors="ignore") as f:
-        for l in tqdm_call(f.readlines()):
-            _parsed_line = split_line(l, DELIM)
-            line_ids.append(_parsed_line[0])
-            character_ids.append(_parsed_line[1])
-            movie_ids.append(_parsed_line[2])
-            character_names.append(_parsed_line[3])
-            utterances.append(_parsed_line[4])
-    res = pd.DataFrame()
-    res["LINE_ID"] = line_ids
-    res["CHARACTER_ID"] = character_ids
-    res["MOVIE_ID"] = movie_ids
-    res["CHARACTER_NAME"] = character_names
-    res["UTTERANCE"] = utterances
-    return res
+    return load_cornell_file(file_path, file_type="movie_lines", compact=False, tqdm_call=tqdm_call)
+
+
+class ConversationIndex(object):
+    """
+    Conversations of the corpus as flat NumPy arrays of movie_lines rows.
+
+    The rows of the utterances of conversation i are turn_rows[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, turn_rows: np.ndarray, offsets: np.ndarray):
+        """
+        :param turn_rows: Row (position) in the movie_lines dataframe of every utterance of every conversation.
+        :param offsets: Start of every conversation in turn_rows (plus the total number of turns at the end).
+        """
+        self.turn_rows = turn_rows
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """
+        Number of utterances of every conversation.
+        """
+        return np.diff(self.offsets)
+
+    def get_conversation(self, i: int) -> np.ndarray:
+        """
+        :param i: Conversation position.
+        :return: Rows of the utterances of the conversation.
+        """
+        return self.turn_rows[self.offsets[i]:self.offsets[i + 1]]
+
+    def _get_responses(self) -> Tuple[np.ndarray, np.ndarray]:
+        # Positions (in turn_rows) of every turn but the first one of its conversation, and their conversation
+        lengths = self.lengths
+        is_response = np.ones(len(self.turn_rows), dtype=bool)
+        is_response[self.offsets[:-1][lengths > 0]] = False
+        return np.flatnonzero(is_response), np.repeat(np.arange(len(self)), np.maximum(lengths - 1, 0))
 
+    def turn_pairs(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Get every pair of consecutive utterances of every conversation.
+        :return: Arrays with the context row, the response row and the conversation of every pair.
+        """
+        responses, conversations = self._get_responses()
+        return self.turn_rows[responses - 1], self.turn_rows[responses], conversations
 
+    def context_windows(self, context_size: int, pad_row: int = -1) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Get, for every utterance but the first one of its conversation, the window of previous utterances.
+        :param context_size: Maximum number of utterances of the context.
+        :param pad_row: Row used to pad contexts shorter than context_size (at their beginning).
+        :return: Arrays with the context rows (shape [num_responses, context_size]), the response row and the
+        conversation of every window.
+        """
+        responses, conversations = self._get_responses()
+        # Positions (in turn_rows) of the context of every response, masked when out of its conversation
+        positions = responses[:, None] + np.arange(-context_size, 0)[None, :]
+        valid = positions >= self.offsets[conversations][:, None]
+        contexts = np.where(valid, self.turn_rows[np.maximum(positions, 0)], pad_row)
+        return contexts, self.turn_rows[responses], conversations
 
 
+def build_conversation_index(df_movie_lines: pd.DataFrame, df_movie_conversations: pd.DataFrame) -> \
+        ConversationIndex:
+    """
+    Build the index of the conversations of the corpus.
+
+    :param df_movie_lines: movie_lines dataframe (see load_cornell_file).
+    :param df_movie_conversations: movie_conversations dataframe (see load_cornell_file).
+    :return: The conversation index. Utterances not found in df_movie_lines are dropped from their conversation.
+    """
+    line_ids = df_movie_lines["LINE_ID"]
+    if line_ids.dtype == object or pd.api.types.is_string_dtype(line_ids):
+        line_ids = line_ids.str[len(_ID_PREFIXES["LINE_ID"]):].astype(np.int64)
+    line_ids = line_ids.to_numpy(dtype=np.int64)
+    # lineID -> row lookup table
+    row_by_line_id = np.full(line_ids.max() + 1 if len(line_ids) > 0 else 0, -1, dtype=np.int64)
+    row_by_line_id[line_ids] = np.arange(len(line_ids))
+
+    # Utterance IDs of every conversation, flattened
+    _ids = df_movie_conversations["LINE_IDS"].astype(str)
+    lengths = _ids.str.count(r"L\d+").to_numpy(dtype=np.int64)
+    conversation_line_ids = np.array(re.findall(r"L(\d+)", " ".join(_ids)), dtype=np.int64)
+
+    found = conversation_line_ids < len(row_by_line_id)
+    found[found] = row_by_line_id[conversation_line_ids[found]] >= 0
+    turn_rows = row_by_line_id[conversation_line_ids[found]]
+    conversations = np.repeat(np.arange(len(lengths)), lengths)[found]
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(conversations, minlength=len(lengths)))
+    return ConversationIndex(turn_rows, offsets)
+
+
+def translate_movie_lines(movie_lines_file: Text, destination_file: Text, translator: Translator,
+                          batch_size: int = 100, encoding: Text = "iso-8859-1",
+                          tqdm_call: Optional[Callable] = tqdm) -> Tuple[int, int]:
+    """
+    Write a copy of movie_lines.txt with translated utterances (same format, utf-8 encoded).
+    The translation is incremental: a manifest next to destination_file keeps the content hash of every line, so
+    when the file is translated again, only new or changed lines are translated, and the output of the other ones is
+    copied from the previous destination file (see delta.DeltaWriter).
+
+    :param movie_lines_file:
+    :param destination_file:
+    :param translator:
+    :param batch_size: Number of texts passed to every translate_batch call.
+    :param encoding: Encoding of movie_lines_file.
+    :param tqdm_call:
+    :return: Number of reused and translated lines.
+    """
+    fingerprint = "{} {}".format(type(translator).__name__, getattr(translator, "destination_language", ""))
+    with DeltaWriter(destination_file, fingerprint=fingerprint) as writer, open(movie_lines_file, "rb") as f:
+        # Lines waiting to be written, in order (None for the ones copied from the previous output)
+        _pending = []
+        _num_texts = 0
 
+        def _flush():
+            _fields = [l.decode(encoding, errors="ignore").split(DELIM) for _, l in _pending if l is not None]
+            _texts = [_f[-1].strip() for _f in _fields if len(_f) == len(CORNELL_FILE_COLUMNS["movie_lines"])]
+            _translations = iter(translator.translate_batch(_texts) if len(_texts) > 0 else [])
+            _fields = iter(_fields)
+            for h, l in _pending:
+                if l is None:
+                    writer.copy_unit(h)
+                    continue
+                _f = next(_fields)
+                if len(_f) == len(CORNELL_FILE_COLUMNS["movie_lines"]):
+                    _f[-1] = " " + next(_translations)
+                writer.write_unit(h, (DELIM.join(_f) + "\n").encode("utf-8"))
 
+        for l in tqdm_call(f, desc="Movie lines"):
+            l = l.rstrip(b"\r\n")
+            h = content_hash(l)
+            if writer.has_unit(h):
+                _pending.append((h, None))
+            else:
+                _pending.append((h, l))
+                _num_texts += 1
+            if _num_texts >= batch_size or len(_pending) >= 100 * batch_size:
+                _flush()
+                _pending = []
+                _num_texts = 0
+        _flush()
+    print("Movie lines: {} reused, {} translated".format(writer.num_reused, writer.num_written))
+    return writer.num_reused, writer.num_written
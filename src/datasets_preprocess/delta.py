@@ -0,0 +1,159 @@
+#
+# Incremental (delta) rewriting of translated datasets.
+#
+# The output file of a dataset is made of units (dialogues, lines...) and separators. A manifest next to the output
+# file records the content hash of the source of every unit and the byte range of its output. When the dataset is
+# processed again, units whose source did not change are copied from the previous output file, byte range by byte
+# range, and only the new or changed ones are translated and serialized. The manifest also records the size and
+# modification time of the output file, so it is ignored if the output was rewritten by a non incremental run.
+#
+# @author: jpquiroga@gmail.com
+
+import os
+import hashlib
+from typing import Text, Dict, Tuple, Optional, List, Union
+
+
+def content_hash(data: Union[Text, bytes]) -> Text:
+    """
+    :param data:
+    :return: Hash of the source of a unit.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class DeltaWriter(object):
+    """
+    Writer of an output file that reuses the output of the unchanged units of the previous version of the file.
+
+    The new version is written to a temporary file, which replaces the previous one (and its manifest) on close.
+    If an exception is raised inside the context manager, the previous version is kept.
+    """
+
+    def __init__(self, destination_file: Text, fingerprint: Text = "", manifest_file: Optional[Text] = None):
+        """
+        :param destination_file:
+        :param fingerprint: Identifier of everything but the source that determines the output (e.g. the
+        destination language). The previous output is not reused if it was written with a different fingerprint.
+        :param manifest_file: Defaults to <destination_file>.manifest
+        """
+        self.destination_file = destination_file
+        self.fingerprint = fingerprint
+        self.manifest_file = manifest_file if manifest_file is not None else destination_file + ".manifest"
+        self._previous_units = {}
+        self._previous_fd = None
+        if os.path.exists(destination_file) and os.path.exists(self.manifest_file):
+            _fingerprint, _output_stat, _units = DeltaWriter.load_manifest(self.manifest_file)
+            _stat = os.stat(destination_file)
+            # The manifest is ignored if the output file was rewritten by anything else
+            if _fingerprint == fingerprint and _output_stat == (_stat.st_size, _stat.st_mtime_ns):
+                self._previous_units = {h: (offset, length) for h, offset, length in _units
+                                        if offset >= 0 and length >= 0 and offset + length <= _stat.st_size}
+                self._previous_fd = open(destination_file, "rb")
+        self._tmp_file = destination_file + ".tmp"
+        self._fd = open(self._tmp_file, "wb")
+        self._units = []
+        self.num_reused = 0
+        self.num_written = 0
+
+    @staticmethod
+    def load_manifest(manifest_file: Text) -> Tuple[Text, Optional[Tuple[int, int]], List[Tuple[Text, int, int]]]:
+        """
+        :param manifest_file:
+        :return: Fingerprint, (size, mtime in nanoseconds) of the output file it describes (None if unknown) and list
+        of (hash, offset, length) tuples of the units.
+        """
+        units = []
+        output_stat = None
+        with open(manifest_file) as f:
+            fingerprint = f.readline().rstrip("\n")[len("# "):]
+            _toks = f.readline().split()
+            if len(_toks) == 3 and _toks[0] == "#output":
+                output_stat = (int(_toks[1]), int(_toks[2]))
+            for l in f:
+                h, offset, length = l.split()
+                units.append((h, int(offset), int(length)))
+        return fingerprint, output_stat, units
+
+    def _save_manifest(self, manifest_file: Text):
+        _stat = os.stat(self.destination_file)
+        with open(manifest_file, "w") as f:
+            f.write("# {}\n".format(self.fingerprint))
+            f.write("#output {} {}\n".format(_stat.st_size, _stat.st_mtime_ns))
+            for h, offset, length in self._units:
+                f.write("{} {} {}\n".format(h, offset, length))
+
+    def has_unit(self, unit_hash: Text) -> bool:
+        """
+        :param unit_hash: Content hash of the source of a unit.
+        :return: True if the output of the unit can be copied from the previous output file.
+        """
+        return unit_hash in self._previous_units
+
+    def write(self, data: bytes):
+        """
+        Write data that is not part of any unit (e.g. separators).
+        :param data:
+        """
+        self._fd.write(data)
+
+    def write_unit(self, unit_hash: Text, data: bytes):
+        """
+        Write the output of a new (or changed) unit.
+        :param unit_hash: Content hash of the source of the unit.
+        :param data: Output of the unit.
+        """
+        self._units.append((unit_hash, self._fd.tell(), len(data)))
+        self._fd.write(data)
+        self.num_written += 1
+
+    def copy_unit(self, unit_hash: Text):
+        """
+        Copy the output of an unchanged unit from the previous output file.
+        :param unit_hash: Content hash of the source of the unit.
+        """
+        offset, length = self._previous_units[unit_hash]
+        self._previous_fd.seek(offset)
+        data = self._previous_fd.read(length)
+        if len(data) != length:
+            raise IOError("{} is shorter than its manifest".format(self.destination_file))
+        self._units.append((unit_hash, self._fd.tell(), length))
+        self._fd.write(data)
+        self.num_reused += 1
+
+    def stats(self) -> Dict[Text, int]:
+        return {"reused": self.num_reused, "written": self.num_written}
+
+    def close(self):
+        """
+        Replace the previous output file and manifest with the new ones.
+        """
+        self._fd.close()
+        if self._previous_fd is not None:
+            self._previous_fd.close()
+        # Output first: a manifest never describes a different output file (at worst, there is no valid manifest)
+        if os.path.exists(self.manifest_file):
+            os.remove(self.manifest_file)
+        os.replace(self._tmp_file, self.destination_file)
+        self._save_manifest(self.manifest_file + ".tmp")
+        os.replace(self.manifest_file + ".tmp", self.manifest_file)
+
+    def abort(self):
+        """
+        Discard the new output, keeping the previous one.
+        """
+        self._fd.close()
+        if self._previous_fd is not None:
+            self._previous_fd.close()
+        os.remove(self._tmp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,93 @@
+# Progress journal for resumable translation jobs.
+#
+# The journal is a small text file: a header line with the fingerprint of the job, followed by one
+# "<batch index> <batch id>" line for every committed batch. Lines are fsynced in groups.
+#
+# @author: jpquiroga@gmail.com
+
+import os
+from typing import Text, List
+
+
+class TranslationJournal(object):
+    """
+    Journal of the committed batches of a translation job.
+    """
+
+    _HEADER_PREFIX = "# job "
+
+    def __init__(self, journal_file: Text, fingerprint: Text, fsync_every: int = 16):
+        """
+        Open a journal. Committed batches are loaded if the journal exists and belongs to the same job; otherwise a
+        new journal is started.
+        :param journal_file:
+        :param fingerprint: Fingerprint of the job.
+        :param fsync_every: Number of commits between fsyncs.
+        """
+        self.journal_file = journal_file
+        self.fingerprint = fingerprint
+        self.fsync_every = fsync_every
+        self.committed = {}
+        self._pending_syncs = 0
+        if os.path.exists(journal_file):
+            with open(journal_file, "r") as f:
+                header = f.readline()
+                if header.strip() == TranslationJournal._HEADER_PREFIX + fingerprint:
+                    for l in f:
+                        toks = l.split()
+                        # Ignore a possibly truncated last line
+                        if len(toks) == 2 and l.endswith("\n"):
+                            self.committed[int(toks[0])] = toks[1]
+                else:
+                    self.committed = None
+        else:
+            self.committed = None
+        if self.committed is None:
+            self.committed = {}
+            self._fd = open(journal_file, "w")
+            self._fd.write(TranslationJournal._HEADER_PREFIX + fingerprint + "\n")
+            self.sync()
+        else:
+            self._fd = open(journal_file, "a")
+
+    @property
+    def position(self) -> int:
+        """
+        Number of batches committed without gaps from the beginning of the job.
+        """
+        res = 0
+        while res in self.committed:
+            res += 1
+        return res
+
+    def is_committed(self, batch_index: int, batch_id: Text) -> bool:
+        return self.committed.get(batch_index) == batch_id
+
+    def commit(self, batch_indexes: List[int], batch_ids: List[Text]):
+        """
+        Record batches as committed (their translations must be already stored).
+        :param batch_indexes:
+        :param batch_ids:
+        """
+        for i, b in zip(batch_indexes, batch_ids):
+            self._fd.write("{} {}\n".format(i, b))
+            self.committed[i] = b
+        self._pending_syncs += 1
+        if self._pending_syncs >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+        self._pending_syncs = 0
+
+    def close(self):
+        if not self._fd.closed:
+            self.sync()
+            self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
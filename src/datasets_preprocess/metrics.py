@@ -0,0 +1,274 @@
+#
+# Lightweight performance metrics (counters, gauges and latency histograms).
+#
+# Metrics can be dumped as JSON or in the Prometheus text exposition format, at the end of a run or periodically.
+#
+# @author: jpquiroga@gmail.com
+
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Text, Dict, Tuple, Optional, Iterator, Any
+
+
+# Upper bounds (seconds) of the default latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def exponential_buckets(start: float, factor: float, count: int) -> Tuple[float, ...]:
+    """
+    :param start: Upper bound of the first bucket.
+    :param factor: Ratio between the upper bounds of consecutive buckets.
+    :param count: Number of buckets.
+    :return: Exponentially growing bucket bounds (e.g. for precise latency quantiles).
+    """
+    return tuple(start * factor ** i for i in range(count))
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        :param buckets: Sorted upper bounds of the buckets (an implicit +Inf bucket is added).
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: "Histogram"):
+        """
+        Add the observations of another histogram (e.g. recorded by a worker process).
+        :param other: Histogram with the same buckets.
+        """
+        if other.buckets != self.buckets:
+            raise ValueError("Cannot merge histograms with different buckets")
+        self.counts = [c + o for c, o in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimate a quantile (upper bound of the bucket where it falls).
+        :param q: Quantile, in [0, 1].
+        :return: The estimation, or None if there are no observations. Quantiles falling in the +Inf bucket are
+        estimated as the largest finite bound.
+        """
+        if self.count == 0:
+            return None
+        _rank = q * self.count
+        _cumulative = 0
+        for bound, c in zip(self.buckets, self.counts):
+            _cumulative += c
+            if _cumulative >= _rank:
+                return bound
+        return self.buckets[-1]
+
+    def to_dict(self) -> Dict[Text, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": {str(b): c for b, c in zip(self.buckets + ("+Inf",), self.counts)}
+        }
+
+
+def _format_labels(labels: Tuple[Tuple[Text, Text], ...]) -> Text:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+class Metrics(object):
+    """
+    Thread safe registry of metrics. Every metric is identified by its name and its labels.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        :param buckets: Default buckets of the histograms.
+        """
+        self.buckets = tuple(buckets)
+        self.start_time = time.time()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._dump_thread = None
+        self._dump_stop = None
+
+    def inc(self, name: Text, value: float = 1, **labels):
+        """
+        Increment a counter.
+        :param name:
+        :param value:
+        :param labels:
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: Text, value: float, **labels):
+        """
+        Set a gauge.
+        :param name:
+        :param value:
+        :param labels:
+        """
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: Text, value: float, buckets: Optional[Tuple[float, ...]] = None, **labels):
+        """
+        Add an observation to a histogram.
+        :param name:
+        :param value:
+        :param buckets: Buckets of the histogram, if it does not exist yet. Defaults to the registry buckets.
+        :param labels:
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            _histogram = self._histograms.get(key)
+            if _histogram is None:
+                _histogram = self._histograms[key] = Histogram(buckets if buckets is not None else self.buckets)
+            _histogram.observe(value)
+
+    def merge_histogram(self, name: Text, histogram: Histogram, **labels):
+        """
+        Add the observations of a histogram (e.g. recorded by a worker process) to a histogram of the registry.
+        :param name:
+        :param histogram: Histogram with the same buckets as the one of the registry, if it exists.
+        :param labels:
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            _histogram = self._histograms.get(key)
+            if _histogram is None:
+                _histogram = self._histograms[key] = Histogram(histogram.buckets)
+            _histogram.merge(histogram)
+
+    @contextmanager
+    def time(self, name: Text, **labels) -> Iterator[None]:
+        """
+        Context manager observing the time (seconds) spent in its block.
+        :param name: Histogram name.
+        :param labels:
+        """
+        _start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - _start, **labels)
+
+    def get_histogram(self, name: Text, **labels) -> Optional[Histogram]:
+        """
+        :param name:
+        :param labels:
+        :return: A histogram, or None if it does not exist.
+        """
+        with self._lock:
+            return self._histograms.get((name, tuple(sorted(labels.items()))))
+
+    def get(self, name: Text, **labels) -> float:
+        """
+        :param name:
+        :param labels:
+        :return: Value of a counter or gauge (0 if it does not exist).
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def to_dict(self) -> Dict[Text, Any]:
+        """
+        :return: Snapshot of all the metrics. Metrics with labels are keyed by name{labels}.
+        """
+        with self._lock:
+            return {
+                "uptime_seconds": time.time() - self.start_time,
+                "counters": {n + _format_labels(l): v for (n, l), v in sorted(self._counters.items())},
+                "gauges": {n + _format_labels(l): v for (n, l), v in sorted(self._gauges.items())},
+                "histograms": {n + _format_labels(l): h.to_dict() for (n, l), h in sorted(self._histograms.items())}
+            }
+
+    def to_json(self) -> Text:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> Text:
+        """
+        :return: All the metrics, in the Prometheus text exposition format.
+        """
+        res = []
+        with self._lock:
+            res.append("# TYPE uptime_seconds gauge")
+            res.append("uptime_seconds {}".format(time.time() - self.start_time))
+            for metrics, _type in ((self._counters, "counter"), (self._gauges, "gauge")):
+                _last_name = None
+                for (n, l), v in sorted(metrics.items()):
+                    if n != _last_name:
+                        res.append("# TYPE {} {}".format(n, _type))
+                        _last_name = n
+                    res.append("{}{} {}".format(n, _format_labels(l), v))
+            _last_name = None
+            for (n, l), h in sorted(self._histograms.items()):
+                if n != _last_name:
+                    res.append("# TYPE {} histogram".format(n))
+                    _last_name = n
+                _cumulative = 0
+                for b, c in zip(h.buckets + ("+Inf",), h.counts):
+                    _cumulative += c
+                    res.append("{}_bucket{} {}".format(n, _format_labels(l + (("le", b),)), _cumulative))
+                res.append("{}_sum{} {}".format(n, _format_labels(l), h.sum))
+                res.append("{}_count{} {}".format(n, _format_labels(l), h.count))
+        return "\n".join(res) + "\n"
+
+    def dump(self, metrics_file: Text, metrics_format: Optional[Text] = None):
+        """
+        Write all the metrics to a file (atomically replacing it).
+        :param metrics_file:
+        :param metrics_format: "json" or "prometheus". Defaults to "json" for .json files, and "prometheus"
+        otherwise.
+        """
+        if metrics_format is None:
+            metrics_format = "json" if metrics_file.endswith(".json") else "prometheus"
+        contents = self.to_json() if metrics_format == "json" else self.to_prometheus()
+        _tmp_file = metrics_file + ".tmp"
+        with open(_tmp_file, "w") as f:
+            f.write(contents)
+        os.replace(_tmp_file, metrics_file)
+
+    def start_periodic_dump(self, metrics_file: Text, interval: float = 60.0, metrics_format: Optional[Text] = None):
+        """
+        Dump the metrics periodically from a background thread (see dump), until stop_periodic_dump is called.
+        :param metrics_file:
+        :param interval: Seconds between dumps.
+        :param metrics_format:
+        """
+        self.stop_periodic_dump()
+        self._dump_stop = threading.Event()
+
+        def _dump_loop(stop: threading.Event):
+            while not stop.wait(interval):
+                self.dump(metrics_file, metrics_format=metrics_format)
+
+        self._dump_thread = threading.Thread(target=_dump_loop, args=(self._dump_stop,), daemon=True)
+        self._dump_thread.start()
+
+    def stop_periodic_dump(self):
+        if self._dump_thread is not None:
+            self._dump_stop.set()
+            self._dump_thread.join()
+            self._dump_thread = None
+            self._dump_stop = None
@@ -8,34 +8,645 @@
 import xml.sax
 import xml.dom
 import os.path
+import sys
+import gzip
 from tqdm import tqdm
-from bs4 import BeautifulSoup
 import argparse
 import subprocess
 import time
 import datetime
+import threading
+import multiprocessing
+import re
+import math
+import hashlib
+import array
+import numpy as np
+from xml.etree import ElementTree
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, List, Tuple, Iterator, Optional, IO, Callable
+try:
+    from .metrics import Metrics, Histogram
+except ImportError:
+    # Run as a script
+    from metrics import Metrics, Histogram
 
 CURSOR_UP_ONE = "\x1b[1A"
 ERASE_LINE = "\x1b[2K"
 
+
+def _normalize_whitespace(text: str) -> str:
+    return " ".join(text.split())
+
+
+def _open_subtitles_document(subtitles_file: str) -> IO[bytes]:
+    # Compressed documents are read transparently
+    if subtitles_file.endswith(".gz"):
+        return gzip.open(subtitles_file, "rb")
+    return open(subtitles_file, "rb")
+
+
+def iter_sentences_etree(subtitles_file: str) -> Iterator[Tuple[str, str]]:
+    """
+    Stream the sentences of a subtitles document with ElementTree.iterparse (no document tree is kept in memory).
+    :param subtitles_file:
+    :return: Iterator over (sentence id, whitespace normalized text) tuples.
+    """
+    with _open_subtitles_document(subtitles_file) as f:
+        for event, elem in ElementTree.iterparse(f, events=("end",)):
+            if elem.tag == "s":
+                yield elem.attrib["id"], _normalize_whitespace("".join(elem.itertext()))
+                elem.clear()
+
+
+def iter_sentences_bs4(subtitles_file: str) -> Iterator[Tuple[str, str]]:
+    """
+    Get the sentences of a subtitles document building its BeautifulSoup tree.
+    :param subtitles_file:
+    :return: Iterator over (sentence id, whitespace normalized text) tuples.
+    """
+    from bs4 import BeautifulSoup
+    with _open_subtitles_document(subtitles_file) as f:
+        contents = f.read()
+    bs = BeautifulSoup(contents, 'xml')
+    for e in bs.find_all("s"):
+        yield e.attrs["id"], _normalize_whitespace(e.text)
+
+
+# Available sentence readers
+SENTENCE_READERS = {
+    "etree": iter_sentences_etree,
+    "bs4": iter_sentences_bs4
+}
+
+
+class SentenceMapCache(object):
+    """
+    LRU cache of the sentence maps (sentence id -> text) of subtitles documents, bounded by an estimation of the
+    memory they use.
+    """
+
+    def __init__(self, max_bytes: int = 256 << 20):
+        """
+        :param max_bytes: Maximum (estimated) memory used by the cached sentence maps.
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _get_size(sentences: Dict[str, str]) -> int:
+        return sys.getsizeof(sentences) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in sentences.items())
+
+    def get(self, key: Tuple[str, str]) -> Optional[Dict[str, str]]:
+        """
+        :param key: (subtitles file, sentence reader) tuple.
+        :return: The cached sentence map, or None if it is not cached.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Tuple[str, str], sentences: Dict[str, str]):
+        """
+        Cache a sentence map, evicting the least recently used ones if needed. Maps bigger than the whole cache are
+        not cached.
+        :param key: (subtitles file, sentence reader) tuple.
+        :param sentences:
+        """
+        size = SentenceMapCache._get_size(sentences)
+        if size > self.max_bytes or key in self._entries:
+            return
+        while self.num_bytes + size > self.max_bytes:
+            _, (_, _size) = self._entries.popitem(last=False)
+            self.num_bytes -= _size
+            self.evictions += 1
+        self._entries[key] = (sentences, size)
+        self.num_bytes += size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self),
+                "bytes": self.num_bytes}
+
+
+def read_sentences(subtitles_file: str, sentence_reader: str = "etree",
+                   cache: Optional[SentenceMapCache] = None, metrics: Optional[Metrics] = None) -> Dict[str, str]:
+    """
+    Read the sentences of a subtitles document.
+    :param subtitles_file: Subtitles document (it can be gzip compressed).
+    :param sentence_reader: Name of the sentence reader (see SENTENCE_READERS).
+    :param cache: Cache of already read documents.
+    :param metrics: Metrics registry where the parse time of the document is recorded.
+    :return: Dictionary with the text of every sentence, keyed by sentence id.
+    """
+    if cache is not None:
+        res = cache.get((subtitles_file, sentence_reader))
+        if res is not None:
+            return res
+    if metrics is not None:
+        with metrics.time("opensubtitles_document_parse_seconds"):
+            res = dict(SENTENCE_READERS[sentence_reader](subtitles_file))
+        metrics.inc("opensubtitles_documents_parsed_total")
+    else:
+        res = dict(SENTENCE_READERS[sentence_reader](subtitles_file))
+    if cache is not None:
+        cache.put((subtitles_file, sentence_reader), res)
+    return res
+
+
+def _get_subtitles_file(base_dir: str, doc: str) -> str:
+    # Documents are read compressed or uncompressed, whichever exists (the given name first)
+    res = os.path.join(base_dir, doc)
+    if not os.path.exists(res):
+        _alternative = res[:-3] if res.endswith(".gz") else res + ".gz"
+        if os.path.exists(_alternative):
+            res = _alternative
+    return res
+
+
+def align_link_group(base_dir: str, from_doc: str, to_doc: str, xtargets: List[str],
+                     sentence_reader: str = "etree", cache: Optional[SentenceMapCache] = None,
+                     metrics: Optional[Metrics] = None) -> Tuple[List[str], List[str]]:
+    """
+    Get the aligned texts of a link group (linkGrp element).
+    :param base_dir: The base dir where subtitles data is located.
+    :param from_doc: Origin subtitles document (fromDoc attribute).
+    :param to_doc: Destination subtitles document (toDoc attribute).
+    :param xtargets: The xtargets attributes of the link elements of the group.
+    :param sentence_reader: Name of the sentence reader (see SENTENCE_READERS).
+    :param cache: Cache of already read documents.
+    :param metrics: Metrics registry (see read_sentences).
+    :return: Lists of aligned origin and destination texts (empty if a document cannot be read).
+    """
+    origin_subtitles_file = _get_subtitles_file(base_dir, from_doc)
+    destination_subtitles_file = _get_subtitles_file(base_dir, to_doc)
+    # Read subtitle files for later alignment processing
+    try:
+        in_orig_dict = read_sentences(origin_subtitles_file, sentence_reader=sentence_reader, cache=cache,
+                                      metrics=metrics)
+        in_dest_dict = read_sentences(destination_subtitles_file, sentence_reader=sentence_reader, cache=cache,
+                                      metrics=metrics)
+    except OSError as e:
+        print("Error reading files {} and {}: {}".format(origin_subtitles_file, destination_subtitles_file, e))
+        print("Skipping...")
+        return [], []
+    res_orig = []
+    res_dest = []
+    for x in xtargets:
+        orig_indexes, dest_indexes = x.split(";")
+        orig_indexes = orig_indexes.strip()
+        dest_indexes = dest_indexes.strip()
+        if len(orig_indexes) > 0 and len(dest_indexes) > 0:
+            orig_indexes = orig_indexes.split(" ")
+            dest_indexes = dest_indexes.split(" ")
+            try:
+                text_orig = [in_orig_dict[i] for i in orig_indexes]
+                text_dest = [in_dest_dict[i] for i in dest_indexes]
+                res_orig.append(" ".join(text_orig))
+                res_dest.append(" ".join(text_dest))
+            except:
+                print("Error aligning files {} and {} at indexes {} and {} respectively".format(
+                    origin_subtitles_file, destination_subtitles_file, orig_indexes, dest_indexes))
+                print("Skipping...")
+    return res_orig, res_dest
+
+
+def count_link_groups(alignment_file: str) -> int:
+    """
+    Count the link groups of an alignment file. The link group index of the file is used if it exists and it is up
+    to date; otherwise every group is supposed to have its opening and closing tags in different lines.
+    :param alignment_file:
+    :return: Number of link groups.
+    """
+    if os.path.exists(LinkGroupIndex.get_index_file(alignment_file)):
+        index = LinkGroupIndex.load(alignment_file)
+        if not index.is_stale():
+            return len(index)
+    p = subprocess.Popen(["grep", '-c', "linkGrp", alignment_file], stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    result, err = p.communicate()
+    if p.returncode != 0:
+        raise IOError(err)
+    return int(int(result.strip().split()[0]) / 2)
+
+
+class LinkGroupIndex(object):
+    """
+    Byte offset index of the link groups (linkGrp elements) of an alignment file.
+
+    For every group it keeps its byte offset, its length and its fromDoc/toDoc attributes, so groups can be
+    counted, sharded and read in isolation without scanning the whole alignment file. The index is stored in a
+    sidecar .npz file next to the alignment file, along with the size and modification time of the alignment file
+    (to detect stale indexes).
+    """
+
+    _START_TAG = b"<linkGrp"
+    _END_TAG = b"</linkGrp>"
+    _FROM_DOC = re.compile(rb'fromDoc="([^"]*)"')
+    _TO_DOC = re.compile(rb'toDoc="([^"]*)"')
+
+    def __init__(self, alignment_file: str, offsets: np.ndarray, lengths: np.ndarray, docs: np.ndarray,
+                 from_doc_ids: np.ndarray, to_doc_ids: np.ndarray, file_size: int = -1, file_mtime_ns: int = -1):
+        """
+        :param alignment_file:
+        :param offsets: Byte offset of every group.
+        :param lengths: Length in bytes of every group.
+        :param docs: Unique subtitles documents.
+        :param from_doc_ids: fromDoc of every group, as an index over docs.
+        :param to_doc_ids: toDoc of every group, as an index over docs.
+        :param file_size: Size of the indexed alignment file (-1 if unknown).
+        :param file_mtime_ns: Modification time (nanoseconds) of the indexed alignment file (-1 if unknown).
+        """
+        self.alignment_file = alignment_file
+        self.offsets = offsets
+        self.lengths = lengths
+        self.docs = docs
+        self.from_doc_ids = from_doc_ids
+        self.to_doc_ids = to_doc_ids
+        self.file_size = file_size
+        self.file_mtime_ns = file_mtime_ns
+
+    @staticmethod
+    def get_index_file(alignment_file: str) -> str:
+        return alignment_file + ".idx.npz"
+
+    @staticmethod
+    def build(alignment_file: str, chunk_size: int = 1 << 24) -> "LinkGroupIndex":
+        """
+        Build the index of an alignment file (one sequential pass over the file).
+        :param alignment_file:
+        :param chunk_size: Number of bytes read at a time.
+        :return: The index.
+        """
+        _stat = os.stat(alignment_file)
+        offsets = []
+        lengths = []
+        from_docs = []
+        to_docs = []
+        _buff = b""
+        _buff_offset = 0
+        _eof = False
+        with open(alignment_file, "rb") as f:
+            while not _eof:
+                data = f.read(chunk_size)
+                _eof = len(data) == 0
+                _buff += data
+                _pos = 0
+                while True:
+                    _start = _buff.find(LinkGroupIndex._START_TAG, _pos)
+                    if _start < 0:
+                        # Keep a possibly truncated start tag
+                        _pos = max(_pos, len(_buff) - len(LinkGroupIndex._START_TAG))
+                        break
+                    _end = _buff.find(LinkGroupIndex._END_TAG, _start)
+                    if _end < 0:
+                        _pos = _start
+                        break
+                    _end += len(LinkGroupIndex._END_TAG)
+                    _start_tag = _buff[_start:_buff.index(b">", _start)]
+                    offsets.append(_buff_offset + _start)
+                    lengths.append(_end - _start)
+                    from_docs.append(LinkGroupIndex._FROM_DOC.search(_start_tag).group(1).decode("utf-8"))
+                    to_docs.append(LinkGroupIndex._TO_DOC.search(_start_tag).group(1).decode("utf-8"))
+                    _pos = _end
+                _buff = _buff[_pos:]
+                _buff_offset += _pos
+        docs, doc_ids = np.unique(np.array(from_docs + to_docs, dtype=str), return_inverse=True)
+        doc_ids = doc_ids.astype(np.int32)
+        return LinkGroupIndex(alignment_file, np.array(offsets, dtype=np.int64),
+                              np.array(lengths, dtype=np.int32), docs, doc_ids[:len(from_docs)],
+                              doc_ids[len(from_docs):], _stat.st_size, _stat.st_mtime_ns)
+
+    def save(self, index_file: Optional[str] = None):
+        """
+        Save the index to a sidecar file.
+        :param index_file: Defaults to <alignment_file>.idx.npz
+        """
+        if index_file is None:
+            index_file = LinkGroupIndex.get_index_file(self.alignment_file)
+        with open(index_file, "wb") as f:
+            np.savez(f, offsets=self.offsets, lengths=self.lengths, docs=self.docs,
+                     from_doc_ids=self.from_doc_ids, to_doc_ids=self.to_doc_ids,
+                     file_size=np.int64(self.file_size), file_mtime_ns=np.int64(self.file_mtime_ns))
+
+    @staticmethod
+    def load(alignment_file: str, index_file: Optional[str] = None) -> "LinkGroupIndex":
+        """
+        Load the index of an alignment file.
+        :param alignment_file:
+        :param index_file: Defaults to <alignment_file>.idx.npz
+        :return: The index.
+        """
+        if index_file is None:
+            index_file = LinkGroupIndex.get_index_file(alignment_file)
+        with np.load(index_file) as data:
+            # Indexes saved without the stat of the alignment file are always stale
+            return LinkGroupIndex(alignment_file, data["offsets"], data["lengths"], data["docs"],
+                                  data["from_doc_ids"], data["to_doc_ids"],
+                                  int(data["file_size"]) if "file_size" in data else -1,
+                                  int(data["file_mtime_ns"]) if "file_mtime_ns" in data else -1)
+
+    def is_stale(self) -> bool:
+        """
+        :return: True if the alignment file changed (size or modification time) since the index was built.
+        """
+        _stat = os.stat(self.alignment_file)
+        return (_stat.st_size, _stat.st_mtime_ns) != (self.file_size, self.file_mtime_ns)
+
+    @staticmethod
+    def load_or_build(alignment_file: str) -> "LinkGroupIndex":
+        """
+        Load the index of an alignment file, building (and saving) it first if it does not exist or it is stale.
+        :param alignment_file:
+        :return: The index.
+        """
+        if os.path.exists(LinkGroupIndex.get_index_file(alignment_file)):
+            res = LinkGroupIndex.load(alignment_file)
+            if not res.is_stale():
+                return res
+        print("Building link group index...")
+        res = LinkGroupIndex.build(alignment_file)
+        res.save()
+        return res
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def get_docs(self, i: int) -> Tuple[str, str]:
+        """
+        :param i: Group position.
+        :return: fromDoc and toDoc of the group.
+        """
+        return str(self.docs[self.from_doc_ids[i]]), str(self.docs[self.to_doc_ids[i]])
+
+    def get_link_group(self, i: int) -> Tuple[str, str, List[str]]:
+        """
+        Read and parse a single group.
+        :param i: Group position.
+        :return: (fromDoc, toDoc, xtargets list) tuple.
+        """
+        return read_link_group(self.alignment_file, int(self.offsets[i]), int(self.lengths[i]))
+
+
+def read_link_group(alignment_file: str, offset: int, length: int) -> Tuple[str, str, List[str]]:
+    """
+    Read and parse a single link group from an alignment file.
+    :param alignment_file:
+    :param offset: Byte offset of the group.
+    :param length: Length in bytes of the group.
+    :return: (fromDoc, toDoc, xtargets list) tuple.
+    """
+    with open(alignment_file, "rb") as f:
+        f.seek(offset)
+        element = ElementTree.fromstring(f.read(length))
+    return element.attrib["fromDoc"], element.attrib["toDoc"], [e.attrib["xtargets"] for e in element.iter("link")]
+
+
+class HashSet64(object):
+    """
+    Compact set of 64 bit hashes: open addressing (linear probing) table with 8 bytes per slot, doubled when it is
+    half full.
+
+    Adding a hash takes between two and three times as long as adding it to a set of ints (about 0.8 us against
+    0.3 us, in CPython), but the set takes 16 to 32 bytes per hash instead of about 80 bytes (the int objects
+    included). Deduplicating 1M pairs (hashing included) takes 2.9 s with it and 2.1 s with a set. Probing stays in
+    pure Python: a numpy table is slower for single items, and batched vectorized probing only pays off for batches
+    of thousands of hashes (larger than a link group). The table is rebuilt in a vectorized way when it grows.
+    """
+
+    def __init__(self, capacity: int = 1 << 16):
+        """
+        :param capacity: Initial number of slots (a power of two).
+        """
+        self._slots = array.array("Q", bytes(8 * capacity))
+        self._mask = capacity - 1
+        # 0 marks empty slots, so it is kept out of the table
+        self._has_zero = False
+        self.size = 0
+
+    def add(self, h: int) -> bool:
+        """
+        :param h: 64 bit hash.
+        :return: True if the hash was not in the set.
+        """
+        if h == 0:
+            if self._has_zero:
+                return False
+            self._has_zero = True
+            self.size += 1
+            return True
+        _slots = self._slots
+        _mask = self._mask
+        i = h & _mask
+        while True:
+            v = _slots[i]
+            if v == 0:
+                _slots[i] = h
+                self.size += 1
+                if self.size * 2 > len(_slots):
+                    self._grow()
+                return True
+            if v == h:
+                return False
+            i = (i + 1) & _mask
+
+    def _grow(self):
+        _old_slots = np.frombuffer(self._slots, dtype=np.uint64)
+        self._slots = array.array("Q", HashSet64._place(_old_slots[_old_slots != 0], 2 * len(_old_slots)).tobytes())
+        self._mask = len(self._slots) - 1
+
+    @staticmethod
+    def _place(hashes: np.ndarray, capacity: int) -> np.ndarray:
+        # Table with the given (unique, non zero) hashes. In home slot order, every hash goes to its home slot or to
+        # the slot after the previous hash, whichever is greater, so there are no empty slots between the home slot
+        # of a hash and its slot. Hashes past the end wrap around to the first empty slots.
+        _homes = hashes & np.uint64(capacity - 1)
+        _order = np.argsort(_homes, kind="stable")
+        hashes = hashes[_order]
+        _steps = np.arange(len(hashes), dtype=np.int64)
+        positions = np.maximum.accumulate(_homes[_order].astype(np.int64) - _steps) + _steps
+        res = np.zeros(capacity, dtype=np.uint64)
+        _wrapped = positions >= capacity
+        res[positions[~_wrapped]] = hashes[~_wrapped]
+        if _wrapped.any():
+            res[np.flatnonzero(res == 0)[:int(_wrapped.sum())]] = hashes[_wrapped]
+        return res
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def num_bytes(self) -> int:
+        return len(self._slots) * 8
+
+
+class BloomFilter(object):
+    """
+    Bloom filter with a fixed memory size. Unseen items are reported as seen with a small probability (false
+    positives), which grows with the number of items.
+    """
+
+    def __init__(self, max_bytes: int = 64 << 20, expected_items: Optional[int] = None):
+        """
+        :param max_bytes: Size of the bit array.
+        :param expected_items: Expected number of items, used to choose the optimal number of hash functions
+        (7 by default).
+        """
+        self.num_bits = max_bytes * 8
+        self.num_hashes = max(1, int(round(self.num_bits / expected_items * math.log(2)))) \
+            if expected_items else 7
+        self._bits = bytearray(max_bytes)
+        self.size = 0
+
+    def add(self, h: int) -> bool:
+        """
+        :param h: 128 bit hash.
+        :return: True if the item was (certainly) not in the filter.
+        """
+        # Double hashing
+        h1 = h & 0xFFFFFFFFFFFFFFFF
+        h2 = (h >> 64) | 1
+        res = False
+        for j in range(self.num_hashes):
+            b = (h1 + j * h2) % self.num_bits
+            _bit = 1 << (b & 7)
+            if not self._bits[b >> 3] & _bit:
+                self._bits[b >> 3] |= _bit
+                res = True
+        if res:
+            self.size += 1
+        return res
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def num_bytes(self) -> int:
+        return len(self._bits)
+
+
+class PairFilter(object):
+    """
+    Inline quality filter and deduplicator of aligned text pairs.
+
+    Pairs are dropped, in this order, if any of their texts is shorter than min_chars or longer than max_chars, if
+    the length ratio of their texts is greater than max_length_ratio, or if they are duplicates of a previous pair.
+    """
+
+    # Reasons to drop a pair
+    DROP_REASONS = ("too_short", "too_long", "length_ratio", "duplicate")
+
+    def __init__(self, dedup: Optional[str] = "exact", bloom_max_bytes: int = 64 << 20,
+                 expected_pairs: Optional[int] = None, min_chars: int = 0, max_chars: Optional[int] = None,
+                 max_length_ratio: Optional[float] = None, ratio_min_chars: int = 10):
+        """
+        :param dedup: "exact" (set of 64 bit hashes of the pairs, 16 bytes per unique pair at most), "bloom"
+        (Bloom filter of bloom_max_bytes; a few unique pairs may be dropped as duplicates) or None (no dedup).
+        :param bloom_max_bytes: Memory cap of the Bloom filter.
+        :param expected_pairs: Expected number of unique pairs (to tune the Bloom filter).
+        :param min_chars: Minimum number of characters of every text (1 drops pairs with an empty text).
+        :param max_chars: Maximum number of characters of every text.
+        :param max_length_ratio: Maximum ratio between the lengths of the longest and the shortest text.
+        :param ratio_min_chars: The length ratio is only checked if both texts have at least this length (it is
+        not meaningful for very short texts).
+        """
+        if dedup == "exact":
+            self._seen = HashSet64()
+        elif dedup == "bloom":
+            self._seen = BloomFilter(bloom_max_bytes, expected_items=expected_pairs)
+        elif dedup is None:
+            self._seen = None
+        else:
+            raise ValueError("Unknown dedup method: {}".format(dedup))
+        self._digest_size = 16 if dedup == "bloom" else 8
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.max_length_ratio = max_length_ratio
+        self.ratio_min_chars = ratio_min_chars
+        self.num_pairs = 0
+        self.drop_counts = {r: 0 for r in PairFilter.DROP_REASONS}
+
+    def _get_drop_reason(self, text_orig: str, text_dest: str) -> Optional[str]:
+        _len_orig = len(text_orig)
+        _len_dest = len(text_dest)
+        if min(_len_orig, _len_dest) < self.min_chars:
+            return "too_short"
+        if self.max_chars is not None and max(_len_orig, _len_dest) > self.max_chars:
+            return "too_long"
+        if self.max_length_ratio is not None and min(_len_orig, _len_dest) >= self.ratio_min_chars and \
+                max(_len_orig, _len_dest) > self.max_length_ratio * min(_len_orig, _len_dest):
+            return "length_ratio"
+        if self._seen is not None:
+            _hash = hashlib.blake2b("{}\t{}".format(text_orig, text_dest).encode("utf-8"),
+                                    digest_size=self._digest_size).digest()
+            if not self._seen.add(int.from_bytes(_hash, "little")):
+                return "duplicate"
+        return None
+
+    def accept(self, text_orig: str, text_dest: str) -> bool:
+        """
+        :param text_orig:
+        :param text_dest:
+        :return: True if the pair is kept.
+        """
+        self.num_pairs += 1
+        reason = self._get_drop_reason(text_orig, text_dest)
+        if reason is None:
+            return True
+        self.drop_counts[reason] += 1
+        return False
+
+    def filter(self, texts_orig: List[str], texts_dest: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        :param texts_orig:
+        :param texts_dest:
+        :return: The kept origin and destination texts.
+        """
+        res_orig = []
+        res_dest = []
+        for o, d in zip(texts_orig, texts_dest):
+            if self.accept(o, d):
+                res_orig.append(o)
+                res_dest.append(d)
+        return res_orig, res_dest
+
+    def stats(self) -> Dict[str, int]:
+        res = {"pairs": self.num_pairs, "kept": self.num_pairs - sum(self.drop_counts.values())}
+        res.update(self.drop_counts)
+        if self._seen is not None:
+            res["dedup_bytes"] = self._seen.num_bytes
+        return res
+
+
 class OpensubtitlesAlignementHandler(xml.sax.ContentHandler):
 
     def __init__(self, alignment_file, base_dir: str, origin_output_text_file: str, destination_output_text_file: str,
-                 subsample_rate=1, sample_index=0):
+                 subsample_rate=1, sample_index=0, sentence_reader: str = "etree", cache_max_bytes: int = 256 << 20,
+                 metrics: Optional[Metrics] = None, pair_filter: Optional[PairFilter] = None):
         self.subsample_rate = subsample_rate
+        self.pair_filter = pair_filter
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.sentence_reader = sentence_reader
+        self.sentence_cache = SentenceMapCache(cache_max_bytes) if cache_max_bytes > 0 else None
         self.sample_index = sample_index
         self.aligment_file = alignment_file
         self.base_dir = base_dir
-        self.origin_subtitles_file = None
-        self.destination_subtitles_file = None
+        self.from_doc = None
+        self.to_doc = None
+        self.xtargets = None
         self.origin_output_text_file = origin_output_text_file + "_" + str(sample_index)
         self.destination_output_text_file = destination_output_text_file + "_" + str(sample_index)
-        # Temporal file descriptors for reading
-        self.in_orig_fd = None
-        self.in_dest_fd = None
-        # Temporal parsers for reading
-        self.in_orig_bs = None
-        self.in_dest_bs = None
         # Open output files for writing
         self.out_orig_fd = open(self.origin_output_text_file, "w")
         self.out_dest_fd = open(self.destination_output_text_file, "w")
@@ -45,8 +656,6 @@ class OpensubtitlesAlignementHandler(xml.sax.ContentHandler):
         self.start_time = None
         self.count = 0
         self.active = False
-        self.in_orig_dict = None
-        self.in_dest_dict = None
 
 
     def startElement(self, name, attrs):
@@ -59,48 +668,14 @@ class OpensubtitlesAlignementHandler(xml.sax.ContentHandler):
         if name == "linkGrp":
             if self.count % self.subsample_rate == self.sample_index:
                 self.active = True
-                self.origin_subtitles_file = os.path.join(self.base_dir, attrs["fromDoc"])
-                self.destination_subtitles_file = os.path.join(self.base_dir, attrs["toDoc"])
-
-                # All files are supposed to be uncompressed
-                if self.origin_subtitles_file.endswith(".gz"):
-                    self.origin_subtitles_file = self.origin_subtitles_file[:-3]
-                if self.destination_subtitles_file.endswith(".gz"):
-                    self.destination_subtitles_file = self.destination_subtitles_file[:-3]
-
-                # Read subtitle files for later alignment processing
-                self.in_orig_fd = open(self.origin_subtitles_file, "r")
-                contents = self.in_orig_fd.read()
-                self.in_orig_bs = BeautifulSoup(contents, 'xml')
-                self.in_orig_dict = {e.attrs["id"]:e.text for e in self.in_orig_bs.find_all("s")}
-                #
-                self.in_dest_fd = open(self.destination_subtitles_file, "r")
-                contents = self.in_dest_fd.read()
-                self.in_dest_bs = BeautifulSoup(contents, 'xml')
-                self.in_dest_dict = {e.attrs["id"]:e.text for e in self.in_dest_bs.find_all("s")}
+                self.from_doc = attrs["fromDoc"]
+                self.to_doc = attrs["toDoc"]
+                self.xtargets = []
             else:
                 self.active = False
             self.count += 1
         elif name == "link" and self.active:
-            xtargets = attrs["xtargets"]
-            orig_indexes, dest_indexes = xtargets.split(";")
-            orig_indexes = orig_indexes.strip()
-            dest_indexes = dest_indexes.strip()
-            if len(orig_indexes) > 0 and len(dest_indexes) > 0:
-                orig_indexes = orig_indexes.split(" ")
-                dest_indexes = dest_indexes.split(" ")
-                try:
-                    # text_orig = [self.in_orig_bs.find("s", {"id":i}).text.replace("\n", " ").strip() for i in orig_indexes]
-                    # text_dest = [self.in_dest_bs.find("s", {"id":i}).text.replace("\n", " ").strip() for i in dest_indexes]
-                    text_orig = [self.in_orig_dict[i].replace("\n", " ").strip() for i in orig_indexes]
-                    text_dest = [self.in_dest_dict[i].replace("\n", " ").strip() for i in dest_indexes]
-                    # Write to files
-                    self.out_orig_fd.write(" ".join(text_orig) + "\n")
-                    self.out_dest_fd.write(" ".join(text_dest) + "\n")
-                except:
-                    print("Error aligning files {} and {} at indexes {} and {} respectively".format(
-                        self.origin_subtitles_file, self.destination_subtitles_file, orig_indexes, dest_indexes))
-                    print("Skipping...")
+            self.xtargets.append(attrs["xtargets"])
 
     def endElement(self, name):
         """Signals the end of an element in non-namespace mode.
@@ -108,8 +683,20 @@ class OpensubtitlesAlignementHandler(xml.sax.ContentHandler):
         The name parameter contains the name of the element type, just
         as with the startElement event."""
         if name == "linkGrp" and self.active:
-            self.in_orig_fd.close()
-            self.in_dest_fd.close()
+            with self.metrics.time("opensubtitles_link_group_seconds"):
+                text_orig, text_dest = align_link_group(self.base_dir, self.from_doc, self.to_doc, self.xtargets,
+                                                        sentence_reader=self.sentence_reader,
+                                                        cache=self.sentence_cache, metrics=self.metrics)
+            self.metrics.inc("opensubtitles_link_groups_total")
+            self.metrics.inc("opensubtitles_aligned_texts_total", len(text_orig))
+            if self.pair_filter is not None:
+                text_orig, text_dest = self.pair_filter.filter(text_orig, text_dest)
+                _set_pair_filter_metrics(self.metrics, self.pair_filter)
+            # Write to files
+            for t in text_orig:
+                self.out_orig_fd.write(t + "\n")
+            for t in text_dest:
+                self.out_dest_fd.write(t + "\n")
             self.num_processed_subtitles += 1
             if self.start_time is None:
                 self.start_time = time.time()
@@ -129,6 +716,12 @@ class OpensubtitlesAlignementHandler(xml.sax.ContentHandler):
             self.active = False
 
     def close(self):
+        if self.sentence_cache is not None:
+            for k, v in self.sentence_cache.stats().items():
+                self.metrics.set("opensubtitles_sentence_cache_" + k, v)
+            print("\nSentence cache: {}".format(self.sentence_cache.stats()))
+        if self.pair_filter is not None:
+            print("Pair filter: {}".format(self.pair_filter.stats()))
         if self.out_orig_fd is not None:
             self.out_orig_fd.close()
         if self.out_dest_fd is not None:
@@ -136,16 +729,219 @@ class OpensubtitlesAlignementHandler(xml.sax.ContentHandler):
 
     def _get_num_subtitles_to_process(self):
         print("Gathering subtitles to process...")
-        p = subprocess.Popen(["grep", '-c', "linkGrp", self.aligment_file], stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        result, err = p.communicate()
-        if p.returncode != 0:
-            raise IOError(err)
-        res = int(int(int(result.strip().split()[0]) / 2) / self.subsample_rate)
+        res = len(range(self.sample_index, count_link_groups(self.aligment_file), self.subsample_rate))
         print("Found {} subtitles to process.".format(res))
         return res
 
 
+def _set_pair_filter_metrics(metrics: Metrics, pair_filter: PairFilter):
+    for k, v in pair_filter.stats().items():
+        metrics.set("opensubtitles_pair_filter_" + k, v)
+
+
+class LinkGroupCollector(xml.sax.ContentHandler):
+    """
+    Collect the link groups of an alignment file as (fromDoc, toDoc, xtargets list) tuples.
+    """
+
+    def __init__(self):
+        self.link_groups = []
+        self._current = None
+
+    def startElement(self, name, attrs):
+        if name == "linkGrp":
+            self._current = (attrs["fromDoc"], attrs["toDoc"], [])
+        elif name == "link" and self._current is not None:
+            self._current[2].append(attrs["xtargets"])
+
+    def endElement(self, name):
+        if name == "linkGrp" and self._current is not None:
+            self.link_groups.append(self._current)
+            self._current = None
+
+
+def iter_link_groups(alignment_file: str, subsample_rate: int = 1, sample_index: int = 0,
+                     chunk_size: int = 1 << 20) -> Iterator[Tuple[str, str, List[str]]]:
+    """
+    Stream the link groups of an alignment file, parsing it only once.
+    :param alignment_file:
+    :param subsample_rate:
+    :param sample_index: Only groups whose position modulo subsample_rate is sample_index are returned.
+    :param chunk_size: Number of bytes fed to the parser at a time.
+    :return: Iterator over (fromDoc, toDoc, xtargets list) tuples.
+    """
+    collector = LinkGroupCollector()
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(collector)
+    count = 0
+    with open(alignment_file, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if len(data) > 0:
+                parser.feed(data)
+            else:
+                parser.close()
+            for g in collector.link_groups:
+                if count % subsample_rate == sample_index:
+                    yield g
+                count += 1
+            collector.link_groups = []
+            if len(data) == 0:
+                break
+
+
+# Sentence map cache and histogram buckets of every worker process
+_worker_sentence_cache = None
+_worker_buckets = None
+
+
+def _init_worker(cache_max_bytes: int, buckets: Tuple[float, ...]):
+    global _worker_sentence_cache, _worker_buckets
+    _worker_sentence_cache = SentenceMapCache(cache_max_bytes) if cache_max_bytes > 0 else None
+    _worker_buckets = buckets
+
+
+def _align_link_group_unit(base_dir: str, sentence_reader: str, link_group: Tuple[str, str, List[str]]) -> \
+        Tuple[List[str], List[str], int, int, Optional[Histogram]]:
+    # The cache hits and misses and the document parse times of the unit are returned along with the aligned texts
+    _stats = (_worker_sentence_cache.hits, _worker_sentence_cache.misses) if _worker_sentence_cache else (0, 0)
+    _metrics = Metrics(_worker_buckets)
+    res = align_link_group(base_dir, *link_group, sentence_reader=sentence_reader, cache=_worker_sentence_cache,
+                           metrics=_metrics)
+    _parse_seconds = _metrics.get_histogram("opensubtitles_document_parse_seconds")
+    if _worker_sentence_cache is None:
+        return res[0], res[1], 0, 0, _parse_seconds
+    return res[0], res[1], _worker_sentence_cache.hits - _stats[0], _worker_sentence_cache.misses - _stats[1], \
+        _parse_seconds
+
+
+def _align_indexed_link_group_unit(alignment_file: str, base_dir: str, sentence_reader: str,
+                                   position: Tuple[int, int]) -> \
+        Tuple[List[str], List[str], int, int, Optional[Histogram]]:
+    return _align_link_group_unit(base_dir, sentence_reader, read_link_group(alignment_file, *position))
+
+
+def iter_aligned_texts(alignment_file: str, base_dir: str, num_workers: int, subsample_rate: int = 1,
+                       sample_index: int = 0, chunksize: int = 16, max_pending: Optional[int] = None,
+                       index: Optional[LinkGroupIndex] = None, sentence_reader: str = "etree",
+                       cache_max_bytes: int = 256 << 20, metrics: Optional[Metrics] = None,
+                       tqdm_call: Callable = tqdm) -> Iterator[Tuple[List[str], List[str]]]:
+    """
+    Align the link groups of an alignment file using a pool of processes.
+    The alignment file is parsed once, by the coordinator process, and the link groups are handed out to the
+    workers. If a link group index is given, the coordinator only hands out group positions and every worker
+    reads its groups from the alignment file. Aligned texts are yielded in the order of the alignment file.
+
+    :param alignment_file: The file containing the alignment information in XCES format.
+    :param base_dir: The base dir where subtitles data is located for both languages.
+    :param num_workers: Number of worker processes.
+    :param subsample_rate:
+    :param sample_index:
+    :param chunksize: Number of link groups sent to a worker at a time.
+    :param max_pending: Maximum number of link groups read ahead of the consumer (bounds the coordinator memory).
+    :param index: Link group index of the alignment file.
+    :param sentence_reader: Name of the sentence reader (see SENTENCE_READERS).
+    :param cache_max_bytes: Memory bound of the sentence map cache of every worker (0 disables the cache).
+    :param metrics: Metrics registry where link group, text and cache counts are recorded.
+    :param tqdm_call:
+    :return: Iterator over the (origin texts, destination texts) of every link group.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    if max_pending is None:
+        max_pending = num_workers * chunksize * 4
+    if index is not None:
+        _units = ((int(index.offsets[i]), int(index.lengths[i]))
+                  for i in range(sample_index, len(index), subsample_rate))
+        _align_unit = partial(_align_indexed_link_group_unit, alignment_file, base_dir, sentence_reader)
+        num_subtitles_to_process = len(range(sample_index, len(index), subsample_rate))
+    else:
+        _units = iter_link_groups(alignment_file, subsample_rate=subsample_rate, sample_index=sample_index)
+        _align_unit = partial(_align_link_group_unit, base_dir, sentence_reader)
+        print("Gathering subtitles to process...")
+        num_subtitles_to_process = len(range(sample_index, count_link_groups(alignment_file), subsample_rate))
+    print("Found {} subtitles to process.".format(num_subtitles_to_process))
+    # The pool feeder thread consumes groups only when there is room for them. It gives up when the run stops (e.g.
+    # on a worker error, or when the consumer stops iterating), so the pool can be terminated.
+    pending = threading.BoundedSemaphore(max_pending)
+    stop = threading.Event()
+
+    def _link_groups():
+        for g in _units:
+            while not pending.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            yield g
+
+    cache_hits = 0
+    cache_misses = 0
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(cache_max_bytes, metrics.buckets)) \
+            as pool:
+        try:
+            for text_orig, text_dest, _hits, _misses, _parse_seconds in \
+                    tqdm_call(pool.imap(_align_unit, _link_groups(), chunksize=chunksize),
+                              total=num_subtitles_to_process, desc="Processed subtitles"):
+                metrics.inc("opensubtitles_link_groups_total")
+                metrics.inc("opensubtitles_aligned_texts_total", len(text_orig))
+                if _parse_seconds is not None:
+                    metrics.merge_histogram("opensubtitles_document_parse_seconds", _parse_seconds)
+                    metrics.inc("opensubtitles_documents_parsed_total", _parse_seconds.count)
+                cache_hits += _hits
+                cache_misses += _misses
+                pending.release()
+                yield text_orig, text_dest
+        finally:
+            # Unblock the feeder thread before the pool is terminated
+            stop.set()
+    metrics.set("opensubtitles_sentence_cache_hits", cache_hits)
+    metrics.set("opensubtitles_sentence_cache_misses", cache_misses)
+    print("Sentence cache: {} hits, {} misses".format(cache_hits, cache_misses))
+
+
+def extract_aligned_texts(alignment_file: str, base_dir: str, origin_output_text_file: str,
+                          destination_output_text_file: str, num_workers: int, subsample_rate: int = 1,
+                          sample_index: int = 0, chunksize: int = 16, max_pending: Optional[int] = None,
+                          index: Optional[LinkGroupIndex] = None, sentence_reader: str = "etree",
+                          cache_max_bytes: int = 256 << 20, metrics: Optional[Metrics] = None,
+                          pair_filter: Optional[PairFilter] = None):
+    """
+    Extract the aligned texts of an alignment file using a pool of processes (see iter_aligned_texts). Results are
+    written in the order of the alignment file.
+
+    :param alignment_file: The file containing the alignment information in XCES format.
+    :param base_dir: The base dir where subtitles data is located for both languages.
+    :param origin_output_text_file: The output file where the origin language texts will be written.
+    :param destination_output_text_file: The output file where the destination language texts will be written.
+    :param num_workers: Number of worker processes.
+    :param subsample_rate:
+    :param sample_index:
+    :param chunksize: Number of link groups sent to a worker at a time.
+    :param max_pending: Maximum number of link groups read ahead of the writer (bounds the coordinator memory).
+    :param index: Link group index of the alignment file.
+    :param sentence_reader: Name of the sentence reader (see SENTENCE_READERS).
+    :param cache_max_bytes: Memory bound of the sentence map cache of every worker (0 disables the cache).
+    :param metrics: Metrics registry where link group, text and cache counts are recorded.
+    :param pair_filter: Filter applied to the aligned pairs before they are written.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    with open(origin_output_text_file, "w") as out_orig_fd, open(destination_output_text_file, "w") as out_dest_fd:
+        for text_orig, text_dest in iter_aligned_texts(alignment_file, base_dir, num_workers,
+                                                       subsample_rate=subsample_rate, sample_index=sample_index,
+                                                       chunksize=chunksize, max_pending=max_pending, index=index,
+                                                       sentence_reader=sentence_reader,
+                                                       cache_max_bytes=cache_max_bytes, metrics=metrics):
+            if pair_filter is not None:
+                text_orig, text_dest = pair_filter.filter(text_orig, text_dest)
+                _set_pair_filter_metrics(metrics, pair_filter)
+            for t in text_orig:
+                out_orig_fd.write(t + "\n")
+            for t in text_dest:
+                out_dest_fd.write(t + "\n")
+    if pair_filter is not None:
+        print("Pair filter: {}".format(pair_filter.stats()))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Preproces opensubtitles in two languages to produce a couple of files"
                                                  "with aligned texts that cna be used for automatic translation "
@@ -164,15 +960,96 @@ if __name__ == "__main__":
                         help="The output file where the destination language texts will be written.")
     parser.add_argument("subsample_rate",
                         type=int,
+                        nargs="?",
+                        default=1,
                         help="The subsample rate")
     parser.add_argument("sample_index",
                         type=int,
+                        nargs="?",
+                        default=0,
                         help="The sample index (valid values are in {0, ..., subsample_rate-1}")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=0,
+                        help="Number of worker processes. If greater than 0, the alignment file is parsed once and "
+                             "the aligned texts are written directly to the output files (no _<sample_index> "
+                             "suffix).")
+    parser.add_argument("--index",
+                        action="store_true",
+                        help="Use the byte offset index of the link groups (<alignment_file>.idx.npz), building it "
+                             "first if it does not exist. In --workers mode, the alignment file is then not parsed "
+                             "by the coordinator.")
+    parser.add_argument("--sentence-reader",
+                        type=str,
+                        default="etree",
+                        choices=sorted(SENTENCE_READERS),
+                        help="The parser used to read the sentences of the subtitles documents.")
+    parser.add_argument("--cache-mb",
+                        type=int,
+                        default=256,
+                        help="Memory bound (in MB) of the cache of parsed subtitles documents (of every worker in "
+                             "--workers mode). 0 disables the cache.")
+    parser.add_argument("--dedup",
+                        type=str,
+                        default="none",
+                        choices=["none", "exact", "bloom"],
+                        help="Drop duplicate pairs, tracking them in a compact hash set (exact) or in a Bloom filter "
+                             "of --bloom-mb MB (bloom; a few unique pairs may be dropped).")
+    parser.add_argument("--bloom-mb",
+                        type=int,
+                        default=64,
+                        help="Memory cap (in MB) of the Bloom filter used by --dedup bloom.")
+    parser.add_argument("--min-chars",
+                        type=int,
+                        default=0,
+                        help="Drop pairs with a text shorter than this (1 drops pairs with an empty text).")
+    parser.add_argument("--max-chars",
+                        type=int,
+                        default=0,
+                        help="If greater than 0, drop pairs with a text longer than this.")
+    parser.add_argument("--max-length-ratio",
+                        type=float,
+                        default=0,
+                        help="If greater than 0, drop pairs whose longest text is longer than this ratio times the "
+                             "shortest one.")
+    parser.add_argument("--metrics-file",
+                        type=str,
+                        default=None,
+                        help="File where performance metrics are dumped at the end of the run (JSON if its "
+                             "extension is .json, Prometheus text format otherwise).")
+    parser.add_argument("--metrics-interval",
+                        type=float,
+                        default=0,
+                        help="If greater than 0, metrics are also dumped every --metrics-interval seconds.")
 
     args = parser.parse_args()
 
-    handler = OpensubtitlesAlignementHandler(args.alignment_file, args.base_dir, args.origin_output_text_file,
-                                             args.destination_output_text_file, subsample_rate=args.subsample_rate,
-                                             sample_index=args.sample_index)
-    xml.sax.parse(args.alignment_file, handler)
-    handler.close()
+    pair_filter = None
+    if args.dedup != "none" or args.min_chars > 0 or args.max_chars > 0 or args.max_length_ratio > 0:
+        pair_filter = PairFilter(dedup=args.dedup if args.dedup != "none" else None,
+                                 bloom_max_bytes=args.bloom_mb << 20, min_chars=args.min_chars,
+                                 max_chars=args.max_chars if args.max_chars > 0 else None,
+                                 max_length_ratio=args.max_length_ratio if args.max_length_ratio > 0 else None)
+    metrics = Metrics()
+    if args.metrics_file is not None and args.metrics_interval > 0:
+        metrics.start_periodic_dump(args.metrics_file, interval=args.metrics_interval)
+
+    index = LinkGroupIndex.load_or_build(args.alignment_file) if args.index else None
+    if args.workers > 0:
+        extract_aligned_texts(args.alignment_file, args.base_dir, args.origin_output_text_file,
+                              args.destination_output_text_file, num_workers=args.workers,
+                              subsample_rate=args.subsample_rate, sample_index=args.sample_index, index=index,
+                              sentence_reader=args.sentence_reader, cache_max_bytes=args.cache_mb << 20,
+                              metrics=metrics, pair_filter=pair_filter)
+    else:
+        handler = OpensubtitlesAlignementHandler(args.alignment_file, args.base_dir, args.origin_output_text_file,
+                                                 args.destination_output_text_file, subsample_rate=args.subsample_rate,
+                                                 sample_index=args.sample_index,
+                                                 sentence_reader=args.sentence_reader,
+                                                 cache_max_bytes=args.cache_mb << 20, metrics=metrics,
+                                                 pair_filter=pair_filter)
+        xml.sax.parse(args.alignment_file, handler)
+        handler.close()
+    if args.metrics_file is not None:
+        metrics.stop_periodic_dump()
+        metrics.dump(args.metrics_file)
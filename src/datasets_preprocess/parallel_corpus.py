@@ -0,0 +1,298 @@
+#
+# Random access reader for aligned parallel corpora (one text per line, one file per language, e.g. the output
+# files of opensubtitles.py).
+#
+# Files are memory mapped and every line is located through a line offset index, stored in a sidecar .npz file,
+# so pairs can be accessed, sliced and shuffled without loading the texts into memory.
+#
+# @author: jpquiroga@gmail.com
+
+import os
+import mmap
+import argparse
+import numpy as np
+from typing import Text, List, Tuple, Iterator, Optional, Union, Sequence
+
+
+class LineIndex(object):
+    """
+    Byte offset index of the lines of a text file.
+    """
+
+    def __init__(self, text_file: Text, starts: np.ndarray, file_size: int):
+        """
+        :param text_file:
+        :param starts: Byte offset of every line, followed by the offset of the end of the last line plus one (as
+        if the file always ended with a newline).
+        :param file_size: Size of the indexed file (used to detect stale indexes).
+        """
+        self.text_file = text_file
+        self.starts = starts
+        self.file_size = file_size
+
+    @staticmethod
+    def get_index_file(text_file: Text) -> Text:
+        return text_file + ".lines.npz"
+
+    @staticmethod
+    def build(text_file: Text, chunk_size: int = 1 << 26) -> "LineIndex":
+        """
+        Build the index of a text file (one sequential pass over the file).
+        :param text_file:
+        :param chunk_size: Number of bytes scanned at a time.
+        :return: The index.
+        """
+        file_size = os.path.getsize(text_file)
+        _starts = [np.zeros(1, dtype=np.int64)]
+        with open(text_file, "rb") as f:
+            _offset = 0
+            while True:
+                data = f.read(chunk_size)
+                if len(data) == 0:
+                    break
+                _newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+                _starts.append(_newlines.astype(np.int64) + _offset + 1)
+                _offset += len(data)
+        starts = np.concatenate(_starts)
+        if file_size > 0 and starts[-1] != file_size:
+            # Last line without newline
+            starts = np.append(starts, file_size + 1)
+        return LineIndex(text_file, starts, file_size)
+
+    def save(self, index_file: Optional[Text] = None):
+        """
+        Save the index to a sidecar file.
+        :param index_file: Defaults to <text_file>.lines.npz
+        """
+        if index_file is None:
+            index_file = LineIndex.get_index_file(self.text_file)
+        with open(index_file, "wb") as f:
+            np.savez(f, starts=self.starts, file_size=np.int64(self.file_size))
+
+    @staticmethod
+    def load(text_file: Text, index_file: Optional[Text] = None) -> "LineIndex":
+        """
+        Load the index of a text file.
+        :param text_file:
+        :param index_file: Defaults to <text_file>.lines.npz
+        :return: The index.
+        """
+        if index_file is None:
+            index_file = LineIndex.get_index_file(text_file)
+        with np.load(index_file) as data:
+            return LineIndex(text_file, data["starts"], int(data["file_size"]))
+
+    @staticmethod
+    def load_or_build(text_file: Text) -> "LineIndex":
+        """
+        Load the index of a text file, building (and saving) it first if it does not exist or it is stale.
+        :param text_file:
+        :return: The index.
+        """
+        if os.path.exists(LineIndex.get_index_file(text_file)):
+            res = LineIndex.load(text_file)
+            if res.file_size == os.path.getsize(text_file):
+                return res
+        res = LineIndex.build(text_file)
+        res.save()
+        return res
+
+    def __len__(self) -> int:
+        return len(self.starts) - 1
+
+
+class LineFile(object):
+    """
+    Memory mapped text file with random access to its lines.
+    """
+
+    def __init__(self, text_file: Text, index: Optional[LineIndex] = None, encoding: Text = "utf-8"):
+        """
+        :param text_file:
+        :param index: Line index of the file. It is loaded (or built) from its sidecar file by default.
+        :param encoding:
+        """
+        self.text_file = text_file
+        self.index = index if index is not None else LineIndex.load_or_build(text_file)
+        self.starts = self.index.starts
+        self.encoding = encoding
+        self._file = open(text_file, "rb")
+        if self.index.file_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = memoryview(self._mmap)
+        else:
+            self._mmap = None
+            self.buffer = memoryview(b"")
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get_bytes(self, i: int) -> memoryview:
+        """
+        :param i: Line number.
+        :return: The bytes of the line (without newline), as a view over the mapped file.
+        """
+        return self.buffer[self.starts[i]:self.starts[i + 1] - 1]
+
+    def __getitem__(self, i: int) -> Text:
+        return str(self.get_bytes(i), self.encoding)
+
+    def get_batch(self, start: int, stop: int) -> Tuple[memoryview, np.ndarray]:
+        """
+        Zero-copy slice of consecutive lines.
+        :param start:
+        :param stop:
+        :return: View over the bytes of the lines (newlines included) and the offsets of the lines in it (one more
+        than the number of lines; line j is view[offsets[j]:offsets[j + 1] - 1]).
+        """
+        _offsets = self.starts[start:stop + 1]
+        return self.buffer[_offsets[0]:min(_offsets[-1], len(self.buffer))], _offsets - _offsets[0]
+
+    def close(self):
+        """
+        Unmap the file. Views returned by get_bytes and get_batch must have been released.
+        """
+        self.buffer.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+
+class ParallelCorpus(object):
+    """
+    Aligned parallel corpus stored in two line files (line i of both files is the pair i).
+    """
+
+    def __init__(self, origin_text_file: Text, destination_text_file: Text, encoding: Text = "utf-8"):
+        """
+        :param origin_text_file:
+        :param destination_text_file:
+        :param encoding:
+        """
+        self.origin = LineFile(origin_text_file, encoding=encoding)
+        self.destination = LineFile(destination_text_file, encoding=encoding)
+        if len(self.origin) != len(self.destination):
+            self.close()
+            raise ValueError("Files {} and {} have a different number of lines ({} and {})".format(
+                origin_text_file, destination_text_file, len(self.origin), len(self.destination)))
+
+    def __len__(self) -> int:
+        return len(self.origin)
+
+    def __getitem__(self, i: int) -> Tuple[Text, Text]:
+        """
+        :param i: Pair number.
+        :return: Origin and destination texts.
+        """
+        return self.origin[i], self.destination[i]
+
+    def get_batch(self, start: int, stop: int) -> \
+            Tuple[Tuple[memoryview, np.ndarray], Tuple[memoryview, np.ndarray]]:
+        """
+        Zero-copy slice of consecutive pairs (see LineFile.get_batch).
+        :param start:
+        :param stop:
+        :return: Origin and destination (view, offsets) tuples.
+        """
+        return self.origin.get_batch(start, stop), self.destination.get_batch(start, stop)
+
+    def take(self, indexes: Union[Sequence[int], np.ndarray]) -> List[Tuple[Text, Text]]:
+        """
+        :param indexes: Pair numbers.
+        :return: The pairs.
+        """
+        return [(self.origin[i], self.destination[i]) for i in indexes]
+
+    def permutation(self, seed: Optional[int] = None) -> np.ndarray:
+        """
+        :param seed:
+        :return: Random permutation of the pair numbers.
+        """
+        return np.random.default_rng(seed).permutation(len(self))
+
+    def iter_batches(self, batch_size: int, shuffle: bool = False,
+                     seed: Optional[int] = None) -> Iterator[List[Tuple[Text, Text]]]:
+        """
+        Iterate over the corpus in batches of pairs.
+        :param batch_size:
+        :param shuffle: If True, pairs are visited in a random order (the same for the same seed).
+        :param seed:
+        :return: Iterator over lists of (origin, destination) tuples.
+        """
+        order = self.permutation(seed) if shuffle else None
+        for start in range(0, len(self), batch_size):
+            if order is None:
+                yield self.take(range(start, min(start + batch_size, len(self))))
+            else:
+                yield self.take(order[start:start + batch_size])
+
+    def __iter__(self) -> Iterator[Tuple[Text, Text]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def split(self, validation_fraction: float, seed: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Random train/validation split.
+        :param validation_fraction:
+        :param seed:
+        :return: Sorted train and validation pair numbers.
+        """
+        order = self.permutation(seed)
+        _num_validation = int(round(len(self) * validation_fraction))
+        return np.sort(order[_num_validation:]), np.sort(order[:_num_validation])
+
+    def write(self, indexes: Union[Sequence[int], np.ndarray], origin_text_file: Text, destination_text_file: Text):
+        """
+        Write a subset of the pairs to a new pair of line files, copying their bytes from the mapped files.
+        :param indexes: Pair numbers, in the order they are written.
+        :param origin_text_file:
+        :param destination_text_file:
+        """
+        with open(origin_text_file, "wb") as out_orig_fd, open(destination_text_file, "wb") as out_dest_fd:
+            for i in indexes:
+                out_orig_fd.write(self.origin.get_bytes(i))
+                out_orig_fd.write(b"\n")
+                out_dest_fd.write(self.destination.get_bytes(i))
+                out_dest_fd.write(b"\n")
+
+    def close(self):
+        self.origin.close()
+        self.destination.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split an aligned parallel corpus into train and validation "
+                                                 "subsets (files <file>.train and <file>.validation).")
+    parser.add_argument("origin_text_file",
+                        type=str,
+                        help="Origin language texts, one per line.")
+    parser.add_argument("destination_text_file",
+                        type=str,
+                        help="Destination language texts, one per line.")
+    parser.add_argument("--validation-fraction",
+                        type=float,
+                        default=0.01,
+                        help="Fraction of the pairs in the validation subset.")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="Seed of the random split.")
+    parser.add_argument("--shuffle",
+                        action="store_true",
+                        help="Write the pairs of every subset in random order (instead of corpus order).")
+    args = parser.parse_args()
+
+    with ParallelCorpus(args.origin_text_file, args.destination_text_file) as corpus:
+        print("Found {} pairs.".format(len(corpus)))
+        _rng = np.random.default_rng(args.seed)
+        for name, _indexes in zip(("train", "validation"), corpus.split(args.validation_fraction, seed=args.seed)):
+            if args.shuffle:
+                _indexes = _rng.permutation(_indexes)
+            corpus.write(_indexes, args.origin_text_file + "." + name, args.destination_text_file + "." + name)
+            print("Written {} {} pairs.".format(len(_indexes), name))
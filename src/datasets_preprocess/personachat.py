@@ -5,32 +5,184 @@
 #
 # @author: jpquiroga@gmail.com
 
+import os
 import json
-from typing import Text
+import itertools
+from typing import Text, Iterator, Iterable, Dict, Any, List, Optional
 from tqdm import tqdm
 from .translate import Translator
+from .delta import DeltaWriter, content_hash
+from .translation_store import apply_translations
 
 
-def translate_dataset(dataset_file: Text, destination_dataset_file: Text, translator: Translator):
+def iter_dataset(dataset_file: Text, chunk_size: int = 1 << 20) -> Iterator[Dict[Text, Any]]:
+    """
+    Parse the dialogues of a dataset one at a time, without loading the whole file. The dataset must be in the
+    Persona-Chat format (a json array of dialogues).
+    :param dataset_file: Location of the json file of the dataset.
+    :param chunk_size: Number of characters read at a time.
+    :return: Iterator over the dialogues.
+    """
+    decoder = json.JSONDecoder()
+    with open(dataset_file, "r") as f:
+        _buff = ""
+        _pos = 0
+        _started = False
+        _eof = False
+        while True:
+            # Skip whitespace and separators
+            while _pos < len(_buff) and (_buff[_pos].isspace() or (_started and _buff[_pos] == ",")):
+                _pos += 1
+            if _pos < len(_buff):
+                if not _started:
+                    if _buff[_pos] != "[":
+                        raise ValueError("{} is not a json array".format(dataset_file))
+                    _started = True
+                    _pos += 1
+                    continue
+                if _buff[_pos] == "]":
+                    return
+                try:
+                    obj, _end = decoder.raw_decode(_buff, _pos)
+                    yield obj
+                    _pos = _end
+                    continue
+                except json.JSONDecodeError:
+                    # The dialogue is not complete yet
+                    if _eof:
+                        raise
+            elif _eof:
+                raise ValueError("Unexpected end of file in {}".format(dataset_file))
+            data = f.read(max(chunk_size, len(_buff) - _pos))
+            _eof = len(data) == 0
+            _buff = _buff[_pos:] + data
+            _pos = 0
+
+
+def write_dataset(dialogues: Iterable[Dict[Text, Any]], destination_dataset_file: Text):
+    """
+    Write a dataset in the Persona-Chat format, one dialogue at a time. The output is the same as json.dump of the
+    list of dialogues. It is written to a temporary file, which replaces the destination file at the end (an
+    interrupted run keeps the previous destination file).
+    :param dialogues:
+    :param destination_dataset_file:
+    """
+    _tmp_file = destination_dataset_file + ".tmp"
+    try:
+        with open(_tmp_file, "w") as f:
+            f.write("[")
+            for i, d in enumerate(dialogues):
+                if i > 0:
+                    f.write(", ")
+                f.write(json.dumps(d))
+            f.write("]")
+    except BaseException:
+        os.remove(_tmp_file)
+        raise
+    os.replace(_tmp_file, destination_dataset_file)
+
+
+def _translate_dialogues(dialogues: List[Dict[Text, Any]], translator: Translator, batch_size: int):
+    # Every unique turn text is translated once, in batches
+    texts = list(dict.fromkeys(turn["text"] for d in dialogues for turn in d["dialog"]))
+    translations = {}
+    for i in range(0, len(texts), batch_size):
+        _batch = texts[i:i + batch_size]
+        translations.update(zip(_batch, translator.translate_batch(_batch)))
+    for d in dialogues:
+        for turn in d["dialog"]:
+            turn["text"] = translations[turn["text"]]
+
+
+def _iter_windows(dialogues: Iterable[Dict[Text, Any]], max_texts: int) -> Iterator[List[Dict[Text, Any]]]:
+    # Group consecutive dialogues until they have at least max_texts turns
+    _window = []
+    _num_texts = 0
+    for d in dialogues:
+        _window.append(d)
+        _num_texts += len(d["dialog"])
+        if _num_texts >= max_texts:
+            yield _window
+            _window = []
+            _num_texts = 0
+    if len(_window) > 0:
+        yield _window
+
+
+def translate_dataset(dataset_file: Text, destination_dataset_file: Text, translator: Translator,
+                      streaming: bool = False, tqdm_call: tqdm = tqdm, batch_size: int = 100,
+                      incremental: bool = False):
     """
     Translate a dataset. The dataset must be in the Persona-Chat format.
+    Turn texts are gathered and translated in batches (see Translator.translate_batch), every unique text once.
     :param dataset_file: Location of the json file of the dataset.
     :param destination_dataset_file: Location of the destination translated dataset.
     :param translator:
+    :param streaming: If True, dialogues are read, translated and written a few at a time (as many as needed to
+    fill a batch), so memory does not grow with the size of the dataset.
+    :param tqdm_call:
+    :param batch_size: Number of texts passed to every translate_batch call.
+    :param incremental: If True, only dialogues that changed since the previous run are translated, and the
+    translations of the other ones are copied from the previous destination file (see delta.DeltaWriter). Dialogues
+    are streamed.
     """
+    if incremental:
+        _translate_dataset_incremental(dataset_file, destination_dataset_file, translator, tqdm_call, batch_size)
+        return
+    if streaming:
+        def _translated_dialogues():
+            for _window in _iter_windows(tqdm_call(iter_dataset(dataset_file), desc="Translated dialogues"),
+                                         batch_size):
+                _translate_dialogues(_window, translator, batch_size)
+                for d in _window:
+                    yield d
+        write_dataset(_translated_dialogues(), destination_dataset_file)
+        return
     with open(dataset_file, "r") as f:
         dataset = json.load(f)
     # Dataset is a list of dictionaries, each of them corresponding to one dialogue.
     # Translate texts
-    for d in dataset:
-        dialogue = d["dialogue"]
-        for turn in dialogue:
-            turn["text"] = translator.translate(turn["text"])
+    _translate_dialogues(dataset, translator, batch_size)
     # Save translated dataset
     with open(destination_dataset_file, "w") as f:
         json.dump(dataset, f)
 
 
+def _translate_dataset_incremental(dataset_file: Text, destination_dataset_file: Text, translator: Translator,
+                                   tqdm_call: tqdm, batch_size: int):
+    fingerprint = "{} {}".format(type(translator).__name__, getattr(translator, "destination_language", ""))
+    with DeltaWriter(destination_dataset_file, fingerprint=fingerprint) as writer:
+        # Dialogues waiting to be written, in order (None for the ones copied from the previous output)
+        _pending = []
+        _num_texts = 0
+
+        def _flush():
+            _translate_dialogues([d for _, d in _pending if d is not None], translator, batch_size)
+            for h, d in _pending:
+                if writer.num_reused + writer.num_written > 0:
+                    writer.write(b", ")
+                if d is None:
+                    writer.copy_unit(h)
+                else:
+                    writer.write_unit(h, json.dumps(d).encode("utf-8"))
+
+        writer.write(b"[")
+        for d in tqdm_call(iter_dataset(dataset_file), desc="Dialogues"):
+            h = content_hash(json.dumps(d, sort_keys=True))
+            if writer.has_unit(h):
+                _pending.append((h, None))
+            else:
+                _pending.append((h, d))
+                _num_texts += len(d["dialog"])
+            if _num_texts >= batch_size or len(_pending) >= 100 * batch_size:
+                _flush()
+                _pending = []
+                _num_texts = 0
+        _flush()
+        writer.write(b"]")
+    print("Dialogues: {} reused, {} translated".format(writer.num_reused, writer.num_written))
+
+
 def get_texts_to_translate(dataset_file: Text, destination_texts_file: Text):
     """
     Get a list of texts to be translated from a Persona-Chat dataset and saves it as to a plain text file.
@@ -39,9 +191,7 @@ def get_texts_to_translate(dataset_file: Text, destination_texts_file: Text):
     :return: List of texts.
     """
     res = []
-    with open(dataset_file, "r") as f:
-        dataset = json.load(f)
-    for d in dataset:
+    for d in iter_dataset(dataset_file):
         dialogue = d["dialog"]
         for turn in dialogue:
             res.append(turn["text"])
@@ -56,7 +206,8 @@ def _normalize_text_line(text_line):
 
 
 def translate_dataset_from_files(dataset_file: Text, destination_dataset_file: Text, origin_texts_file: Text,
-                                 translated_texts_file: Text, tqdm_call: tqdm = tqdm):
+                                 translated_texts_file: Text, tqdm_call: tqdm = tqdm,
+                                 streaming: bool = False, window_size: int = 100000) -> Optional[List[Dict[Text, Any]]]:
     """
     Translate a dataset. The dataset must be in the Persona-Chat format.
     :param dataset_file: Location of the json file of the dataset.
@@ -64,24 +215,45 @@ def translate_dataset_from_files(dataset_file: Text, destination_dataset_file: T
     :param origin_texts_file: File containing the original texts.
     :param translated_texts_file: File containing the translated texts.
     :param tqdm_call:
-    :return: The new translated dataset as a json object.
+    :param streaming: If True, dialogues are read, translated and written in windows of about window_size turns,
+    so memory does not grow with the size of the dataset.
+    :param window_size: Number of turns translated at a time in streaming mode.
+    :return: The new translated dataset as a json object (None in streaming mode). Turns without translation get
+    None.
     """
-    with open(dataset_file, "r") as f:
-        # Dataset is a list of dictionaries, each of them corresponding to one dialogue.
-        dataset = json.load(f)
     # Load translated texts as a dictionary
     with open(origin_texts_file, "r") as f_o:
-        _orig_texts = (t for t in f_o)
+        _orig_texts = [t.rstrip("\n") for t in f_o]
     with open(translated_texts_file, "r") as f_t:
-        _trans_texts = (t for t in f_t)
+        _trans_texts = [t.rstrip("\n") for t in f_t]
     translation_dict = dict(zip(_orig_texts, _trans_texts))
+    # Number of turns without translation (counted, not kept, so streaming memory does not grow)
+    num_missing = 0
+
+    def _translate_window(dialogues):
+        nonlocal num_missing
+        _turns = [turn for d in dialogues for turn in d["dialog"]]
+        _translations, _ = apply_translations([_normalize_text_line(turn["text"]) for turn in _turns],
+                                              translation_dict)
+        for turn, _t in zip(_turns, _translations):
+            turn["text"] = _t
+        num_missing += int(_translations.isna().sum())
+        return dialogues
+
+    if streaming:
+        _windows = _iter_windows(tqdm_call(iter_dataset(dataset_file), desc="Translated dialogues"), window_size)
+        write_dataset(itertools.chain.from_iterable(_translate_window(w) for w in _windows),
+                      destination_dataset_file)
+        print("{} turns without translation".format(num_missing))
+        return None
+
+    with open(dataset_file, "r") as f:
+        # Dataset is a list of dictionaries, each of them corresponding to one dialogue.
+        dataset = json.load(f)
 
     # Translate texts
-    for d in tqdm_call(dataset):
-        dialogue = d["dialogue"]
-        for turn in dialogue:
-            _t = _normalize_text_line(turn["text"])
-            turn["text"] = translation_dict(_t)
+    _translate_window(tqdm_call(dataset))
+    print("{} turns without translation".format(num_missing))
 
     # Save translated dataset
     with open(destination_dataset_file, "w") as f:
@@ -0,0 +1,505 @@
+#
+# Streaming extract -> translate -> write pipeline.
+#
+# The stages of a dataset translation run concurrently, connected by bounded queues:
+#    - reader: parses the dataset into units (dialogues, movie lines, link groups) and groups them in windows,
+#    - lookup: looks the texts of every window up in the translation cache (dictionary or TranslationStore),
+#    - translation: translates the texts not found in the cache, in batches (one or more threads),
+#    - writer: writes the translated units, in dataset order.
+# A full queue blocks the stage that feeds it, so memory is bounded and the wall-clock time is close to the one of
+# the slowest stage (usually the translation service).
+#
+# Usage (from the src directory):
+#    python -m datasets_preprocess.pipeline personachat dataset.json --output dataset_es.json --subscription-key KEY
+#        [--translation-db translations.db] [--batch-size 100] [--threads 4]
+#
+# @author: jpquiroga@gmail.com
+
+import time
+import queue
+import argparse
+import threading
+from tqdm import tqdm
+from typing import Text, List, Dict, Any, Iterator, Iterable, Tuple, Optional, Callable, MutableMapping
+
+from .translate import Translator
+from .metrics import Metrics
+from .translation_store import TranslationStore, normalize_text
+from .personachat import iter_dataset, write_dataset
+from .cornell_movies import DELIM, CORNELL_FILE_COLUMNS
+from .opensubtitles import iter_link_groups, align_link_group, iter_aligned_texts, SentenceMapCache, PairFilter, \
+    LinkGroupIndex
+
+
+class PipelineDataset(object):
+    """
+    Base class of the datasets of a TranslationPipeline.
+    """
+
+    def iter_units(self) -> Iterator[Tuple[Any, List[Text]]]:
+        """
+        Parse the dataset.
+        :return: Iterator over (unit, texts to translate) tuples, in dataset order.
+        """
+        raise NotImplementedError("PipelineDataset is an abstract class. This method needs to be implemented!")
+
+    def write(self, units: Iterable[Tuple[Any, List[Optional[Text]]]]):
+        """
+        Write the translated dataset.
+        :param units: (unit, translations of its texts) tuples, in dataset order. Texts without translation get None.
+        """
+        raise NotImplementedError("PipelineDataset is an abstract class. This method needs to be implemented!")
+
+
+class PersonaChatDataset(PipelineDataset):
+    """
+    Persona-Chat dataset (see personachat.py). The turns of every dialogue are translated.
+    """
+
+    def __init__(self, dataset_file: Text, destination_dataset_file: Text):
+        self.dataset_file = dataset_file
+        self.destination_dataset_file = destination_dataset_file
+
+    def iter_units(self) -> Iterator[Tuple[Any, List[Text]]]:
+        for d in iter_dataset(self.dataset_file):
+            yield d, [turn["text"] for turn in d["dialog"]]
+
+    def write(self, units: Iterable[Tuple[Any, List[Optional[Text]]]]):
+
+        def _dialogues():
+            for d, translations in units:
+                for turn, t in zip(d["dialog"], translations):
+                    turn["text"] = t
+                yield d
+
+        write_dataset(_dialogues(), self.destination_dataset_file)
+
+
+class CornellMovieLinesDataset(PipelineDataset):
+    """
+    movie_lines.txt file of the Cornell movies dialogues corpus (see cornell_movies.py). The output has the same
+    format, with translated utterances (utf-8 encoded).
+    """
+
+    def __init__(self, movie_lines_file: Text, destination_file: Text, encoding: Text = "iso-8859-1"):
+        self.movie_lines_file = movie_lines_file
+        self.destination_file = destination_file
+        self.encoding = encoding
+
+    def iter_units(self) -> Iterator[Tuple[Any, List[Text]]]:
+        with open(self.movie_lines_file, encoding=self.encoding, errors="ignore") as f:
+            for l in f:
+                _fields = l.rstrip("\r\n").split(DELIM)
+                if len(_fields) == len(CORNELL_FILE_COLUMNS["movie_lines"]):
+                    yield _fields, [_fields[-1].strip()]
+                else:
+                    yield _fields, []
+
+    def write(self, units: Iterable[Tuple[Any, List[Optional[Text]]]]):
+        with open(self.destination_file, "w", encoding="utf-8") as f:
+            for _fields, translations in units:
+                if len(translations) > 0:
+                    _fields[-1] = " " + (translations[0] if translations[0] is not None else "")
+                f.write(DELIM.join(_fields) + "\n")
+
+
+class OpenSubtitlesDataset(PipelineDataset):
+    """
+    Aligned texts of an OpenSubtitles alignment file (see opensubtitles.py). The origin texts are translated, and
+    the aligned origin, destination and translated texts are written to three line files.
+    """
+
+    def __init__(self, alignment_file: Text, base_dir: Text, origin_output_text_file: Text,
+                 destination_output_text_file: Text, translated_output_text_file: Text,
+                 sentence_reader: Text = "etree", cache_max_bytes: int = 256 << 20,
+                 pair_filter: Optional[PairFilter] = None, num_workers: int = 1, use_index: bool = True,
+                 metrics: Optional[Metrics] = None):
+        """
+        :param alignment_file: The file containing the alignment information in XCES format.
+        :param base_dir: The base dir where subtitles data is located for both languages.
+        :param origin_output_text_file:
+        :param destination_output_text_file:
+        :param translated_output_text_file: Translations of the origin texts.
+        :param sentence_reader: Name of the sentence reader (see opensubtitles.SENTENCE_READERS).
+        :param cache_max_bytes: Memory bound of the sentence map cache (0 disables the cache).
+        :param pair_filter: Filter applied to the aligned pairs before they are translated.
+        :param num_workers: Number of worker processes aligning the link groups (see opensubtitles.iter_aligned_texts).
+        If 0, link groups are aligned by the reader thread.
+        :param use_index: If True (and num_workers > 0), the link group index of the alignment file is used (built
+        first if it does not exist or it is stale).
+        :param metrics: Metrics registry where link group, text and cache counts are recorded.
+        """
+        self.alignment_file = alignment_file
+        self.base_dir = base_dir
+        self.origin_output_text_file = origin_output_text_file
+        self.destination_output_text_file = destination_output_text_file
+        self.translated_output_text_file = translated_output_text_file
+        self.sentence_reader = sentence_reader
+        self.cache_max_bytes = cache_max_bytes
+        self.pair_filter = pair_filter
+        self.num_workers = num_workers
+        self.use_index = use_index
+        self.metrics = metrics
+
+    def _iter_aligned_texts(self) -> Iterator[Tuple[List[Text], List[Text]]]:
+        if self.num_workers > 0:
+            index = LinkGroupIndex.load_or_build(self.alignment_file) if self.use_index else None
+            # Progress is shown by the pipeline writer
+            yield from iter_aligned_texts(self.alignment_file, self.base_dir, self.num_workers, index=index,
+                                          sentence_reader=self.sentence_reader, cache_max_bytes=self.cache_max_bytes,
+                                          metrics=self.metrics, tqdm_call=lambda x, **kwargs: x)
+            return
+        cache = SentenceMapCache(self.cache_max_bytes) if self.cache_max_bytes > 0 else None
+        for g in iter_link_groups(self.alignment_file):
+            yield align_link_group(self.base_dir, *g, sentence_reader=self.sentence_reader, cache=cache)
+
+    def iter_units(self) -> Iterator[Tuple[Any, List[Text]]]:
+        for text_orig, text_dest in self._iter_aligned_texts():
+            if self.pair_filter is not None:
+                text_orig, text_dest = self.pair_filter.filter(text_orig, text_dest)
+            yield (text_orig, text_dest), text_orig
+
+    def write(self, units: Iterable[Tuple[Any, List[Optional[Text]]]]):
+        with open(self.origin_output_text_file, "w") as out_orig_fd, \
+                open(self.destination_output_text_file, "w") as out_dest_fd, \
+                open(self.translated_output_text_file, "w") as out_trans_fd:
+            for (text_orig, text_dest), translations in units:
+                for t in text_orig:
+                    out_orig_fd.write(t + "\n")
+                for t in text_dest:
+                    out_dest_fd.write(t + "\n")
+                for t in translations:
+                    out_trans_fd.write((t if t is not None else "").replace("\n", " ") + "\n")
+
+
+class _Stopped(Exception):
+    pass
+
+
+class _InFlight(object):
+    """
+    Texts being translated by a translation thread. The event is set when their translations (keyed by normalized
+    text) are available.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.translations = {}
+
+
+# End of stream marker
+_END = object()
+
+
+class TranslationPipeline(object):
+    """
+    Streaming translation of a dataset, with overlapping parsing, cache lookup, translation and writing stages.
+    """
+
+    def __init__(self, dataset: PipelineDataset, translator: Translator,
+                 translation_dict: Optional[MutableMapping[Text, Text]] = None, batch_size: int = 100,
+                 window_size: int = 1000, queue_size: int = 4, num_translation_threads: int = 1,
+                 metrics: Optional[Metrics] = None, tqdm_call: Optional[Callable] = tqdm):
+        """
+        :param dataset:
+        :param translator:
+        :param translation_dict: Translation cache (dictionary or TranslationStore). New translations are added to
+        it. An empty dictionary is used by default.
+        :param batch_size: Number of texts passed to every translate_batch call.
+        :param window_size: Number of texts of the windows of units passed between stages.
+        :param queue_size: Maximum number of windows waiting between two stages.
+        :param num_translation_threads: Number of windows translated at the same time.
+        :param metrics: Metrics registry where the busy time of every stage and the text counts are recorded.
+        :param tqdm_call:
+        """
+        self.dataset = dataset
+        self.translator = translator
+        self.translation_dict = translation_dict if translation_dict is not None else {}
+        self.batch_size = batch_size
+        self.window_size = window_size
+        self.queue_size = queue_size
+        self.num_translation_threads = num_translation_threads
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.tqdm_call = tqdm_call
+        self._stop = threading.Event()
+        self._errors = []
+        self._busy_seconds = {}
+        self._busy_lock = threading.Lock()
+        # Texts being translated (keyed by normalized text, as in a TranslationStore)
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    def _put(self, q: queue.Queue, item: Any):
+        # Blocks while the queue is full (backpressure), unless the pipeline is stopped
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped()
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        raise _Stopped()
+
+    def _add_busy_time(self, stage: Text, seconds: float):
+        with self._busy_lock:
+            self._busy_seconds[stage] = self._busy_seconds.get(stage, 0.0) + seconds
+        self.metrics.inc("pipeline_stage_busy_seconds_total", seconds, stage=stage)
+
+    def _run_stage(self, target: Callable, *args):
+        # Errors stop the whole pipeline, and they are raised again by run
+        try:
+            target(*args)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    def _lookup_cache(self, texts: List[Text]) -> Dict[Text, Text]:
+        if isinstance(self.translation_dict, TranslationStore):
+            return self.translation_dict.get_many(texts)
+        res = {t: self.translation_dict[t] for t in texts if t in self.translation_dict}
+        # Texts are also looked up normalized, as a TranslationStore does
+        for t in texts:
+            if t not in res:
+                _key = normalize_text(t)
+                if _key in self.translation_dict:
+                    res[t] = self.translation_dict[_key]
+        return res
+
+    def _read(self, output_queue: queue.Queue):
+        _window = []
+        _num_texts = 0
+        _start = time.perf_counter()
+        for unit, texts in self.dataset.iter_units():
+            _window.append((unit, texts))
+            _num_texts += len(texts)
+            if _num_texts >= self.window_size:
+                self._add_busy_time("read", time.perf_counter() - _start)
+                self._put(output_queue, _window)
+                _start = time.perf_counter()
+                _window = []
+                _num_texts = 0
+        self._add_busy_time("read", time.perf_counter() - _start)
+        if len(_window) > 0:
+            self._put(output_queue, _window)
+        self._put(output_queue, _END)
+
+    def _lookup(self, input_queue: queue.Queue, output_queue: queue.Queue):
+        # Windows are numbered, so the writer can restore their order
+        seq = 0
+        while True:
+            _window = self._get(input_queue)
+            if _window is _END:
+                # One end marker per translation thread
+                for _ in range(self.num_translation_threads):
+                    self._put(output_queue, _END)
+                return
+            _start = time.perf_counter()
+            texts = list(dict.fromkeys(t for _, _texts in _window for t in _texts))
+            translations = self._lookup_cache(texts)
+            missing = [t for t in texts if t not in translations]
+            self.metrics.inc("pipeline_cache_hits_total", len(translations))
+            self.metrics.inc("pipeline_cache_misses_total", len(missing))
+            self._add_busy_time("lookup", time.perf_counter() - _start)
+            self._put(output_queue, (seq, _window, translations, missing))
+            seq += 1
+
+    def _translate(self, input_queue: queue.Queue, output_queue: queue.Queue):
+        while True:
+            item = self._get(input_queue)
+            if item is _END:
+                self._put(output_queue, _END)
+                return
+            seq, _window, translations, missing = item
+            _start = time.perf_counter()
+            # The lookup stage runs ahead of translation: texts missing then may have been translated (or be being
+            # translated) for a previous window since. Texts are deduplicated by normalized text, and every one is
+            # sent only once.
+            _own = _InFlight()
+            with self._in_flight_lock:
+                _found = self._lookup_cache(missing)
+                _by_key = {}
+                for t in missing:
+                    if t not in _found:
+                        _by_key.setdefault(normalize_text(t), []).append(t)
+                _waits = {k: self._in_flight[k] for k in _by_key if k in self._in_flight}
+                _to_send = [_texts[0] for k, _texts in _by_key.items() if k not in self._in_flight]
+                for t in _to_send:
+                    self._in_flight[normalize_text(t)] = _own
+            translations.update(_found)
+            _new_translations = {}
+            try:
+                for i in range(0, len(_to_send), self.batch_size):
+                    _batch = _to_send[i:i + self.batch_size]
+                    _new_translations.update(zip(_batch, self.translator.translate_batch(_batch)))
+                if len(_new_translations) > 0:
+                    self.translation_dict.update(_new_translations)
+                _own.translations.update((normalize_text(t), r) for t, r in _new_translations.items())
+            finally:
+                with self._in_flight_lock:
+                    for t in _to_send:
+                        del self._in_flight[normalize_text(t)]
+                _own.event.set()
+            for _in_flight in {id(f): f for f in _waits.values()}.values():
+                while not _in_flight.event.wait(0.1):
+                    if self._stop.is_set():
+                        raise _Stopped()
+            for k, _texts in _by_key.items():
+                _translation = (_waits[k] if k in _waits else _own).translations.get(k)
+                if _translation is not None:
+                    translations.update((t, _translation) for t in _texts)
+            self.metrics.inc("pipeline_translated_texts_total", len(_new_translations))
+            self.metrics.inc("pipeline_deduplicated_texts_total", len(missing) - len(_to_send))
+            self._add_busy_time("translate", time.perf_counter() - _start)
+            self._put(output_queue, (seq, _window, translations))
+
+    def _iter_translated(self, input_queue: queue.Queue) -> Iterator[Tuple[Any, List[Optional[Text]]]]:
+        _pending = {}
+        _next_seq = 0
+        _num_ended = 0
+        while _num_ended < self.num_translation_threads:
+            item = self._get(input_queue)
+            if item is _END:
+                _num_ended += 1
+                continue
+            _pending[item[0]] = item
+            while _next_seq in _pending:
+                _, _window, translations = _pending.pop(_next_seq)
+                _next_seq += 1
+                _start = time.perf_counter()
+                for unit, texts in _window:
+                    yield unit, [translations.get(t) for t in texts]
+                self._add_busy_time("write", time.perf_counter() - _start)
+                self.metrics.inc("pipeline_units_total", len(_window))
+
+    def run(self) -> Dict[Text, float]:
+        """
+        Translate the dataset.
+        :return: Wall-clock time and busy time (seconds) of every stage. The busy time of the write stage includes
+        the time the dataset writer spends in its own code between units.
+        """
+        self._stop.clear()
+        self._errors = []
+        self._busy_seconds = {}
+        self._in_flight = {}
+        _queues = [queue.Queue(self.queue_size) for _ in range(3)]
+        threads = [threading.Thread(target=self._run_stage, args=(self._read, _queues[0]), daemon=True),
+                   threading.Thread(target=self._run_stage, args=(self._lookup, _queues[0], _queues[1]), daemon=True)]
+        threads += [threading.Thread(target=self._run_stage, args=(self._translate, _queues[1], _queues[2]),
+                                     daemon=True) for _ in range(self.num_translation_threads)]
+        _start = time.perf_counter()
+        for t in threads:
+            t.start()
+        try:
+            self.dataset.write(self.tqdm_call(self._iter_translated(_queues[2]), desc="Translated units"))
+        except _Stopped:
+            pass
+        finally:
+            self._stop.set()
+            for t in threads:
+                t.join()
+        if len(self._errors) > 0:
+            raise self._errors[0]
+        res = {"wall": time.perf_counter() - _start}
+        res.update(self._busy_seconds)
+        return res
+
+
+if __name__ == "__main__":
+    from .azure_translator import AzureTranslator
+
+    parser = argparse.ArgumentParser(description="Translate a dataset with a streaming pipeline (parsing, "
+                                                 "translation cache lookup, translation and writing overlap).")
+    parser.add_argument("dataset_type",
+                        type=str,
+                        choices=["personachat", "cornell", "opensubtitles"],
+                        help="Type of the dataset.")
+    parser.add_argument("input",
+                        type=str,
+                        nargs="+",
+                        help="personachat: <dataset.json>; cornell: <movie_lines.txt>; opensubtitles: "
+                             "<alignment_file> <base_dir>.")
+    parser.add_argument("--output",
+                        type=str,
+                        nargs="+",
+                        required=True,
+                        help="personachat and cornell: <destination_file>; opensubtitles: <origin_output_file> "
+                             "<destination_output_file> <translated_output_file>.")
+    parser.add_argument("--subscription-key",
+                        type=str,
+                        required=True,
+                        help="Azure Translator subscription key.")
+    parser.add_argument("--origin-language",
+                        type=str,
+                        default="en")
+    parser.add_argument("--destination-language",
+                        type=str,
+                        default="es")
+    parser.add_argument("--base-url",
+                        type=str,
+                        default="https://api.cognitive.microsofttranslator.com",
+                        help="Base url of the translation service.")
+    parser.add_argument("--translation-db",
+                        type=str,
+                        default=None,
+                        help="Translation store (SQLite database) used as translation cache. New translations are "
+                             "added to it.")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=100,
+                        help="Number of texts per translation request.")
+    parser.add_argument("--window-size",
+                        type=int,
+                        default=1000,
+                        help="Number of texts passed between stages at a time.")
+    parser.add_argument("--queue-size",
+                        type=int,
+                        default=4,
+                        help="Maximum number of windows waiting between two stages.")
+    parser.add_argument("--threads",
+                        type=int,
+                        default=1,
+                        help="Number of translation threads.")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="opensubtitles: number of worker processes aligning the link groups (0 aligns them in "
+                             "the reader thread).")
+    parser.add_argument("--metrics-file",
+                        type=str,
+                        default=None,
+                        help="File where the pipeline and translation metrics are dumped at the end (json if the "
+                             "extension is .json, Prometheus text format otherwise).")
+    args = parser.parse_args()
+
+    metrics = Metrics()
+    if args.dataset_type == "personachat":
+        dataset = PersonaChatDataset(args.input[0], args.output[0])
+    elif args.dataset_type == "cornell":
+        dataset = CornellMovieLinesDataset(args.input[0], args.output[0])
+    else:
+        dataset = OpenSubtitlesDataset(args.input[0], args.input[1], *args.output[:3], num_workers=args.workers,
+                                       metrics=metrics)
+    translator = AzureTranslator(args.subscription_key, origin_language=args.origin_language,
+                                 destination_language=args.destination_language, base_url=args.base_url,
+                                 metrics=metrics)
+    translation_dict = TranslationStore(args.translation_db, origin_language=args.origin_language,
+                                        destination_language=args.destination_language) \
+        if args.translation_db is not None else None
+    pipeline = TranslationPipeline(dataset, translator, translation_dict=translation_dict,
+                                   batch_size=args.batch_size, window_size=args.window_size,
+                                   queue_size=args.queue_size, num_translation_threads=args.threads, metrics=metrics)
+    stats = pipeline.run()
+    print("Stage times (seconds): {}".format(", ".join("{} {:.1f}".format(k, v) for k, v in stats.items())))
+    if translation_dict is not None:
+        translation_dict.close()
+    if args.metrics_file is not None:
+        metrics.dump(args.metrics_file)
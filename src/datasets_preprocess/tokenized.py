@@ -0,0 +1,298 @@
+#
+# Tokenized binary export of text corpora (one text per line, e.g. the outputs of opensubtitles.py or the
+# translated Cornell and Persona-Chat texts).
+#
+# Every text file is exported to two NumPy arrays: the flat token ids of all the texts (<prefix>.ids.npy, with the
+# smallest unsigned dtype for the vocabulary size) and the offsets of every text in them (<prefix>.offsets.npy), so
+# training loaders can memory map them and get every text as a zero-copy slice.
+#
+# @author: jpquiroga@gmail.com
+
+import os
+import re
+import shutil
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+from collections import Counter
+from functools import partial
+from tqdm import tqdm
+from typing import Text, List, Iterable, Iterator, Optional, Callable, Tuple
+
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+PAD_TOKEN = "<pad>"
+UNK_TOKEN = "<unk>"
+BOS_TOKEN = "<s>"
+EOS_TOKEN = "</s>"
+SPECIAL_TOKENS = [PAD_TOKEN, UNK_TOKEN, BOS_TOKEN, EOS_TOKEN]
+
+
+def tokenize(text: Text, lowercase: bool = False) -> List[Text]:
+    """
+    Split a text into words and punctuation marks.
+    :param text:
+    :param lowercase:
+    :return: List of tokens.
+    """
+    if lowercase:
+        text = text.lower()
+    return _TOKEN_PATTERN.findall(text)
+
+
+def _iter_line_chunks(text_file: Text, chunk_size: int) -> Iterator[List[Text]]:
+    with open(text_file) as f:
+        while True:
+            _chunk = [l.rstrip("\n") for l in itertools.islice(f, chunk_size)]
+            if len(_chunk) == 0:
+                break
+            yield _chunk
+
+
+def _count_tokens(lowercase: bool, texts: List[Text]) -> Counter:
+    res = Counter()
+    for t in texts:
+        res.update(tokenize(t, lowercase=lowercase))
+    return res
+
+
+class Vocabulary(object):
+    """
+    Token <-> id mapping. The special tokens (see SPECIAL_TOKENS) take the first ids.
+    """
+
+    def __init__(self, tokens: List[Text], lowercase: bool = False):
+        """
+        :param tokens: Tokens, in id order (special tokens first).
+        :param lowercase: If True, texts are lower cased before tokenization.
+        """
+        self.tokens = tokens
+        self.lowercase = lowercase
+        self.token_ids = {t: i for i, t in enumerate(tokens)}
+        self.unk_id = self.token_ids[UNK_TOKEN]
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    @property
+    def dtype(self) -> np.dtype:
+        """
+        Smallest unsigned integer type able to hold all the token ids.
+        """
+        return np.dtype(np.uint16) if len(self) <= np.iinfo(np.uint16).max + 1 else np.dtype(np.uint32)
+
+    @staticmethod
+    def build(text_files: List[Text], max_size: Optional[int] = None, min_count: int = 1, lowercase: bool = False,
+              num_workers: int = 1, chunk_size: int = 100000, tqdm_call: Optional[Callable] = tqdm) -> "Vocabulary":
+        """
+        Build a vocabulary with the most frequent tokens of some text files.
+        :param text_files: Files with one text per line.
+        :param max_size: Maximum number of tokens (special tokens included).
+        :param min_count: Minimum number of occurrences of a token.
+        :param lowercase:
+        :param num_workers: Number of worker processes counting tokens.
+        :param chunk_size: Number of lines handed out to a worker at a time.
+        :param tqdm_call:
+        :return: The vocabulary (tokens by decreasing count, then alphabetically).
+        """
+        counts = Counter()
+        _chunks = itertools.chain.from_iterable(_iter_line_chunks(f, chunk_size) for f in text_files)
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers) as pool:
+                for c in tqdm_call(pool.imap(partial(_count_tokens, lowercase), _chunks),
+                                   desc="Counting tokens"):
+                    counts.update(c)
+        else:
+            for _chunk in tqdm_call(_chunks, desc="Counting tokens"):
+                counts.update(_count_tokens(lowercase, _chunk))
+        for t in SPECIAL_TOKENS:
+            counts.pop(t, None)
+        # Ties are sorted by token, so ids do not depend on the counting order
+        tokens = [t for t, c in sorted(counts.items(), key=lambda x: (-x[1], x[0])) if c >= min_count]
+        if max_size is not None:
+            tokens = tokens[:max(0, max_size - len(SPECIAL_TOKENS))]
+        return Vocabulary(SPECIAL_TOKENS + tokens, lowercase=lowercase)
+
+    def save(self, vocab_file: Text):
+        """
+        Save the vocabulary (one token per line, in id order; the first line holds the options).
+        :param vocab_file:
+        """
+        with open(vocab_file, "w") as f:
+            f.write("#lowercase={}\n".format(int(self.lowercase)))
+            for t in self.tokens:
+                f.write(t + "\n")
+
+    @staticmethod
+    def load(vocab_file: Text) -> "Vocabulary":
+        with open(vocab_file) as f:
+            _options = f.readline()
+            tokens = [l.rstrip("\n") for l in f]
+        return Vocabulary(tokens, lowercase=_options.strip() == "#lowercase=1")
+
+    def encode(self, text: Text) -> List[int]:
+        """
+        :param text:
+        :return: Token ids of the text (unknown tokens are mapped to the <unk> id).
+        """
+        return [self.token_ids.get(t, self.unk_id) for t in tokenize(text, lowercase=self.lowercase)]
+
+    def decode(self, ids: Iterable[int]) -> List[Text]:
+        """
+        :param ids:
+        :return: Tokens of the ids.
+        """
+        return [self.tokens[i] for i in ids]
+
+
+# Vocabulary of every worker process
+_worker_vocabulary = None
+
+
+def _init_worker(vocabulary: Vocabulary):
+    global _worker_vocabulary
+    _worker_vocabulary = vocabulary
+
+
+def _encode_chunk(texts: List[Text]) -> Tuple[np.ndarray, np.ndarray]:
+    _ids = [_worker_vocabulary.encode(t) for t in texts]
+    return np.fromiter(itertools.chain.from_iterable(_ids), dtype=_worker_vocabulary.dtype), \
+        np.array([len(i) for i in _ids], dtype=np.int64)
+
+
+def export_tokenized(text_file: Text, vocabulary: Vocabulary, output_prefix: Text, num_workers: int = 1,
+                     chunk_size: int = 100000, tqdm_call: Optional[Callable] = tqdm) -> Tuple[int, int]:
+    """
+    Tokenize a text file and write <output_prefix>.ids.npy (flat token ids) and <output_prefix>.offsets.npy
+    (offsets of every text in the ids array, one more than the number of texts).
+    Chunks of texts are tokenized in parallel, and token ids are streamed to disk, so memory does not grow with the
+    size of the file.
+
+    :param text_file: File with one text per line.
+    :param vocabulary:
+    :param output_prefix:
+    :param num_workers: Number of worker processes.
+    :param chunk_size: Number of lines handed out to a worker at a time.
+    :param tqdm_call:
+    :return: Number of texts and tokens.
+    """
+    _raw_file = output_prefix + ".ids.raw"
+    lengths = []
+    num_tokens = 0
+    _chunks = _iter_line_chunks(text_file, chunk_size)
+    with open(_raw_file, "wb") as f:
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(vocabulary,)) as pool:
+                for _ids, _lengths in tqdm_call(pool.imap(_encode_chunk, _chunks), desc="Tokenized chunks"):
+                    f.write(_ids.tobytes())
+                    lengths.append(_lengths)
+                    num_tokens += len(_ids)
+        else:
+            _init_worker(vocabulary)
+            for _ids, _lengths in tqdm_call(map(_encode_chunk, _chunks), desc="Tokenized chunks"):
+                f.write(_ids.tobytes())
+                lengths.append(_lengths)
+                num_tokens += len(_ids)
+    # The ids are copied after a .npy header, now that their number is known
+    with open(output_prefix + ".ids.npy", "wb") as f, open(_raw_file, "rb") as f_raw:
+        np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(vocabulary.dtype),
+                                                 "fortran_order": False, "shape": (num_tokens,)})
+        shutil.copyfileobj(f_raw, f, 1 << 24)
+    os.remove(_raw_file)
+    offsets = np.zeros(sum(len(l) for l in lengths) + 1, dtype=np.int64)
+    if len(lengths) > 0:
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+    np.save(output_prefix + ".offsets.npy", offsets)
+    return len(offsets) - 1, num_tokens
+
+
+class TokenizedCorpus(object):
+    """
+    Memory mapped tokenized export (see export_tokenized).
+    """
+
+    def __init__(self, output_prefix: Text):
+        self.ids = np.load(output_prefix + ".ids.npy", mmap_mode="r")
+        self.offsets = np.load(output_prefix + ".offsets.npy", mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        """
+        :param i: Text number.
+        :return: Token ids of the text (a view over the mapped file).
+        """
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def get_batch(self, start: int, stop: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Zero-copy slice of consecutive texts.
+        :param start:
+        :param stop:
+        :return: Token ids of the texts and their offsets in them (one more than the number of texts).
+        """
+        _offsets = self.offsets[start:stop + 1]
+        return self.ids[_offsets[0]:_offsets[-1]], _offsets - _offsets[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokenize text files (one text per line) and export them as "
+                                                 "NumPy token id and offset arrays.")
+    parser.add_argument("text_files",
+                        type=str,
+                        nargs="+",
+                        help="Text files to export (e.g. en.txt es.txt). Every file gets its own vocabulary, "
+                             "unless --shared-vocab is given.")
+    parser.add_argument("--output-dir",
+                        type=str,
+                        default=".",
+                        help="Directory of the exported files (<name>.ids.npy, <name>.offsets.npy and "
+                             "<name>.vocab).")
+    parser.add_argument("--shared-vocab",
+                        action="store_true",
+                        help="Use a single vocabulary (vocab.txt) for all the files.")
+    parser.add_argument("--vocab-size",
+                        type=int,
+                        default=32000,
+                        help="Maximum vocabulary size. Existing vocabulary files are loaded instead of built.")
+    parser.add_argument("--min-count",
+                        type=int,
+                        default=2,
+                        help="Minimum number of occurrences of a token to be in the vocabulary.")
+    parser.add_argument("--lowercase",
+                        action="store_true",
+                        help="Lower case texts before tokenization.")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of worker processes.")
+    parser.add_argument("--chunk-size",
+                        type=int,
+                        default=100000,
+                        help="Number of lines handed out to a worker at a time.")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    def _get_vocabulary(vocab_file, text_files):
+        if os.path.exists(vocab_file):
+            print("Loading vocabulary {}".format(vocab_file))
+            return Vocabulary.load(vocab_file)
+        res = Vocabulary.build(text_files, max_size=args.vocab_size, min_count=args.min_count,
+                               lowercase=args.lowercase, num_workers=args.workers, chunk_size=args.chunk_size)
+        res.save(vocab_file)
+        print("Vocabulary of {} tokens saved to {}".format(len(res), vocab_file))
+        return res
+
+    shared_vocabulary = _get_vocabulary(os.path.join(args.output_dir, "vocab.txt"), args.text_files) \
+        if args.shared_vocab else None
+    for text_file in args.text_files:
+        name = os.path.basename(text_file)
+        vocabulary = shared_vocabulary if shared_vocabulary is not None else \
+            _get_vocabulary(os.path.join(args.output_dir, name + ".vocab"), [text_file])
+        num_texts, num_tokens = export_tokenized(text_file, vocabulary, os.path.join(args.output_dir, name),
+                                                 num_workers=args.workers, chunk_size=args.chunk_size)
+        print("Exported {}: {} texts, {} tokens ({})".format(text_file, num_texts, num_tokens, vocabulary.dtype))
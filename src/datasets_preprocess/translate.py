@@ -2,7 +2,9 @@
 #
 # @author: jpquiroga@gmail.com
 
-from typing import Text
+import asyncio
+from functools import partial
+from typing import Text, List
 
 
 class Translator(object):
@@ -18,3 +20,24 @@ class Translator(object):
         :return: Translated text.
         """
         raise NotImplementedError("Translator is an abstract class. This method needs to be implemented!")
+
+    def translate_batch(self, texts: List[Text], **kwargs) -> List[Text]:
+        """
+        Translate several texts. By default, texts are translated one by one with translate; networked translators
+        should override it to translate them with as few requests as possible.
+        :param texts: Texts to translate
+        :param kwargs:
+        :return: Translated texts, in the same order.
+        """
+        return [self.translate(t, **kwargs) for t in texts]
+
+    async def translate_batch_async(self, texts: List[Text], **kwargs) -> List[Text]:
+        """
+        Awaitable version of translate_batch. By default, translate_batch is run in the default executor of the
+        running event loop.
+        :param texts: Texts to translate
+        :param kwargs:
+        :return: Translated texts, in the same order.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(self.translate_batch, texts, **kwargs))
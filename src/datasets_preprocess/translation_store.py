@@ -0,0 +1,241 @@
+# Persistent translation memory.
+#
+# Translations are stored in a SQLite database, keyed by (origin language, destination language, normalized text),
+# so they can be looked up without loading the whole translation history into memory.
+#
+# Translations (from a store or any dictionary) are applied in bulk to DataFrame columns and line files with
+# apply_translations and apply_translations_to_file.
+#
+# @author: jpquiroga@gmail.com
+
+import itertools
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from collections.abc import MutableMapping
+from tqdm import tqdm
+from typing import Text, Optional, Callable, Dict, Iterable, Iterator, Tuple, Union, Mapping, List
+
+
+_SEPARATOR = "$___$___$"
+
+_CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS translations (
+        origin_language TEXT NOT NULL,
+        destination_language TEXT NOT NULL,
+        text TEXT NOT NULL,
+        translation TEXT NOT NULL,
+        PRIMARY KEY (origin_language, destination_language, text)
+    ) WITHOUT ROWID
+"""
+
+
+def normalize_text(text: Text) -> Text:
+    """
+    Normalize a text to be used as a translation key (surrounding whitespace is removed and inner whitespace runs
+    are collapsed to a single space).
+    :param text:
+    :return: Normalized text.
+    """
+    return " ".join(text.split())
+
+
+class TranslationStore(MutableMapping):
+    """
+    Dictionary-like persistent translation memory for one language pair.
+
+    It can be used wherever a translation dictionary is expected (e.g. AzureTranslator.translate_with_dict).
+    Keys are normalized with normalize_text.
+    """
+
+    def __init__(self, db_file: Text, origin_language: Text = "en", destination_language: Text = "es"):
+        """
+        :param db_file: SQLite database file. It is created if it does not exist.
+        :param origin_language:
+        :param destination_language:
+        """
+        self.db_file = db_file
+        self.origin_language = origin_language
+        self.destination_language = destination_language
+        self._connection = sqlite3.connect(db_file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(_CREATE_TABLE)
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, text: Text) -> Text:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT translation FROM translations WHERE origin_language=? AND destination_language=? AND text=?",
+                (self.origin_language, self.destination_language, normalize_text(text))).fetchone()
+        if row is None:
+            raise KeyError(text)
+        return row[0]
+
+    def __setitem__(self, text: Text, translation: Text):
+        self.update([(text, translation)])
+
+    def __delitem__(self, text: Text):
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "DELETE FROM translations WHERE origin_language=? AND destination_language=? AND text=?",
+                (self.origin_language, self.destination_language, normalize_text(text)))
+        if cursor.rowcount == 0:
+            raise KeyError(text)
+
+    def __contains__(self, text) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM translations WHERE origin_language=? AND destination_language=? AND text=?",
+                (self.origin_language, self.destination_language, normalize_text(text))).fetchone()
+        return row is not None
+
+    def __iter__(self) -> Iterator[Text]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT text FROM translations WHERE origin_language=? AND destination_language=?",
+                (self.origin_language, self.destination_language)).fetchall()
+        return (r[0] for r in rows)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM translations WHERE origin_language=? AND destination_language=?",
+                (self.origin_language, self.destination_language)).fetchone()[0]
+
+    def get_many(self, texts: Iterable[Text], chunk_size: int = 500) -> Dict[Text, Text]:
+        """
+        Look up several texts at once.
+        :param texts:
+        :param chunk_size: Maximum number of texts per query.
+        :return: Dictionary with the translations found, keyed by the texts as given.
+        """
+        _by_key = {}
+        for t in texts:
+            _by_key.setdefault(normalize_text(t), []).append(t)
+        keys = list(_by_key)
+        res = {}
+        for i in range(0, len(keys), chunk_size):
+            _chunk = keys[i:i + chunk_size]
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT text, translation FROM translations WHERE origin_language=? AND destination_language=? "
+                    "AND text IN ({})".format(",".join("?" * len(_chunk))),
+                    [self.origin_language, self.destination_language] + _chunk).fetchall()
+            for key, translation in rows:
+                for t in _by_key[key]:
+                    res[t] = translation
+        return res
+
+    def update(self, translations: Union[Mapping[Text, Text], Iterable[Tuple[Text, Text]]] = (), **kwargs):
+        """
+        Insert (or replace) several translations in a single transaction.
+        :param translations: Mapping or iterable of (text, translation) pairs.
+        """
+        if isinstance(translations, Mapping):
+            translations = translations.items()
+        rows = [(self.origin_language, self.destination_language, normalize_text(t), tr)
+                for t, tr in list(translations) + list(kwargs.items())]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)", rows)
+
+    def import_log(self, log_file: Text, batch_size: int = 10000, tqdm_call: Optional[Callable] = tqdm) -> int:
+        """
+        Import a legacy translation log file with the format:
+        <original_text> $___$___$ <translated_text>
+
+        :param log_file:
+        :param batch_size: Number of translations inserted per transaction.
+        :param tqdm_call:
+        :return: Number of (non unique) translations read from the log.
+        """
+        count = 0
+        _buffer = []
+        with open(log_file) as f:
+            for l in tqdm_call(f, desc="Importing translation log"):
+                toks = l.split(_SEPARATOR)
+                if len(toks) == 2:
+                    _buffer.append((toks[0].strip(), toks[1].strip()))
+                if len(_buffer) >= batch_size:
+                    self.update(_buffer)
+                    count += len(_buffer)
+                    _buffer = []
+        if len(_buffer) > 0:
+            self.update(_buffer)
+            count += len(_buffer)
+        return count
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _lookup_translations(texts: pd.Series, translations: Mapping[Text, Text]) -> pd.Series:
+    if isinstance(translations, TranslationStore):
+        return texts.map(translations.get_many(texts))
+    # Series.map with a dict converts the whole dict to a Series; look up only the given texts instead
+    return pd.Series([translations.get(t) for t in texts], index=texts.index, dtype=object)
+
+
+def apply_translations(texts: Union[pd.Series, np.ndarray, List[Text]],
+                       translations: Mapping[Text, Text]) -> Tuple[pd.Series, np.ndarray]:
+    """
+    Translate texts (e.g. a DataFrame column) with a translation dictionary or store, in one vectorized pass.
+    Every unique text is looked up once, first as it is and then normalized (see normalize_text), and the
+    translations are taken back to all the texts.
+
+    :param texts:
+    :param translations: Translation dictionary or TranslationStore.
+    :return: Translated texts (None where there is no translation; with the index of texts if it is a Series) and
+    the unique texts without translation.
+    """
+    texts = texts if isinstance(texts, pd.Series) else pd.Series(texts, dtype=object)
+    codes, uniques = pd.factorize(texts)
+    keys = pd.Series(np.asarray(uniques, dtype=object), dtype=object)
+    res = _lookup_translations(keys, translations).astype(object)
+    _missing = res.isna().to_numpy()
+    if _missing.any():
+        res[_missing] = _lookup_translations(keys[_missing].map(normalize_text), translations).to_numpy()
+        _missing = res.isna().to_numpy()
+    _translated = res.to_numpy(dtype=object, copy=True)
+    _translated[_missing] = None
+    # Code -1 (null texts) takes the None appended at the end
+    _translated = np.append(_translated, None)
+    return pd.Series(_translated[codes], index=texts.index, dtype=object), keys.to_numpy()[_missing]
+
+
+def apply_translations_to_file(text_file: Text, translations: Mapping[Text, Text], destination_file: Text,
+                               missing_value: Text = "", chunk_size: int = 100000,
+                               encoding: Text = "utf-8") -> np.ndarray:
+    """
+    Translate a file with one text per line (e.g. the output of get_texts_to_translate or opensubtitles.py) with a
+    translation dictionary or store (see apply_translations). The file is translated in chunks of lines, so memory
+    does not grow with its size, and the translated file has the same lines.
+
+    :param text_file:
+    :param translations: Translation dictionary or TranslationStore.
+    :param destination_file:
+    :param missing_value: Line written for the texts without translation.
+    :param chunk_size: Number of lines translated at a time.
+    :param encoding: Encoding of both files.
+    :return: The unique texts without translation.
+    """
+    missing = {}
+    with open(text_file, "r", encoding=encoding) as f_in, \
+            open(destination_file, "w", encoding=encoding, buffering=1 << 20) as f_out:
+        while True:
+            lines = [l[:-1] if l.endswith("\n") else l for l in itertools.islice(f_in, chunk_size)]
+            if len(lines) == 0:
+                break
+            res, _missing = apply_translations(lines, translations)
+            res = res.fillna(missing_value).str.replace("\n", " ", regex=False)
+            f_out.writelines(t + "\n" for t in res)
+            missing.update(dict.fromkeys(_missing))
+    return np.array(list(missing), dtype=object)
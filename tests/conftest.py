@@ -0,0 +1,6 @@
+import os
+import sys
+
+_TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_TESTS_DIR, "..", "src"))
+sys.path.insert(0, os.path.join(_TESTS_DIR, "..", "benchmarks"))
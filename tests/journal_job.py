@@ -0,0 +1,22 @@
+# Resumable translation job run (and killed) by test_journal.py.
+#
+# Usage:
+#    python tests/journal_job.py <translator_url> <texts_file> <store_file> <journal_file> <log_file>
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from datasets_preprocess.azure_translator import AzureTranslator
+from datasets_preprocess.translation_store import TranslationStore
+
+
+if __name__ == "__main__":
+    url, texts_file, store_file, journal_file, log_file = sys.argv[1:6]
+    with open(texts_file) as f:
+        texts = [l.rstrip("\n") for l in f]
+    translator = AzureTranslator("test", base_url=url, requests_per_second=1000.0, backoff_factor=0.01)
+    with TranslationStore(store_file) as store:
+        translator.translate_with_dict(texts, store, num_texts_per_request=10, tqdm_call=lambda x, **kw: x,
+                                       log_file=log_file, num_workers=4, journal_file=journal_file)
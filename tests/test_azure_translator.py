@@ -0,0 +1,77 @@
+import pytest
+
+from datasets_preprocess.azure_translator import AzureTranslator
+from datasets_preprocess.translation_store import TranslationStore
+
+
+def _no_progress(x, **kwargs):
+    return x
+
+
+class _FakeTranslator(AzureTranslator):
+    """
+    AzureTranslator answering requests locally ("Yes" -> "Sí", any other text -> "<language>:<text>").
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__("test", *args, **kwargs)
+        self.sent = []
+
+    def _post(self, body):
+        self.sent.extend(e["text"] for e in body)
+        return [{"translations": [{"text": "Sí" if e["text"] == "Yes" else "{}:{}".format(l, e["text"]), "to": l}
+                                  for l in self.destination_languages]} for e in body]
+
+
+def test_canonicalize_restores_translations_of_the_texts(tmp_path):
+    translator = _FakeTranslator()
+    log_file = str(tmp_path / "translation_log")
+    with TranslationStore(str(tmp_path / "store.db")) as store:
+        translator.translate_with_dict(["Yes.", "yes!", "YES", "Yesss?"], store, canonicalize=True,
+                                       log_file=log_file, tqdm_call=_no_progress)
+        assert translator.sent == ["Yes"]
+        assert dict(store.items()) == {"Yes.": "Sí.", "yes!": "¡sí!", "YES": "SÍ", "Yesss?": "¿Sí?"}
+    # The canonical key is neither stored nor logged
+    with open(log_file) as f:
+        assert [l.split(" $___$___$ ")[0] for l in f] == ["Yes.", "yes!", "YES", "Yesss?"]
+
+
+def test_canonicalize_reuses_stored_keys():
+    translator = _FakeTranslator()
+    translation_dict = {"Yes": "Vale"}
+    translator.translate_with_dict(["Yes!", "Yes"], translation_dict, canonicalize=True, log_file=None,
+                                   tqdm_call=_no_progress)
+    assert translator.sent == []
+    assert translation_dict == {"Yes": "Vale", "Yes!": "¡Vale!"}
+
+
+class _UpperCaseTranslator(_FakeTranslator):
+    """
+    Fake translator returning upper case language codes, as a service normalizing them differently would.
+    """
+
+    def __init__(self, *args, drop_last: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.drop_last = drop_last
+
+    def _post(self, body):
+        response = super()._post(body)
+        for r in response:
+            for t in r["translations"]:
+                t["to"] = t["to"].upper()
+        return response[:-1] if self.drop_last else response
+
+
+def test_translations_are_mapped_by_position_on_the_destination_languages():
+    translator = _UpperCaseTranslator(destination_language=["es", "fr"])
+    translation_dict = {"es": {}, "fr": {}}
+    res = translator.translate_batch(["Yes", "No"], translation_dict=translation_dict, log_file=None,
+                                     tqdm_call=_no_progress)
+    assert res == ["Sí", "es:No"]
+    assert translation_dict == {"es": {"Yes": "Sí", "No": "es:No"}, "fr": {"Yes": "Sí", "No": "fr:No"}}
+
+
+def test_short_response_raises():
+    translator = _UpperCaseTranslator(destination_language=["es", "fr"], drop_last=True)
+    with pytest.raises(ValueError, match="Expected 2 translated texts"):
+        translator.translate_text_azure_multi(["Yes", "No"], log_file=None)
@@ -0,0 +1,20 @@
+from datasets_preprocess.canonical import CanonicalForms
+
+
+def _keys(texts, **kwargs):
+    forms = CanonicalForms(texts, **kwargs)
+    return [forms.keys[i] for i in forms.key_ids]
+
+
+def test_repeated_letters_are_collapsed_inside_words():
+    assert _keys(["Nooo!", "no", "Sooo good"]) == ["No", "No", "So good"]
+
+
+def test_upper_case_words_and_urls_are_kept():
+    texts = ["Henry VIII", "Henry VI", "World War III", "World War I", "www.imdb.com"]
+    assert len(set(_keys(texts))) == len(texts)
+    assert _keys(["www.imdb.com"]) == ["Www.imdb.com"]
+
+
+def test_collapse_repeats_can_be_disabled():
+    assert _keys(["Nooo", "No"], collapse_repeats=False) == ["Nooo", "No"]
@@ -0,0 +1,18 @@
+from synthetic import write_cornell_corpus
+from datasets_preprocess.cornell_movies import load_cornell_file
+
+
+def _no_progress(x, **kwargs):
+    return x
+
+
+def test_cache_is_keyed_on_loading_parameters(tmp_path):
+    write_cornell_corpus(str(tmp_path), num_movies=2, conversations_per_movie=5)
+    lines_file = str(tmp_path / "movie_lines.txt")
+    cache_file = str(tmp_path / "movie_lines.pkl")
+    compact = load_cornell_file(lines_file, compact=True, cache_file=cache_file, tqdm_call=_no_progress)
+    assert compact["LINE_ID"].dtype.kind == "i"
+    not_compact = load_cornell_file(lines_file, compact=False, cache_file=cache_file, tqdm_call=_no_progress)
+    assert not_compact["LINE_ID"].iloc[0].startswith("L")
+    cached = load_cornell_file(lines_file, compact=False, cache_file=cache_file, tqdm_call=_no_progress)
+    assert cached.equals(not_compact)
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import random
+import signal
+import subprocess
+from collections import Counter
+
+from mock_translator import MockTranslatorServer
+from datasets_preprocess.translation_store import TranslationStore
+
+_JOB_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal_job.py")
+
+
+def _stored_texts(store_file):
+    if not os.path.exists(store_file):
+        return set()
+    with TranslationStore(store_file) as store:
+        return set(store)
+
+
+def test_killed_job_resumes_without_resending_committed_batches(tmp_path):
+    texts = ["sentence number {} of the job".format(i) for i in range(2000)]
+    texts_file = str(tmp_path / "texts.txt")
+    with open(texts_file, "w") as f:
+        f.write("".join(t + "\n" for t in texts))
+    store_file = str(tmp_path / "store.db")
+    _random = random.Random(0)
+    with MockTranslatorServer(latency=0.01, record_requests=True) as server:
+        args = [sys.executable, _JOB_SCRIPT, server.url, texts_file, store_file, str(tmp_path / "journal"),
+                str(tmp_path / "translation_log")]
+        # Texts stored at the time of the last kill, and characters of the texts sent (billed) by every killed run
+        # but not stored
+        stored = set()
+        in_flight = set()
+        in_flight_chars = 0
+        num_kills = 0
+        for attempt in range(6):
+            _num_requests = len(server.received_requests)
+            process = subprocess.Popen(args)
+            if attempt < 5:
+                # Killed at a random point once it has started sending requests (the last run is not killed)
+                while process.poll() is None and len(server.received_requests) == _num_requests:
+                    time.sleep(0.01)
+                time.sleep(_random.uniform(0.0, 0.3))
+                if process.poll() is None:
+                    process.send_signal(signal.SIGKILL)
+                    num_kills += 1
+            process.wait(timeout=120)
+            # Committed texts are never sent again
+            for r in server.received_requests[_num_requests:]:
+                assert not stored.intersection(r)
+            stored = _stored_texts(store_file)
+            _in_flight = [t for r in server.received_requests[_num_requests:] for t in r if t not in stored]
+            in_flight.update(_in_flight)
+            in_flight_chars += sum(len(t) for t in _in_flight)
+            if process.returncode == 0:
+                break
+        assert process.returncode == 0
+        assert num_kills > 0
+
+    # The store is complete
+    with TranslationStore(store_file) as store:
+        assert len(store) == len(texts)
+        assert store.get_many(texts) == {t: "[es] " + t for t in texts}
+    # Texts sent more than once were in flight when the job was killed
+    sent = Counter(t for r in server.received_requests for t in r)
+    assert set(t for t, c in sent.items() if c > 1) <= in_flight
+    assert sum(len(t) * c for t, c in sent.items()) - sum(len(t) for t in texts) <= in_flight_chars
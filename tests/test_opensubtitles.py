@@ -0,0 +1,72 @@
+import os
+import random
+
+from synthetic import write_opensubtitles_corpus
+from datasets_preprocess.metrics import Metrics
+from datasets_preprocess.opensubtitles import LinkGroupIndex, HashSet64, BloomFilter, PairFilter, count_link_groups, \
+    extract_aligned_texts
+
+
+def test_stale_link_group_index_is_rebuilt(tmp_path):
+    alignment_file = str(tmp_path / "alignment.xml")
+    write_opensubtitles_corpus(str(tmp_path), num_documents=5)
+    assert len(LinkGroupIndex.load_or_build(alignment_file)) == 5
+    assert count_link_groups(alignment_file) == 5
+    # Regenerate the corpus in place, keeping the old index next to it
+    write_opensubtitles_corpus(str(tmp_path), num_documents=3, seed=1)
+    assert os.path.exists(LinkGroupIndex.get_index_file(alignment_file))
+    assert LinkGroupIndex.load(alignment_file).is_stale()
+    assert count_link_groups(alignment_file) == 3
+    index = LinkGroupIndex.load_or_build(alignment_file)
+    assert len(index) == 3
+    assert not LinkGroupIndex.load(alignment_file).is_stale()
+
+
+def test_workers_record_document_parse_metrics(tmp_path):
+    write_opensubtitles_corpus(str(tmp_path), num_documents=6)
+    metrics = Metrics()
+    extract_aligned_texts(str(tmp_path / "alignment.xml"), str(tmp_path), str(tmp_path / "out.en"),
+                          str(tmp_path / "out.es"), num_workers=2, chunksize=1, metrics=metrics)
+    # Every link group has its own pair of documents
+    assert metrics.get("opensubtitles_documents_parsed_total") == 12
+    assert metrics.get_histogram("opensubtitles_document_parse_seconds").count == 12
+
+
+def test_hash_set_matches_a_set():
+    rng = random.Random(0)
+    # Hashes 0 and 1, and hashes sharing their home slots (wrapping around the end of the table)
+    hashes = [0, 1] + [(k << 32) | 15 for k in range(40)] + [rng.getrandbits(64) for _ in range(5000)]
+    hashes += rng.sample(hashes, 1000)
+    seen = HashSet64(capacity=16)
+    expected = set()
+    for h in hashes:
+        assert seen.add(h) == (h not in expected)
+        expected.add(h)
+    assert len(seen) == len(expected)
+    assert not any(seen.add(h) for h in expected)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(128) for _ in range(2000)]
+    bloom = BloomFilter(max_bytes=1 << 16, expected_items=len(hashes))
+    assert sum(bloom.add(h) for h in hashes) >= len(hashes) - 2
+    assert not any(bloom.add(h) for h in hashes)
+    assert bloom.num_bytes == 1 << 16
+
+
+def test_pair_filter():
+    pair_filter = PairFilter(dedup="exact", min_chars=2, max_chars=20, max_length_ratio=2.0, ratio_min_chars=5)
+    texts_orig = ["Hi there", "A", "Hi there", "Hi", "A very long sentence here", "Hello world again", "Good morning"]
+    texts_dest = ["Hola", "Una", "Hola", "Ey", "Corta", "Adiós", "Buenos días"]
+    assert pair_filter.filter(texts_orig, texts_dest) == (["Hi there", "Hi", "Good morning"],
+                                                          ["Hola", "Ey", "Buenos días"])
+    assert pair_filter.stats() == {"pairs": 7, "kept": 3, "too_short": 1, "too_long": 1, "length_ratio": 1,
+                                   "duplicate": 1, "dedup_bytes": pair_filter.stats()["dedup_bytes"]}
+
+
+def test_pair_filter_keeps_empty_texts_by_default():
+    pair_filter = PairFilter(dedup=None)
+    assert pair_filter.filter(["", "Hi"], ["Hola", ""]) == (["", "Hi"], ["Hola", ""])
+    assert pair_filter.stats() == {"pairs": 2, "kept": 2, "too_short": 0, "too_long": 0, "length_ratio": 0,
+                                   "duplicate": 0}
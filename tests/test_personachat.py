@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from synthetic import write_personachat_dataset
+from datasets_preprocess.personachat import iter_dataset, write_dataset
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64])
+def test_iter_dataset_with_chunks_smaller_than_a_dialogue(tmp_path, chunk_size):
+    dataset_file = str(tmp_path / "dataset.json")
+    write_personachat_dataset(dataset_file, num_dialogues=5)
+    with open(dataset_file) as f:
+        expected = json.load(f)
+    assert min(len(json.dumps(d)) for d in expected) > chunk_size
+    assert list(iter_dataset(dataset_file, chunk_size=chunk_size)) == expected
+
+
+def test_interrupted_write_keeps_the_previous_dataset(tmp_path):
+    dataset_file = str(tmp_path / "dataset.json")
+    write_dataset([{"dialog": [{"text": "Hi"}]}], dataset_file)
+
+    def _dialogues():
+        yield {"dialog": [{"text": "Bye"}]}
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        write_dataset(_dialogues(), dataset_file)
+    with open(dataset_file) as f:
+        assert json.load(f) == [{"dialog": [{"text": "Hi"}]}]
+    assert [p.name for p in tmp_path.iterdir()] == ["dataset.json"]
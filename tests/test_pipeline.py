@@ -0,0 +1,136 @@
+import time
+import threading
+from collections import Counter
+
+import pytest
+
+from synthetic import write_personachat_dataset, write_opensubtitles_corpus
+from datasets_preprocess.translate import Translator
+from datasets_preprocess.personachat import translate_dataset
+from datasets_preprocess.opensubtitles import extract_aligned_texts
+from datasets_preprocess.pipeline import PipelineDataset, TranslationPipeline, PersonaChatDataset, \
+    CornellMovieLinesDataset, OpenSubtitlesDataset
+
+
+class _CountingTranslator(Translator):
+
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+        self.sent = Counter()
+        self._lock = threading.Lock()
+
+    def translate_batch(self, texts, **kwargs):
+        with self._lock:
+            self.sent.update(texts)
+        time.sleep(self.latency)
+        if "fail" in texts:
+            raise RuntimeError("Translation service error")
+        return ["ES " + t for t in texts]
+
+
+class _ListDataset(PipelineDataset):
+
+    def __init__(self, units):
+        self.units = units
+        self.output = None
+
+    def iter_units(self):
+        for u in self.units:
+            yield u, u
+
+    def write(self, units):
+        self.output = list(units)
+
+
+@pytest.mark.parametrize("num_translation_threads", [1, 4])
+def test_shared_texts_are_translated_once(num_translation_threads):
+    # 20 windows of 10 texts, all of them with "hi there"
+    units = [["hi there"] + ["text {} {}".format(w, i) for i in range(9)] for w in range(20)]
+    translator = _CountingTranslator()
+    dataset = _ListDataset(units)
+    pipeline = TranslationPipeline(dataset, translator, batch_size=5, window_size=10, queue_size=8,
+                                   num_translation_threads=num_translation_threads, tqdm_call=lambda x, **k: x)
+    pipeline.run()
+    assert translator.sent["hi there"] == 1
+    assert max(translator.sent.values()) == 1
+    assert [u for u, _ in dataset.output] == units
+    assert all(t == ["ES " + s for s in u] for u, t in dataset.output)
+
+
+def test_cached_texts_are_not_translated():
+    units = [["a", "b"], ["b", "c"]]
+    translator = _CountingTranslator(latency=0.0)
+    dataset = _ListDataset(units)
+    TranslationPipeline(dataset, translator, translation_dict={"b": "B"}, window_size=1,
+                        tqdm_call=lambda x, **k: x).run()
+    assert translator.sent == Counter({"a": 1, "c": 1})
+    assert [t for _, t in dataset.output] == [["ES a", "B"], ["B", "ES c"]]
+
+
+def _no_progress(x, **kwargs):
+    return x
+
+
+@pytest.mark.parametrize("num_translation_threads", [1, 4])
+def test_texts_are_deduplicated_by_normalized_text(num_translation_threads):
+    units = [["hi there", "text {}".format(w), " hi  there"] for w in range(20)]
+    translator = _CountingTranslator()
+    dataset = _ListDataset(units)
+    TranslationPipeline(dataset, translator, window_size=3, num_translation_threads=num_translation_threads,
+                        tqdm_call=_no_progress).run()
+    assert translator.sent["hi there"] + translator.sent[" hi  there"] == 1
+    assert all(t[0] == t[2] and t[0] in ("ES hi there", "ES  hi  there") for _, t in dataset.output)
+
+
+def test_stage_errors_are_raised_by_run():
+    units = [["text {}".format(i)] for i in range(50)] + [["fail"]] + [["text {}".format(i)] for i in range(50)]
+    dataset = _ListDataset(units)
+    pipeline = TranslationPipeline(dataset, _CountingTranslator(latency=0.0), window_size=5,
+                                   num_translation_threads=2, tqdm_call=_no_progress)
+    with pytest.raises(RuntimeError, match="Translation service error"):
+        pipeline.run()
+
+
+def test_personachat_output_is_the_same_as_translate_dataset(tmp_path):
+    dataset_file = str(tmp_path / "dataset.json")
+    write_personachat_dataset(dataset_file, num_dialogues=30)
+    translate_dataset(dataset_file, str(tmp_path / "expected.json"), _CountingTranslator(latency=0.0),
+                      tqdm_call=_no_progress)
+    TranslationPipeline(PersonaChatDataset(dataset_file, str(tmp_path / "output.json")),
+                        _CountingTranslator(latency=0.0), window_size=50, num_translation_threads=2,
+                        tqdm_call=_no_progress).run()
+    with open(str(tmp_path / "expected.json"), "rb") as f_expected, open(str(tmp_path / "output.json"), "rb") as f:
+        assert f.read() == f_expected.read()
+
+
+def test_cornell_movie_lines_are_translated_to_utf8(tmp_path):
+    movie_lines_file = str(tmp_path / "movie_lines.txt")
+    with open(movie_lines_file, "w", encoding="iso-8859-1") as f:
+        f.write("L1 +++$+++ u0 +++$+++ m0 +++$+++ BIANCA +++$+++ They do not!\n")
+        f.write("L2 +++$+++ u1 +++$+++ m0 +++$+++ CAMERON +++$+++ Café?\n")
+        f.write("L3 +++$+++ u1 +++$+++ m0 +++$+++ CAMERON\n")
+    destination_file = str(tmp_path / "movie_lines_es.txt")
+    TranslationPipeline(CornellMovieLinesDataset(movie_lines_file, destination_file),
+                        _CountingTranslator(latency=0.0), tqdm_call=_no_progress).run()
+    with open(destination_file, encoding="utf-8") as f:
+        assert f.read() == ("L1 +++$+++ u0 +++$+++ m0 +++$+++ BIANCA +++$+++ ES They do not!\n"
+                            "L2 +++$+++ u1 +++$+++ m0 +++$+++ CAMERON +++$+++ ES Café?\n"
+                            "L3 +++$+++ u1 +++$+++ m0 +++$+++ CAMERON\n")
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_opensubtitles_output_is_the_same_as_extract_aligned_texts(tmp_path, num_workers):
+    base_dir = str(tmp_path / "corpus")
+    write_opensubtitles_corpus(base_dir, num_documents=6)
+    alignment_file = str(tmp_path / "corpus" / "alignment.xml")
+    extract_aligned_texts(alignment_file, base_dir, str(tmp_path / "expected.en"), str(tmp_path / "expected.es"),
+                          num_workers=2)
+    outputs = [str(tmp_path / "output.{}".format(l)) for l in ("en", "es", "trans")]
+    TranslationPipeline(OpenSubtitlesDataset(alignment_file, base_dir, *outputs, num_workers=num_workers),
+                        _CountingTranslator(latency=0.0), tqdm_call=_no_progress).run()
+    for l in ("en", "es"):
+        with open(str(tmp_path / "expected.{}".format(l))) as f_expected, \
+                open(str(tmp_path / "output.{}".format(l))) as f:
+            assert f.read() == f_expected.read()
+    with open(outputs[0]) as f_orig, open(outputs[2]) as f_trans:
+        assert ["ES " + t for t in f_orig] == list(f_trans)
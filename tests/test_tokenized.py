@@ -0,0 +1,19 @@
+from datasets_preprocess.tokenized import Vocabulary, SPECIAL_TOKENS
+
+
+def _no_progress(x, **kwargs):
+    return x
+
+
+def test_vocabulary_is_reproducible(tmp_path):
+    text_file = str(tmp_path / "texts.txt")
+    with open(text_file, "w") as f:
+        for i in range(200):
+            f.write("word{} word{} shared\n".format(i, i % 7))
+    vocabularies = [Vocabulary.build([text_file], max_size=20, num_workers=w, chunk_size=c, tqdm_call=_no_progress)
+                    for w, c in [(1, 1000), (1, 7), (4, 7)]]
+    assert all(v.tokens == vocabularies[0].tokens for v in vocabularies)
+    tokens = vocabularies[0].tokens
+    assert tokens[:len(SPECIAL_TOKENS)] == SPECIAL_TOKENS
+    assert tokens[len(SPECIAL_TOKENS)] == "shared"
+    assert len(tokens) == 20
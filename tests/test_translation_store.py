@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from datasets_preprocess.translation_store import TranslationStore, apply_translations, apply_translations_to_file
+
+
+def test_apply_translations_keeps_index_and_nulls():
+    texts = pd.Series(["Hi", None, "Bye", "Hi", np.nan, "Unknown"], index=[10, 11, 12, 13, 14, 15])
+    res, missing = apply_translations(texts, {"Hi": "Hola", "Bye": "Adiós"})
+    assert list(res.index) == [10, 11, 12, 13, 14, 15]
+    assert res.tolist() == ["Hola", None, "Adiós", "Hola", None, None]
+    assert missing.tolist() == ["Unknown"]
+
+
+def test_apply_translations_retries_normalized_texts(tmp_path):
+    texts = ["  Good   morning ", "Good morning", "Night"]
+    res, missing = apply_translations(texts, {"Good morning": "Buenos días"})
+    assert res.tolist() == ["Buenos días", "Buenos días", None]
+    assert missing.tolist() == ["Night"]
+    with TranslationStore(str(tmp_path / "store.db")) as store:
+        store["Night"] = "Noche"
+        res, missing = apply_translations(["Night ", "Good morning"], store)
+        assert res.tolist() == ["Noche", None]
+        assert missing.tolist() == ["Good morning"]
+
+
+def test_apply_translations_to_file_in_chunks(tmp_path):
+    text_file = str(tmp_path / "texts.txt")
+    destination_file = str(tmp_path / "translated.txt")
+    with open(text_file, "w", encoding="utf-8") as f:
+        f.write("Hi\nBye\nWhy?\nHi\nBye\nWhy?\nHi")
+    missing = apply_translations_to_file(text_file, {"Hi": "Hola", "Bye": "Adiós\nadiós"}, destination_file,
+                                         missing_value="?", chunk_size=2)
+    assert missing.tolist() == ["Why?"]
+    with open(destination_file, encoding="utf-8") as f:
+        assert f.read() == "Hola\nAdiós adiós\n?\nHola\nAdiós adiós\n?\nHola\n"